@@ -0,0 +1,126 @@
+"""Background preparation of batches.
+
+While TensorFlow runs a batch, the CPU is mostly idle. The prefetcher uses
+this time to create the next batches and their feed dictionaries in
+a background thread. TensorFlow releases the global interpreter lock during
+the session run, so the preparation really runs in parallel with it.
+"""
+
+# tests: lint, mypy
+
+import queue
+import threading
+from typing import Any, Callable, Iterable, Optional, Tuple
+
+from neuralmonkey.dataset import Dataset
+
+# how often (in seconds) the blocked background thread checks if it should end
+_POLL_INTERVAL = 0.1
+
+
+class _Sentinel(object):
+    """Marker of the end of the batches."""
+
+
+class _Failure(object):
+    """Exception raised in the background thread."""
+
+    def __init__(self, exception: BaseException) -> None:
+        self.exception = exception
+
+
+class BatchPrefetcher(object):
+    """Prepare batches in a background thread.
+
+    Iterating over the prefetcher yields tuples of the batches and their
+    prepared data. When the iteration is left early (e.g. on
+    ``KeyboardInterrupt``), the prefetcher must be closed to end the
+    background thread; using it as a context manager does that. An exception
+    raised during the preparation is re-raised in the iterating thread.
+
+    Example::
+
+        with BatchPrefetcher(dataset.batch_dataset(64), prepare, 4) as batches:
+            for batch, prepared in batches:
+                ...
+    """
+
+    def __init__(self, batches: Iterable[Dataset],
+                 prepare: Callable[[Dataset], Any],
+                 queue_size: int) -> None:
+        """Create the prefetcher.
+
+        Arguments:
+            batches: The batches to prepare.
+            prepare: Function computing the data needed for a batch, e.g.
+                its feed dictionary.
+            queue_size: The maximum number of prepared batches waiting to be
+                used. Zero means the batches are prepared synchronously
+                when they are requested.
+        """
+        self._batches = batches
+        self._prepare = prepare
+        self._queue_size = queue_size
+        self._queue = queue.Queue(max(queue_size, 1))  # type: queue.Queue
+        self._stop = threading.Event()
+        self._thread = None  # type: Optional[threading.Thread]
+
+    def __iter__(self) -> Iterable[Tuple[Dataset, Any]]:
+        if self._queue_size <= 0:
+            return ((batch, self._prepare(batch)) for batch in self._batches)
+
+        if self._thread is not None:
+            raise Exception("The batches can be iterated only once.")
+        self._thread = threading.Thread(target=self._produce, daemon=True)
+        self._thread.start()
+        return self._consume()
+
+    def __enter__(self) -> "BatchPrefetcher":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Stop the background thread and wait for its end."""
+        if self._thread is None:
+            return
+
+        self._stop.set()
+        # unblock the thread waiting for a free place in the queue
+        while self._thread.is_alive():
+            try:
+                self._queue.get(timeout=_POLL_INTERVAL)
+            except queue.Empty:
+                pass
+        self._thread.join()
+        self._thread = None
+
+    def _produce(self) -> None:
+        try:
+            for batch in self._batches:
+                if not self._put((batch, self._prepare(batch))):
+                    return
+            self._put(_Sentinel())
+        # pylint: disable=broad-except
+        except BaseException as exc:
+            self._put(_Failure(exc))
+
+    def _put(self, item: Any) -> bool:
+        """Put an item into the queue unless the prefetcher is stopped."""
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _consume(self) -> Iterable[Tuple[Dataset, Any]]:
+        while True:
+            item = self._queue.get()
+            if isinstance(item, _Sentinel):
+                return
+            if isinstance(item, _Failure):
+                raise item.exception
+            yield item
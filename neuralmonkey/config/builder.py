@@ -4,6 +4,7 @@ specified by the experiment configuration
 """
 
 import collections
+import copy
 import importlib
 from inspect import signature, isclass, isfunction
 
@@ -11,6 +12,11 @@ from neuralmonkey.logging import debug
 from neuralmonkey.config.exceptions import (ConfigInvalidValueException,
                                             ConfigBuildException)
 
+# the function building vocabularies from datasets and the one loading the
+# datasets, which counts the tokens for all the vocabularies at once
+VOCABULARY_FROM_DATASET = "vocabulary.from_dataset"
+LOAD_DATASET = "dataset.load_dataset_from_files"
+
 
 # pylint:disable=too-few-public-methods
 class ClassSymbol(object):
@@ -169,6 +175,7 @@ def build_config(config_dicts, ignore_names):
         raise Exception("Configuration does not contain the main block.")
 
     existing_objects = collections.OrderedDict()
+    config_dicts = _add_counted_series(config_dicts)
 
     main_config = config_dicts['main']
 
@@ -185,3 +192,52 @@ def build_config(config_dicts, ignore_names):
                 raise ConfigBuildException(key, exc) from None
 
     return configuration
+
+
+def _add_counted_series(config_dicts):
+    """Let the datasets count the tokens for the vocabularies built from them.
+
+    The series used by the ``vocabulary.from_dataset`` sections are set as
+    the ``count_series`` argument of the datasets loaded by
+    ``dataset.load_dataset_from_files`` unless it is set explicitly. The
+    datasets then count the tokens of all their vocabularies in a single
+    pass.
+
+    Arguments:
+        config_dicts: The parsed configuration file.
+
+    Returns:
+        The configuration with the updated dataset sections. The original
+        dictionaries are not changed.
+    """
+    counted_series = collections.OrderedDict()
+    for section in config_dicts.values():
+        if not _has_class(section, VOCABULARY_FROM_DATASET):
+            continue
+        datasets = section.get("datasets", [])
+        series_ids = section.get("series_ids", [])
+        if not isinstance(datasets, list) or not isinstance(series_ids, list):
+            continue
+        for reference in datasets:
+            if not (isinstance(reference, str) and
+                    reference.startswith("object:")):
+                continue
+            series = counted_series.setdefault(reference[7:], [])
+            series.extend(s for s in series_ids
+                          if isinstance(s, str) and s not in series)
+
+    config_dicts = copy.copy(config_dicts)
+    for name, series in counted_series.items():
+        section = config_dicts.get(name)
+        if (section is not None and _has_class(section, LOAD_DATASET) and
+                "count_series" not in section):
+            debug("Dataset '{}' counts tokens of series {}".format(
+                name, series), "configBuild")
+            config_dicts[name] = copy.copy(section)
+            config_dicts[name]["count_series"] = series
+    return config_dicts
+
+
+def _has_class(section, class_name):
+    clazz = section.get("class") if isinstance(section, dict) else None
+    return isinstance(clazz, ClassSymbol) and clazz.clazz == class_name
@@ -1,17 +1,34 @@
 """ Implementation of the dataset class. """
 
-import random
+import copy
+import functools
+import itertools
+import multiprocessing
+import pickle
 import re
 import collections
 
-from typing import cast, Any, List, Callable, Iterable, Dict, Tuple, Union
+from typing import (cast, Any, List, Callable, Iterable, Dict, Optional,
+                    Tuple, Union)
 
 import numpy as np
 from typeguard import check_argument_types
 
+from neuralmonkey.dataset_cache import (
+    dataset_cache_key, load_cached_series, load_filtered_index,
+    load_token_counts, cache_series)
 from neuralmonkey.logging import log
+from neuralmonkey.readers.numpy_reader import ConcatenatedArray
 from neuralmonkey.readers.utils import Reader
-from neuralmonkey.readers.plain_text_reader import UtfPlainTextReader
+from neuralmonkey.readers.plain_text_reader import (
+    PlainTextReader, UtfPlainTextReader, line_index)
+from neuralmonkey.token_series import (
+    OrderedCounter, TokenSeries, count_tokens)
+
+# filter of dataset rows, see neuralmonkey.processors.filters
+# pylint: disable=invalid-name
+ItemFilter = Callable[[Dict[str, Any]], Optional[str]]
+# pylint: enable=invalid-name
 
 
 class Dataset(collections.Sized):
@@ -19,9 +36,15 @@ class Dataset(collections.Sized):
     encoders and decoders in the model. If it is not provided a parent
     dataset, it also manages the vocabularies inferred from the data.
 
-    A data series is either a list of strings or a numpy array.
+    A data series is either a list of strings or a numpy array. Tokenized
+    text can also be stored in the compact columnar form of a ``TokenSeries``
+    which behaves as a read-only list of sentences. Arrays stored in several
+    files can be concatenated virtually by a ``ConcatenatedArray``.
     """
 
+    # whether the series are stored, so the batches can refer to them
+    _stored = True
+
     def __init__(self, name: str, series: Dict[str, List],
                  series_outputs: Dict[str, str]) -> None:
         """Creates a dataset from the provided already preprocessed
@@ -36,6 +59,30 @@ class Dataset(collections.Sized):
         self._series = series
         self.series_outputs = series_outputs
 
+        # positions of the items in the dataset this one was batched,
+        # sharded or filtered from
+        self.indices = None  # type: Optional[np.ndarray]
+        # position in the dataset this one was batched from after this batch
+        # as the number of items before its window and the number of batches
+        # taken from the window (see ``skip``)
+        self.position = None  # type: Optional[Tuple[int, int]]
+        # position at which the next pass through the data starts
+        self._start_position = 0
+        self._start_batches = 0
+        # order in which the items are batched, None means the stored order
+        self._permutation = None  # type: Optional[np.ndarray]
+        self.shuffle_seed = None  # type: Optional[int]
+        self.padding_statistics = PaddingStatistics()
+        # text series converted to vocabulary indices (see
+        # ``get_token_ids``) and the dataset this one was batched from,
+        # whose converted series are used instead
+        self._token_ids = {}  # type: Dict[Tuple[str, int], Tuple]
+        self._batched_from = None  # type: Optional[Dataset]
+        # text series whose tokens are counted together when the counts of
+        # any of them are needed (see ``token_counts``) and their counts
+        self.counted_series = []  # type: List[str]
+        self._token_counts = {}  # type: Dict[str, collections.Counter]
+
         self._check_series_lengths()
 
     def _check_series_lengths(self) -> None:
@@ -44,11 +91,12 @@ class Dataset(collections.Sized):
         Raises:
             Exception when the lengths in the dataset do not match.
         """
-        lengths = [len(list(v)) for v in self._series.values()
-                   if isinstance(v, list) or isinstance(v, np.ndarray)]
+        lengths = [len(v) for v in self._series.values()
+                   if isinstance(v, (list, np.ndarray, TokenSeries,
+                                     ConcatenatedArray))]
 
         if len(set(lengths)) > 1:
-            err_str = ["{}: {}".format(s, len(list(self._series[s])))
+            err_str = ["{}: {}".format(s, len(self._series[s]))
                        for s in self._series]
             raise Exception("Lengths of data series must be equal. Instead: {}"
                             .format(", ".join(err_str)))
@@ -63,6 +111,8 @@ class Dataset(collections.Sized):
             return 0
         else:
             first_series = next(iter(self._series.values()))
+            if hasattr(first_series, "__len__"):
+                return len(first_series)
             return len(list(first_series))
 
     def has_series(self, name: str) -> bool:
@@ -79,6 +129,9 @@ class Dataset(collections.Sized):
     def get_series(self, name: str, allow_none: bool=False) -> Iterable:
         """Get the data series with a given name.
 
+        The series is always returned in the order in which it was loaded,
+        shuffling only changes the order in which the dataset is batched.
+
         Arguments:
             name: The name of the series to fetch.
             allow_none: If True, return None if the series does not exist.
@@ -98,13 +151,108 @@ class Dataset(collections.Sized):
     def series_ids(self) -> Iterable[str]:
         return self._series.keys()
 
-    def shuffle(self) -> None:
-        """Shuffle the dataset randomly """
-        keys = list(self._series.keys())
-        zipped = list(zip(*[self._series[k] for k in keys]))
-        random.shuffle(zipped)
-        for key, serie in zip(keys, list(zip(*zipped))):
-            self._series[key] = serie
+    def get_token_ids(self, name: str, vocabulary: Any) -> TokenSeries:
+        """Get a text series converted to the indices of a vocabulary.
+
+        The converted series is cached, so every word is looked up in the
+        vocabulary only once per run. The batches of a dataset whose series
+        are stored take the indices from the cache of that dataset, which
+        makes the later epochs only gather the cached arrays.
+
+        Arguments:
+            name: The name of the series.
+            vocabulary: The ``Vocabulary`` to use.
+
+        Returns:
+            Token series whose token table is the list of the vocabulary
+            words (see ``Vocabulary.series_to_ids``).
+        """
+        if self._batched_from is not None:
+            return self._batched_from.get_token_ids(
+                name, vocabulary).take(self.indices)
+
+        key = (name, id(vocabulary))
+        cached = self._token_ids.get(key)
+        # the indices change only when words are added or removed
+        if (cached is None or cached[0] is not vocabulary or
+                cached[1] != len(vocabulary)):
+            cached = (vocabulary, len(vocabulary),
+                      vocabulary.series_to_ids(self.get_series(name)))
+            self._token_ids[key] = cached
+        return cached[2]
+
+    def token_counts(self, name: str) -> Optional[collections.Counter]:
+        """Get the counts of the tokens of a counted text series.
+
+        All series listed in ``counted_series`` are counted in a single pass
+        through the data when the counts of any of them are needed for the
+        first time, so building several vocabularies from a dataset reads it
+        only once.
+
+        Arguments:
+            name: The name of the series.
+
+        Returns:
+            Counter of the tokens in the order of their first occurrence, None
+            if the series is not among the counted ones.
+        """
+        if name not in self.counted_series:
+            return None
+        if name not in self._token_counts:
+            self._token_counts = self._count_tokens(self.counted_series)
+        return self._token_counts[name]
+
+    def _count_tokens(self, names: List[str]) -> Dict[
+            str, collections.Counter]:
+        """Count the tokens of the series, missing series have no tokens."""
+        counts = {}  # type: Dict[str, collections.Counter]
+        for name in names:
+            series = self.get_series(name, allow_none=True)
+            counts[name] = count_tokens(series if series is not None else [])
+        return counts
+
+    def shuffle(self, seed: Optional[int]=None) -> None:
+        """Shuffle the dataset randomly.
+
+        The data series are not reordered. Instead, a random permutation of
+        the item indices is kept next to the series and the batches are taken
+        through it, so no copy of the data is made.
+
+        Arguments:
+            seed: Seed of the random permutation. The same seed always leads
+                to the same order, which allows resuming the training from
+                the middle of an epoch. If None (default), the global NumPy
+                random generator is used.
+        """
+        if seed is None:
+            self._permutation = np.random.permutation(len(self))
+        else:
+            self._permutation = np.random.RandomState(seed).permutation(
+                len(self))
+        self.shuffle_seed = seed
+
+    def skip(self, num_items: int, num_batches: int=0) -> None:
+        """Start the next pass through the data at the given position.
+
+        Together with a seeded shuffling, this allows resuming the training
+        exactly at the batch where it stopped, using the ``position`` of the
+        last trained batch.
+
+        Arguments:
+            num_items: Number of items to skip in the current order.
+            num_batches: Number of batches to skip from the window that
+                starts after the skipped items. The window is split the same
+                way as before only if the dataset is shuffled with the same
+                seed (or not at all).
+
+        Raises:
+            ValueError if the dataset is shorter than the skipped items.
+        """
+        if num_items > len(self):
+            raise ValueError("Trying to skip more instances than "
+                             "the size of the dataset")
+        self._start_position = num_items
+        self._start_batches = num_batches
 
     def batch_serie(self, serie_name: str,
                     batch_size: int) -> Iterable[Iterable]:
@@ -117,8 +265,12 @@ class Dataset(collections.Sized):
         Returns:
             Generator yielding batches of the data from the serie.
         """
+        series = self.get_series(serie_name)
+        if self._permutation is not None:
+            series = (series[i] for i in self._permutation)
+
         buf = []
-        for item in self.get_series(serie_name):
+        for item in series:
             buf.append(item)
             if len(buf) >= batch_size:
                 yield buf
@@ -126,25 +278,189 @@ class Dataset(collections.Sized):
         if buf:
             yield buf
 
-    def batch_dataset(self, batch_size: int) -> Iterable['Dataset']:
+    def batch_dataset(self, batch_size: int,
+                      bucket_span: Optional[int]=None,
+                      batch_tokens: Optional[int]=None,
+                      length_series: Optional[List[str]]=None) -> Iterable[
+                          'Dataset']:
         """Split the dataset into a list of batched datasets.
 
+        If the bucketing is enabled, the data are read in windows of
+        ``bucket_span`` batches. Within a window, the items are sorted by
+        their length, split into batches and the batches are shuffled. This
+        way, sentences of similar length share a batch and less computation
+        is wasted on padding. The effect on padding is collected in the
+        ``padding_statistics`` attribute of the dataset.
+
+        If the token budget is set, the batches are filled with items until
+        the number of token positions in the batch padded to its longest item
+        (summed over the text series in ``length_series``, e.g. source and
+        target) would exceed ``batch_tokens``. The batch size then only
+        limits the number of items in a batch. An item longer than the
+        budget forms a batch on its own. Without bucketing, the batches are
+        built from the whole stream of items, i.e. the items left over at the
+        end of a window of ``batch_size`` items start the next batch.
+
+        Note that the budget bounds the tokens up to the longest item of the
+        batch. The Neural Monkey encoders and decoders pad their inputs to
+        their fixed maximum length, so the size of the tensors fed to the
+        model (and the memory they need) is bounded only by the batch size.
+        The budget makes the batches of short sentences larger while the
+        number of real tokens in a batch stays roughly constant.
+
+        Every batched dataset remembers the positions of its items in this
+        dataset in its ``indices`` attribute, so the original order can be
+        restored. Its ``position`` attribute tells where to continue after
+        the batch (see ``skip``).
+
+        If the dataset is shuffled with a seed, the bucketed batches are also
+        shuffled deterministically.
+
         Arguments:
             batch_size: The size of a batch.
+            bucket_span: Number of batches in a window within which the
+                items are sorted by length. If None (default), no bucketing
+                is done and the batches follow the order of the dataset.
+            batch_tokens: The maximum number of padded tokens in a batch.
+                If None (default), the batches have a fixed size.
+            length_series: The series whose lengths are used for the
+                bucketing, the token budget and the padding statistics, i.e.
+                the text series fed to the model. If None (default), all
+                series are used. Missing series are ignored.
 
         Returns:
             Generator yielding batched datasets.
         """
-        keys = list(self._series.keys())
-        batched_series = [self.batch_serie(key, batch_size) for key in keys]
+        keys = list(self.series_ids)
+        length_columns = [
+            index for index, key in enumerate(keys)
+            if length_series is None or key in length_series]
+        window_size = batch_size * (bucket_span or 1)
+        self.padding_statistics = PaddingStatistics()
+
+        window_start = self._start_position
+        skipped_batches, self._start_batches = self._start_batches, 0
+
+        # without bucketing, the last batch of a window limited by the token
+        # budget is completed with the items of the next window
+        carry_over = bool(batch_tokens) and not bucket_span
+        carried = None  # type: Optional[Tuple[np.ndarray, List[Any]]]
 
         batch_index = 0
-        for next_batches in zip(*batched_series):
-            batch_dict = {key: data for key, data in zip(keys, next_batches)}
-            dataset = Dataset(self.name + "-batch-{}".format(batch_index),
-                              batch_dict, {})
-            batch_index += 1
-            yield dataset
+        windows = self._data_windows(keys, window_size)
+        for positions, window in itertools.chain(windows, [(None, None)]):
+            # at the end of the data, only the carried items are left
+            last = positions is None
+            new_items = 0 if last else len(positions)
+            if carried is not None:
+                positions, window = _join_windows(carried, positions, window)
+            elif last:
+                break
+            # the position of the first window item in the order of the pass
+            first = window_start + new_items - len(positions)
+
+            if self.shuffle_seed is not None:
+                random_state = np.random.RandomState(
+                    [self.shuffle_seed, window_start])
+            else:
+                random_state = np.random
+            batches, lengths = _split_window(
+                [window[i] for i in length_columns], len(positions),
+                batch_size, bucket_span, batch_tokens, random_state)
+
+            carried = None
+            if carry_over and not last and batches:
+                held = batches.pop()
+                carried = (positions[held], [_take(series, held)
+                                             for series in window])
+            if lengths is not None:
+                size = sum(len(batch) for batch in batches)
+                self.padding_statistics.add_window(
+                    lengths[:size], _plain_batches(size, batch_size),
+                    batches)
+
+            for window_batch, batch in enumerate(batches):
+                if window_batch < skipped_batches:
+                    continue
+                batch_dict = {key: _take(series, batch)
+                              for key, series in zip(keys, window)}
+                dataset = Dataset(self.name + "-batch-{}".format(batch_index),
+                                  batch_dict, {})
+                dataset.indices = positions[batch]
+                if carry_over:
+                    # the batches are consecutive, the next one starts after
+                    dataset.position = (first + int(batch[-1]) + 1, 0)
+                else:
+                    dataset.position = (window_start, window_batch + 1)
+                if self._stored:
+                    dataset._batched_from = self
+                batch_index += 1
+                yield dataset
+
+            skipped_batches = 0
+            window_start += new_items
+
+    def _data_windows(self, keys: List[str], window_size: int) -> Iterable[
+            Tuple[np.ndarray, List[Any]]]:
+        """Read the dataset in windows of consecutive items.
+
+        Arguments:
+            keys: The series to read.
+            window_size: The maximum number of items in a window.
+
+        Returns:
+            Generator yielding tuples of the positions of the window items
+            in the dataset and the window data as a list of series.
+        """
+        if self._permutation is not None:
+            order = self._permutation
+        else:
+            order = np.arange(len(self))
+        order = order[self._start_position:]
+        self._start_position = 0
+
+        for start in range(0, len(order), window_size):
+            positions = order[start:start + window_size]
+            yield positions, [_take(self._series[key], positions)
+                              for key in keys]
+
+    def shard(self, index: int, count: int,
+              strided: bool=False) -> "Dataset":
+        """Get a part of the dataset for one of several workers.
+
+        The dataset is split into ``count`` disjoint shards which together
+        cover the whole dataset. The items of all series stay aligned. The
+        shards do not depend on the shuffling, so every worker always gets
+        the same items. The positions of the shard items in this dataset are
+        stored in the ``indices`` attribute of the shard.
+
+        Output files of the shard get the shard index as a suffix, so the
+        workers do not overwrite each other's outputs.
+
+        Arguments:
+            index: The index of the shard, from zero to ``count - 1``.
+            count: The number of shards.
+            strided: If True, the shard consists of every ``count``-th item
+                starting from the ``index``-th one. Otherwise (default), the
+                shard is a contiguous range of items.
+
+        Returns:
+            The shard as a new dataset.
+        """
+        _check_shard(index, count)
+        if strided:
+            positions = np.arange(index, len(self), count)
+        else:
+            start, end = _contiguous_shard(len(self), index, count)
+            positions = np.arange(start, end)
+
+        dataset = Dataset(
+            _shard_name(self.name, index, count),
+            {key: _take(series, positions)
+             for key, series in self._series.items()},
+            _shard_outputs(self.series_outputs, index))
+        dataset.indices = positions
+        return dataset
 
     def add_series(self, name: str, series: List[Any]) -> None:
         if name in self._series:
@@ -160,19 +476,40 @@ class LazyDataset(Dataset):
     that the contents of the file are not fully loaded to the memory.
     Instead, everytime the function ``get_series`` is called, a new file handle
     is created and a generator which yields lines from the file is returned.
+
+    The lazy dataset can be shuffled using a bounded amount of memory. The
+    files can be split into blocks of lines which are read in a random order
+    (this requires uncompressed files read by the plain text reader) and the
+    read items can pass through a shuffle buffer which yields them in a random
+    order.
     """
 
+    _stored = False
+
+    # pylint: disable=too-many-arguments
     def __init__(self, name: str,
                  series_paths_and_readers: Dict[str, Tuple[List[str], Reader]],
                  series_outputs: Dict[str, str],
-                 preprocessors: List[Tuple[str, str, Callable]]=None) -> None:
+                 preprocessors: List[Tuple[str, str, Callable]]=None,
+                 shuffle_buffer_size: Optional[int]=None,
+                 shuffle_block_size: Optional[int]=None,
+                 filters: Optional[List[ItemFilter]]=None) -> None:
         """Create a new instance of the lazy dataset.
 
         Arguments:
-            name: The name of the dataset series_paths_and_readers: The mapping
-            of series name to its file series_outputs: Dictionary mapping
-            series names to their output file preprocess: The preprocessor to
-            apply to the read lines
+            name: The name of the dataset
+            series_paths_and_readers: The mapping of series name to its file
+            series_outputs: Dictionary mapping series names to their output
+                file
+            preprocessors: The preprocessors to apply to the read lines
+            shuffle_buffer_size: Number of items kept in the shuffle buffer.
+                If None, the shuffle buffer is not used.
+            shuffle_block_size: Number of lines in a block of the files which
+                are reordered when shuffling. If None, the blocks are not
+                reordered.
+            filters: Filters removing rows from the read data. The rows are
+                filtered as they are read, so the dataset does not know its
+                length.
         """
         parent_series = dict()  # type: Dict[str, Any]
         parent_series.update({s: None for s in series_paths_and_readers})
@@ -194,17 +531,48 @@ class LazyDataset(Dataset):
                              src_id, func.__name__))
                 self.preprocess_series[tgt_id] = (src_id, func)
 
-    def __len__(self):
-        """Length of the lazy dataset is unknown.
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.shuffle_block_size = shuffle_block_size
+        self.filters = filters or []
+        self._random = None  # type: Optional[np.random.RandomState]
+        # blocks of lines as tuples of the number of lines and a dictionary
+        # mapping the series to the file path and the offset of the block
+        self._blocks = None  # type: Optional[List[Tuple[int, Dict]]]
+        self._indices = None  # type: Optional[Dict[str, List[np.ndarray]]]
+        # the items of the shard as a start, end and step of the positions
+        # in the files, the end is None if the length of the files is unknown
+        self._shard = None  # type: Optional[Tuple[int, Optional[int], int]]
+
+    def __len__(self) -> int:
+        """Get the length of the lazy dataset.
 
-        TODO: reconsider the exception raising, maybe just write a warning
-        log message instead and return None or zero. Make the decision
-        consistent with the implementation of the ``shuffle`` function.
+        The length is known only if the series are uncompressed plain text
+        files, in which case it is read from their line indices, and the
+        dataset is not filtered.
 
         Raises:
-            Exception every time this function is called.
+            Exception if the length of the dataset is unknown.
         """
-        raise Exception("Lazy dataset does not know its size")
+        if self.filters:
+            raise Exception("Filtered lazy dataset does not know its size")
+        return self._num_rows()
+
+    def _num_rows(self) -> int:
+        """Get the number of rows in the shard before filtering."""
+        length = self._num_lines()
+        if self._shard is not None:
+            start, end, step = self._shard
+            return len(range(start, length if end is None else end, step))
+        return length
+
+    def _num_lines(self) -> int:
+        """Get the number of lines of the series files."""
+        indices = self._line_indices()
+        if indices is None:
+            raise Exception("Lazy dataset does not know its size")
+        if not indices:
+            return 0
+        return sum(len(index) - 1 for index in next(iter(indices.values())))
 
     def has_series(self, name: str) -> bool:
         """Check if the dataset contains a series of a given name.
@@ -240,6 +608,14 @@ class LazyDataset(Dataset):
                 name not in self.preprocess_series):
             return None
 
+        if (self.filters or self._shard is not None) and self.has_series(
+                name):
+            return (row[0] for row in self._ordered_rows([name]))
+
+        return self._whole_series(name)
+
+    def _whole_series(self, name: str) -> Iterable:
+        """Read the series of the whole dataset regardless of the shard."""
         if name in self.series_paths_and_readers:
             paths, reader = self.series_paths_and_readers[name]
             return reader(paths)
@@ -251,23 +627,1067 @@ class LazyDataset(Dataset):
         else:
             raise Exception("Series '{}' is not in the dataset.".format(name))
 
-    def shuffle(self):
-        """Does nothing, not in-memory shuffle is impossible.
+    def _ordered_rows(self, keys: List[str]) -> Iterable[Tuple]:
+        """Iterate over the filtered rows of the shard in the file order."""
+        # the filters may need other series than the requested ones
+        read_keys = list(self.series_ids) if self.filters else keys
+        rows = self._rows_from(read_keys, 0)
+        if self.filters:
+            rows = _filter_rows(rows, read_keys, self.filters, self.name)
+            columns = [read_keys.index(key) for key in keys]
+            rows = (tuple(row[i] for i in columns) for row in rows)
+        return rows
+
+    def _count_tokens(self, names: List[str]) -> Dict[
+            str, collections.Counter]:
+        """Count the tokens of all the series while reading the files once."""
+        counts = {name: OrderedCounter()
+                  for name in names}  # type: Dict[str, collections.Counter]
+        keys = [name for name in names if self.has_series(name)]
+        if keys:
+            log("Counting tokens of series {} of dataset '{}'".format(
+                ", ".join(keys), self.name))
+            for row in self._ordered_rows(keys):
+                for key, sentence in zip(keys, row):
+                    counts[key].update(sentence)
+        return counts
+
+    @property
+    def shuffling(self) -> bool:
+        """Tell whether the shuffling of the dataset is enabled."""
+        return bool(self.shuffle_buffer_size or self.shuffle_block_size)
 
-        TODO: this is related to the ``__len__`` method.
+    def shuffle(self, seed: Optional[int]=None) -> None:
+        """Shuffle the dataset for the next pass through the data.
+
+        The data are never loaded into the memory as a whole. If enabled,
+        blocks of lines are read in a random order and the items pass through
+        a shuffle buffer. If none of them is enabled, only the seed is stored.
+
+        Arguments:
+            seed: Seed of the random order. If None (default), the seed is
+                drawn from the global NumPy random generator.
         """
-        pass
+        if not self.shuffling:
+            # the seed still makes the bucketed batches deterministic
+            self.shuffle_seed = seed
+            return
+
+        if seed is None:
+            seed = np.random.randint(2 ** 31 - 1)
+        self._random = np.random.RandomState(seed)
+        self.shuffle_seed = seed
 
     @property
     def series_ids(self) -> Iterable[str]:
         return (list(self.series_paths_and_readers.keys()) +
                 list(self.preprocess_series.keys()))
 
+    def _data_windows(self, keys: List[str], window_size: int) -> Iterable[
+            Tuple[np.ndarray, List[Any]]]:
+        """Read the series files in windows of consecutive lines.
+
+        Only a single window is kept in the memory at a time. If the dataset
+        is shuffled, the window positions refer to the shuffled order.
+        """
+        start = self._start_position
+        return _row_windows(self._rows(keys), start, window_size)
+
+    def _rows(self, keys: List[str]) -> Iterable[Tuple]:
+        """Iterate over the items of the dataset in the current order.
+
+        The order of a shuffled or filtered dataset or of files without line
+        indices cannot be entered in the middle, so the items before the
+        start position are read and thrown away.
+
+        Raises:
+            ValueError if there are fewer items than the start position.
+        """
+        start, self._start_position = self._start_position, 0
+        if (self._random is None and not self.filters and
+                (not start or self._line_indices() is not None)):
+            return self._rows_from(keys, start)
+
+        # the filters may need other series than the requested ones
+        read_keys = list(self.series_ids) if self.filters else keys
+
+        if self._random is None:
+            rows = self._rows_from(read_keys, 0)  # type: Iterable[Tuple]
+        elif self.shuffle_block_size and self._get_blocks() is not None:
+            rows = self._block_shuffled_rows(read_keys)
+        else:
+            rows = self._in_shard(
+                self._file_rows(read_keys, self._read_series), 0)
+
+        if self.filters:
+            rows = _filter_rows(rows, read_keys, self.filters, self.name)
+            columns = [read_keys.index(key) for key in keys]
+            rows = (tuple(row[i] for i in columns) for row in rows)
+
+        if self._random is not None and self.shuffle_buffer_size:
+            rows = _buffer_shuffle(rows, self.shuffle_buffer_size,
+                                   self._random)
+        return _skip_rows(rows, start)
+
+    def _rows_from(self, keys: List[str], start: int) -> Iterable[Tuple]:
+        """Iterate over the items of the dataset from a given position.
+
+        If the line indices of the files are available, the reading starts
+        directly at the position, otherwise the preceding items are read and
+        thrown away.
+        """
+        if self._shard is not None:
+            start = self._shard[0] + start * self._shard[2]
+
+        indices = self._line_indices()
+        if not start:
+            rows = self._file_rows(
+                keys, self._read_series)  # type: Iterable[Tuple]
+        elif indices is None:
+            rows = itertools.islice(
+                self._file_rows(keys, self._read_series), start, None)
+        else:
+            rows = self._file_rows(
+                keys, lambda name: self._read_from(name, indices[name], start))
+
+        return self._in_shard(rows, start)
+
+    def _file_rows(self, keys: List[str],
+                   read: Callable[[str], Iterable[Any]]) -> Iterable[Tuple]:
+        """Read aligned rows of the given series.
+
+        Every file series is read only once, even if more series are derived
+        from it. The preprocessed series are computed from the same items
+        that are returned in the file series.
+
+        Arguments:
+            keys: The series to read.
+            read: Function reading the items of a file series given its name.
+
+        Returns:
+            Generator yielding tuples of items of the series.
+        """
+        sources = []  # type: List[str]
+        columns = []  # type: List[Tuple[int, Optional[Callable]]]
+        for key in keys:
+            if key in self.preprocess_series:
+                src_id, func = self.preprocess_series[key]
+            else:
+                src_id, func = key, None
+            if src_id not in sources:
+                sources.append(src_id)
+            columns.append((sources.index(src_id), func))
+
+        for items in zip(*[read(name) for name in sources]):
+            yield tuple(items[index] if func is None else func(items[index])
+                        for index, func in columns)
+
+    def _read_series(self, name: str) -> Iterable[Any]:
+        """Read all items of a file series."""
+        paths, reader = self.series_paths_and_readers[name]
+        return reader(paths)
+
+    def _read_from(self, name: str, indices: List[np.ndarray],
+                   start: int) -> Iterable[Any]:
+        """Read a file series from the given line till the end."""
+        paths, reader = self.series_paths_and_readers[name]
+        for path, index in zip(paths, indices):
+            num_lines = len(index) - 1
+            if start >= num_lines:
+                start -= num_lines
+                continue
+            for item in reader.read_lines(path, int(index[start]),
+                                          num_lines - start):
+                yield item
+            start = 0
+
+    def _line_indices(self) -> Optional[Dict[str, List[np.ndarray]]]:
+        """Get the line indices of the files of all series.
+
+        Returns:
+            Dictionary mapping the series to the list of line indices of their
+            files or None if any of the series is not an uncompressed plain
+            text.
+        """
+        if self._indices is not None:
+            return self._indices
+
+        indices = {}
+        for name, (paths, reader) in self.series_paths_and_readers.items():
+            if not isinstance(reader, PlainTextReader):
+                return None
+            series_indices = [line_index(path) for path in paths]
+            if any(index is None for index in series_indices):
+                return None
+            indices[name] = series_indices
+
+        self._indices = indices
+        return self._indices
+
+    def skip(self, num_items: int, num_batches: int=0) -> None:
+        """Start the next pass through the data at the given position.
+
+        If the dataset is not shuffled and its files are indexed, the reading
+        starts directly at the position. Otherwise, the skipped items are
+        read, but not batched.
+
+        Arguments:
+            num_items: Number of items to skip.
+            num_batches: Number of batches to skip from the window that
+                starts after the skipped items.
+
+        Raises:
+            ValueError if the dataset is shorter than the skipped items. If
+            the length of the dataset is not known, it is raised when the
+            skipped items are read.
+        """
+        if (self._line_indices() is not None and not self.filters and
+                num_items > len(self)):
+            raise ValueError("Trying to skip more instances than "
+                             "the size of the dataset")
+        self._start_position = num_items
+        self._start_batches = num_batches
+
+    def sample(self, size: int,
+               random_state: np.random.RandomState=None) -> Dataset:
+        """Load a random sample of the items into an in-memory dataset.
+
+        The lines are read directly using the line indices of the files, no
+        file is scanned.
+
+        Arguments:
+            size: The number of items to sample (without repetition).
+            random_state: The random generator to use. If None, the global
+                NumPy generator is used.
+
+        Returns:
+            In-memory dataset with the sampled items in the order in which
+            they appear in the files. The items removed by the filters are
+            left out, so the sample may be smaller.
+        """
+        indices = self._line_indices()
+        if indices is None:
+            raise Exception("Sampling lazy dataset '{}' requires uncompressed "
+                            "plain text files".format(self.name))
+
+        random_state = random_state or np.random
+        positions = np.sort(random_state.choice(
+            self._num_rows(), size=min(size, self._num_rows()),
+            replace=False))
+        if self._shard is not None:
+            positions = self._shard[0] + positions * self._shard[2]
+
+        series = {}  # type: Dict[str, List[Any]]
+        for name, (paths, reader) in self.series_paths_and_readers.items():
+            file_starts = np.cumsum(
+                [0] + [len(index) - 1 for index in indices[name]])
+            items = []
+            for position in positions:
+                file_index = np.searchsorted(file_starts, position,
+                                             side="right") - 1
+                index = indices[name][file_index]
+                line = position - file_starts[file_index]
+                items.extend(reader.read_lines(
+                    paths[file_index], int(index[line]), 1))
+            series[name] = items
+
+        for name, (src_id, func) in self.preprocess_series.items():
+            series[name] = [func(item) for item in series[src_id]]
+
+        dataset = Dataset(self.name + "-sample", series, {})
+        if self.filters:
+            dataset = _filter_dataset(dataset, self.filters)[0]
+        return dataset
+
+    def _block_shuffled_rows(self, keys: List[str]) -> Iterable[Tuple]:
+        """Read the blocks of lines in a random order."""
+        blocks = cast(List[Tuple[int, Dict]], self._blocks)
+        block_begins = np.cumsum([0] + [length for length, _ in blocks])
+        for block_index in self._random.permutation(len(blocks)):
+            num_lines, locations = blocks[block_index]
+            selected = slice(0, num_lines)  # type: Optional[slice]
+            if self._shard is not None:
+                begin = int(block_begins[block_index])
+                selected = self._shard_slice(begin, begin + num_lines)
+                if selected is None:
+                    continue
+
+            read_block = functools.partial(self._read_block, locations,
+                                           num_lines, selected)
+            for row in self._file_rows(keys, read_block):
+                yield row
+
+    def _read_block(self, locations: Dict[str, Tuple[str, int]],
+                    num_lines: int, selected: slice,
+                    name: str) -> List[Any]:
+        """Read the selected lines of a block of a file series."""
+        path, offset = locations[name]
+        reader = self.series_paths_and_readers[name][1]
+        return reader.read_lines(path, offset, num_lines)[selected]
+
+    def _get_blocks(self) -> Optional[List[Tuple[int, Dict]]]:
+        """Split the series files into blocks of lines.
+
+        The blocks are found using the line indices of the files. This is
+        possible only if all series are uncompressed plain text files and the
+        corresponding files of all series have the same number of lines.
+
+        Returns:
+            List of blocks or None if the files cannot be split.
+        """
+        if self._blocks is not None:
+            return self._blocks
+
+        block_size = cast(int, self.shuffle_block_size)
+        indices = self._line_indices()
+        if indices is None:
+            log("Warning: Series of lazy dataset '{}' are not all "
+                "uncompressed plain text, blocks will not be shuffled"
+                .format(self.name), color="red")
+            self.shuffle_block_size = None
+            return None
+
+        file_lengths = {name: [len(index) - 1 for index in series_indices]
+                        for name, series_indices in indices.items()}
+        if len(set(tuple(l) for l in file_lengths.values())) > 1:
+            log("Warning: Files of the series have different numbers of "
+                "lines, blocks of lazy dataset '{}' will not be shuffled"
+                .format(self.name), color="red")
+            self.shuffle_block_size = None
+            return None
+
+        self._blocks = []
+        names = list(indices.keys())
+        for file_index, length in enumerate(file_lengths[names[0]]):
+            for block_start in range(0, length, block_size):
+                locations = {}
+                for name in names:
+                    path = self.series_paths_and_readers[name][0][file_index]
+                    locations[name] = (
+                        path, int(indices[name][file_index][block_start]))
+                self._blocks.append(
+                    (min(block_size, length - block_start), locations))
+
+        log("Lazy dataset '{}' split into {} blocks for shuffling".format(
+            self.name, len(self._blocks)))
+        return self._blocks
+
+    def shard(self, index: int, count: int,
+              strided: bool=False) -> "LazyDataset":
+        """Get a part of the lazy dataset for one of several workers.
+
+        See ``Dataset.shard`` for the description of the shards. The shard
+        only reads its own lines and keeps the shuffling settings of this
+        dataset. Contiguous shards need to know the length of the dataset,
+        so they require uncompressed plain text files.
+
+        Arguments:
+            index: The index of the shard, from zero to ``count - 1``.
+            count: The number of shards.
+            strided: If True, the shard consists of every ``count``-th item
+                starting from the ``index``-th one. Otherwise (default), the
+                shard is a contiguous range of items.
+
+        Returns:
+            The shard as a new lazy dataset.
+        """
+        _check_shard(index, count)
+        if self._shard is not None:
+            raise Exception(
+                "Lazy dataset '{}' is already a shard".format(self.name))
+
+        end = None  # type: Optional[int]
+        if strided:
+            start, step = index, count
+        else:
+            if self._line_indices() is None:
+                raise Exception(
+                    "Contiguous shards of lazy dataset '{}' require "
+                    "uncompressed plain text files".format(self.name))
+            start, end = _contiguous_shard(self._num_lines(), index, count)
+            step = 1
+
+        dataset = copy.copy(self)
+        dataset.name = _shard_name(self.name, index, count)
+        dataset.series_outputs = _shard_outputs(self.series_outputs, index)
+        dataset.padding_statistics = PaddingStatistics()
+        dataset.shuffle_seed = None
+        # pylint: disable=protected-access
+        dataset._random = None
+        dataset._start_position = 0
+        dataset._start_batches = 0
+        dataset._shard = (start, end, step)
+        dataset._token_counts = {}
+        # pylint: enable=protected-access
+        return dataset
+
+    def _shard_slice(self, begin: int, end: Optional[int]) -> Optional[slice]:
+        """Find the shard items among the items at given file positions.
+
+        Arguments:
+            begin: The file position of the first item.
+            end: The file position after the last item, None if unknown.
+
+        Returns:
+            Slice of the shard items relative to the first item, None if none
+            of the items belongs to the shard.
+        """
+        start, stop, step = cast(Tuple[int, Optional[int], int], self._shard)
+        if stop is not None:
+            end = stop if end is None else min(end, stop)
+
+        if begin <= start:
+            first = start
+        else:
+            first = start + (begin - start + step - 1) // step * step
+
+        if end is not None and first >= end:
+            return None
+        return slice(first - begin, None if end is None else end - begin, step)
+
+    def _in_shard(self, rows: Iterable[Tuple], begin: int) -> Iterable[Tuple]:
+        """Select the shard items from rows starting at a file position."""
+        if self._shard is None:
+            return rows
+
+        selected = self._shard_slice(begin, None)
+        if selected is None:
+            return iter([])
+        return itertools.islice(rows, selected.start, selected.stop,
+                                selected.step)
+
     def add_series(self, name: str, series: Iterable[Any]) -> None:
         raise NotImplementedError(
             "Lazy dataset does not support adding series.")
 
 
+# number of items read from a source of the mixed dataset at once
+MIXING_WINDOW_SIZE = 1000
+
+
+class MixedDataset(Dataset):
+    """Dataset streaming a weighted mixture of several datasets.
+
+    For every item, a source dataset is drawn at random according to the
+    weights and its next item is taken. When a source runs out of items, it
+    starts a new epoch. Only a window of items of every source is kept in the
+    memory, so the sources can be lazy datasets of any size.
+
+    A pass through the mixture ends after ``size`` items or, if the size is
+    not set, when the first source finishes its epoch. Every pass starts all
+    the sources from their beginning and the whole pass is given by the seed
+    of the shuffling, so it can be resumed by ``skip``. When the mixture is
+    shuffled, every epoch of a source is shuffled with a seed derived from
+    it. The numbers of items and finished epochs of the sources are kept in
+    the ``source_items`` and ``source_epochs`` attributes and logged at the
+    end of every pass.
+    """
+
+    _stored = False
+
+    def __init__(self, name: str, datasets: List[Dataset],
+                 weights: Optional[List[float]]=None,
+                 size: Optional[int]=None) -> None:
+        """Create the mixture of datasets.
+
+        Arguments:
+            name: The name of the dataset.
+            datasets: The source datasets. All of them must contain the
+                series of the first one.
+            weights: Relative probabilities of drawing an item from the
+                sources. If None (default), all sources have the same weight.
+            size: The number of items in a pass through the mixture. If None
+                (default), the pass ends when the first source is exhausted.
+
+        Raises:
+            ValueError if the sources or their weights are invalid.
+        """
+        assert check_argument_types()
+        super().__init__(name, {}, {})
+
+        if not datasets:
+            raise ValueError("Mixed dataset needs at least one source")
+        if weights is None:
+            weights = [1.] * len(datasets)
+        if len(weights) != len(datasets) or min(weights) < 0 or not any(
+                weights):
+            raise ValueError("Mixed dataset needs a non-negative weight for "
+                             "every source: {}".format(weights))
+        if size is None and not weights[0]:
+            raise ValueError("The first source of a mixed dataset without "
+                             "size must have a non-zero weight")
+
+        self._keys = list(datasets[0].series_ids)
+        for dataset in datasets[1:]:
+            missing = [key for key in self._keys
+                       if not dataset.has_series(key)]
+            if missing:
+                raise ValueError("Dataset '{}' does not contain series {}"
+                                 .format(dataset.name, ", ".join(missing)))
+
+        self.datasets = datasets
+        self.weights = np.array(weights, dtype=np.float64) / sum(weights)
+        self.size = size
+        self.source_items = [0] * len(datasets)
+        self.source_epochs = [0] * len(datasets)
+
+    def __len__(self) -> int:
+        """Get the number of items in a pass through the mixture.
+
+        Raises:
+            Exception if the size of the mixture is not set.
+        """
+        if self.size is None:
+            raise Exception("Mixed dataset without size does not know its "
+                            "length")
+        return self.size
+
+    def has_series(self, name: str) -> bool:
+        return name in self._keys
+
+    def get_series(self, name: str, allow_none: bool=False) -> Iterable:
+        """Get the data series with a given name.
+
+        The series is read in the mixed order of the current pass.
+
+        Arguments:
+            name: The name of the series to fetch.
+            allow_none: If True, return None if the series does not exist.
+
+        Returns:
+            Generator of the series items.
+
+        Raises:
+            Exception if the series does not exist and allow_none is False.
+        """
+        if not self.has_series(name):
+            if allow_none:
+                return None
+            raise Exception("Series '{}' is not in the dataset.".format(name))
+        return (row[0] for row in self._mixed_rows([name]))
+
+    @property
+    def series_ids(self) -> Iterable[str]:
+        return list(self._keys)
+
+    def shuffle(self, seed: Optional[int]=None) -> None:
+        """Set the seed of the mixing and of the shuffling of the sources.
+
+        Arguments:
+            seed: The seed. If None (default), it is drawn from the global
+                NumPy random generator.
+        """
+        if seed is None:
+            seed = np.random.randint(2 ** 31 - 1)
+        self.shuffle_seed = seed
+
+    def skip(self, num_items: int, num_batches: int=0) -> None:
+        """Start the next pass through the mixture at the given position.
+
+        The skipped items are drawn from the sources, but not batched.
+
+        Arguments:
+            num_items: Number of items to skip.
+            num_batches: Number of batches to skip from the window that
+                starts after the skipped items.
+
+        Raises:
+            ValueError if the mixture is shorter than the skipped items.
+        """
+        if self.size is not None and num_items > self.size:
+            raise ValueError("Trying to skip more instances than "
+                             "the size of the dataset")
+        self._start_position = num_items
+        self._start_batches = num_batches
+
+    def _data_windows(self, keys: List[str], window_size: int) -> Iterable[
+            Tuple[np.ndarray, List[Any]]]:
+        start, self._start_position = self._start_position, 0
+        rows = itertools.islice(self._mixed_rows(keys), start, None)
+        return _row_windows(rows, start, window_size)
+
+    def _mixed_rows(self, keys: List[str]) -> Iterable[Tuple]:
+        """Draw the items of a pass through the mixture."""
+        random_state = np.random.RandomState(
+            0 if self.shuffle_seed is None else self.shuffle_seed)
+        self.source_items = [0] * len(self.datasets)
+        self.source_epochs = [0] * len(self.datasets)
+        sources = [self._source_rows(index, keys)
+                   for index in range(len(self.datasets))]
+
+        random_sources = np.zeros(0, dtype=np.int64)
+        drawn = 0
+        while self.size is None or drawn < self.size:
+            if random_sources.size == 0:
+                random_sources = random_state.choice(
+                    len(self.datasets), size=1024, p=self.weights)
+            index = random_sources[-1]
+            random_sources = random_sources[:-1]
+
+            row = next(sources[index], None)
+            if row is None:
+                self.source_epochs[index] += 1
+                if index == 0 and self.size is None:
+                    break
+                sources[index] = self._source_rows(index, keys)
+                row = next(sources[index], None)
+                if row is None:
+                    raise ValueError("Source dataset '{}' is empty".format(
+                        self.datasets[index].name))
+
+            self.source_items[index] += 1
+            drawn += 1
+            yield row
+
+        log("Mixed dataset '{}': {}".format(self.name, ", ".join(
+            "{} items and {} finished epochs of '{}'".format(
+                items, epochs, dataset.name)
+            for dataset, items, epochs in zip(
+                self.datasets, self.source_items, self.source_epochs))))
+
+    def _source_rows(self, index: int, keys: List[str]) -> Iterable[Tuple]:
+        """Read an epoch of a source dataset."""
+        # pylint: disable=protected-access
+        dataset = self.datasets[index]
+        if self.shuffle_seed is not None:
+            dataset.shuffle(np.random.RandomState(
+                [self.shuffle_seed, index,
+                 self.source_epochs[index]]).randint(2 ** 31 - 1))
+        for _, window in dataset._data_windows(keys, MIXING_WINDOW_SIZE):
+            for row in zip(*window):
+                yield row
+
+    def shard(self, index: int, count: int,
+              strided: bool=False) -> "Dataset":
+        """Get a part of the mixture for one of several workers.
+
+        The mixture of the shards of the sources is returned, each with the
+        corresponding part of the size of this mixture.
+
+        Arguments:
+            index: The index of the shard, from zero to ``count - 1``.
+            count: The number of shards.
+            strided: Whether the sources are sharded by strides (see
+                ``Dataset.shard``).
+
+        Returns:
+            The shard as a new mixed dataset.
+        """
+        _check_shard(index, count)
+        size = self.size
+        if size is not None:
+            start, end = _contiguous_shard(size, index, count)
+            size = end - start
+        return MixedDataset(
+            _shard_name(self.name, index, count),
+            [dataset.shard(index, count, strided)
+             for dataset in self.datasets],
+            self.weights.tolist(), size)
+
+    def add_series(self, name: str, series: Iterable[Any]) -> None:
+        raise NotImplementedError(
+            "Mixed dataset does not support adding series.")
+
+
+class PaddingStatistics(object):
+    """Counts of tokens and padding of the batches created from a dataset.
+
+    The statistics compare the padding of the batches that were actually
+    created with the padding the plain batching in the dataset order would
+    need. Padding is counted over the text series whose lengths are used for
+    the batching (see ``Dataset.batch_dataset``).
+
+    The batches are counted as padded to their longest item. This is the
+    padding that the computation on the real tokens of a batch needs, not
+    the size of the tensors fed to the model: the encoders and decoders pad
+    their inputs to their fixed maximum length regardless of the batching.
+
+    Attributes:
+        tokens: Number of real tokens in the batched items.
+        plain_padded: Number of token positions of plain batches padded to
+            their longest item.
+        padded: Number of token positions of the created batches padded to
+            their longest item.
+    """
+
+    def __init__(self) -> None:
+        self.tokens = 0
+        self.plain_padded = 0
+        self.padded = 0
+
+    def add_window(self, lengths: np.ndarray,
+                   plain_batches: List[np.ndarray],
+                   batches: List[np.ndarray]) -> None:
+        """Account a window of items split into batches.
+
+        Arguments:
+            lengths: Item lengths, a matrix of shape (items, series).
+            plain_batches: Indices of the window items in plain batches.
+            batches: Indices of the window items in the created batches.
+        """
+        self.tokens += int(lengths.sum())
+        self.plain_padded += sum(_padded_size(lengths[b])
+                                 for b in plain_batches)
+        self.padded += sum(_padded_size(lengths[b]) for b in batches)
+
+    @property
+    def plain_ratio(self) -> float:
+        """Ratio of padding to the longest item with plain batching."""
+        return 1. - self.tokens / max(self.plain_padded, 1)
+
+    @property
+    def ratio(self) -> float:
+        """Ratio of padding to the longest item in the created batches."""
+        return 1. - self.tokens / max(self.padded, 1)
+
+    def __str__(self) -> str:
+        return ("ratio of padding to the longest sentence of a batch {:.3f} "
+                "with plain batching, {:.3f} in the actual batches ({} "
+                "tokens; the model inputs are padded to the maximum length "
+                "of the encoders and decoders)".format(
+                    self.plain_ratio, self.ratio, self.tokens))
+
+
+def _check_shard(index: int, count: int) -> None:
+    if count < 1 or not 0 <= index < count:
+        raise ValueError("Invalid shard {} of {} shards".format(index, count))
+
+
+def _contiguous_shard(length: int, index: int, count: int) -> Tuple[int, int]:
+    """Get the range of items of a contiguous shard.
+
+    The shard sizes differ by one item at most.
+    """
+    return length * index // count, length * (index + 1) // count
+
+
+def _shard_name(name: str, index: int, count: int) -> str:
+    return "{}-shard-{}-of-{}".format(name, index, count)
+
+
+def _shard_outputs(series_outputs: Dict[str, str],
+                   index: int) -> Dict[str, str]:
+    return {key: "{}.{}".format(path, index)
+            for key, path in series_outputs.items()}
+
+
+def _item_length(item: Any) -> int:
+    """Get the number of tokens of a data item.
+
+    Items that are not sequences of tokens (e.g. numpy arrays) do not need
+    any padding and count as empty.
+    """
+    if isinstance(item, (list, tuple)):
+        return len(item)
+    return 0
+
+
+def _padded_size(lengths: np.ndarray) -> int:
+    """Get the number of token positions in a padded batch.
+
+    Arguments:
+        lengths: Item lengths, a matrix of shape (items, series).
+    """
+    if lengths.size == 0:
+        return 0
+    return lengths.shape[0] * int(lengths.max(axis=0).sum())
+
+
+def _buffer_shuffle(rows: Iterable[Tuple], buffer_size: int,
+                    random_state: np.random.RandomState) -> Iterable[Tuple]:
+    """Shuffle a stream of items using a bounded buffer.
+
+    The buffer is filled with the first items. Then, a random item from the
+    buffer is yielded for every new item, which takes its place.
+
+    Arguments:
+        rows: The stream of items.
+        buffer_size: The maximum number of items kept in the buffer.
+        random_state: The random generator to use.
+    """
+    buf = []  # type: List[Tuple]
+    random_indices = np.zeros(0, dtype=np.int64)
+    for row in rows:
+        if len(buf) < buffer_size:
+            buf.append(row)
+            continue
+
+        if random_indices.size == 0:
+            random_indices = random_state.randint(buffer_size, size=1024)
+        index = random_indices[-1]
+        random_indices = random_indices[:-1]
+
+        yield buf[index]
+        buf[index] = row
+
+    for index in random_state.permutation(len(buf)):
+        yield buf[index]
+
+
+def _filter_rows(rows: Iterable[Tuple], keys: List[str],
+                 filters: List[ItemFilter], name: str,
+                 kept: List[int]=None) -> Iterable[Tuple]:
+    """Remove the rows rejected by any of the filters from a stream.
+
+    When the stream ends, the numbers of removed rows are logged by the
+    reasons given by the filters.
+
+    Arguments:
+        rows: The stream of rows, tuples of items of the series.
+        keys: Names of the series in the rows.
+        filters: The filters to apply.
+        name: Name of the dataset used in the log.
+        kept: If given, the positions of the kept rows are appended to it.
+    """
+    removed = collections.Counter()  # type: collections.Counter
+    total = 0
+    for position, row in enumerate(rows):
+        total += 1
+        items = dict(zip(keys, row))
+        reason = None
+        for item_filter in filters:
+            reason = item_filter(items)
+            if reason is not None:
+                break
+        if reason is not None:
+            removed[reason] += 1
+            continue
+        if kept is not None:
+            kept.append(position)
+        yield row
+
+    log("Dataset '{}': kept {} of {} items{}".format(
+        name, total - sum(removed.values()), total,
+        "".join(", {}: {}".format(reason, count)
+                for reason, count in removed.most_common())))
+
+
+def _filter_dataset(dataset: Dataset,
+                    filters: List[ItemFilter]) -> Tuple[Dataset, List[int]]:
+    """Remove the items rejected by any of the filters from a dataset.
+
+    Returns:
+        The filtered dataset and the positions of the kept items in the
+        original one.
+    """
+    # pylint: disable=protected-access
+    keys = list(dataset.series_ids)
+    kept = []  # type: List[int]
+    for _ in _filter_rows(zip(*[dataset.get_series(key) for key in keys]),
+                          keys, filters, dataset.name, kept):
+        pass
+    indices = np.array(kept, dtype=np.int64)
+    filtered = Dataset(
+        dataset.name,
+        {key: _take(dataset._series[key], indices) for key in keys},
+        dataset.series_outputs)
+    filtered.indices = indices
+    return filtered, kept
+
+
+def _row_windows(rows: Iterable[Tuple], start: int,
+                 window_size: int) -> Iterable[Tuple[np.ndarray, List[Any]]]:
+    """Collect a stream of rows into windows of series.
+
+    Arguments:
+        rows: The stream of rows, tuples of items of the series.
+        start: The position of the first row.
+        window_size: The maximum number of rows in a window.
+
+    Returns:
+        Generator yielding the positions of the window rows and the window
+        data as a list of series.
+    """
+    rows = iter(rows)
+    while True:
+        window_rows = list(itertools.islice(rows, window_size))
+        if not window_rows:
+            break
+        positions = np.arange(start, start + len(window_rows))
+        start += len(window_rows)
+        yield positions, [list(column) for column in zip(*window_rows)]
+
+
+def _skip_rows(rows: Iterable[Tuple], count: int) -> Iterable[Tuple]:
+    """Skip the first rows of a stream which must contain at least as many."""
+    rows = iter(rows)
+    for _ in range(count):
+        if next(rows, None) is None:
+            raise ValueError("Trying to skip more instances than "
+                             "the size of the dataset")
+    for row in rows:
+        yield row
+
+
+def _take(series: Any, indices: np.ndarray) -> Any:
+    """Select items from a data series."""
+    if isinstance(series, (np.ndarray, ConcatenatedArray)):
+        return series[indices]
+    if isinstance(series, TokenSeries):
+        return series.take(indices)
+    return [series[i] for i in indices]
+
+
+def _series_lengths(series: Any) -> List[int]:
+    """Get the numbers of tokens of the items of a data series."""
+    if isinstance(series, TokenSeries):
+        return series.lengths()
+    if isinstance(series, (np.ndarray, ConcatenatedArray)):
+        # array items do not need any padding
+        return np.zeros(len(series), dtype=np.int64)
+    return [_item_length(item) for item in series]
+
+
+def _stored_series(items: Iterable[Any], columnar: bool) -> Any:
+    """Store a data series read by a reader in the memory.
+
+    Arrays (e.g. the memory-mapped arrays of the numpy reader) are kept as
+    they are, so that batches are gathered from them as arrays. Other series
+    are stored as lists, or in the columnar form if requested.
+    """
+    if isinstance(items, (np.ndarray, ConcatenatedArray)):
+        return items
+    if columnar:
+        return _columnar(items)
+    return list(items)
+
+
+def _columnar(items: Iterable[Any]) -> Any:
+    """Store a data series as a token series if it consists of sentences.
+
+    Other series (e.g. numpy arrays) are stored as lists.
+    """
+    items = iter(items)
+    first = next(items, None)
+    if first is None:
+        return []
+
+    series = itertools.chain([first], items)
+    if isinstance(first, (list, tuple)):
+        return TokenSeries.from_sentences(series)
+    return list(series)
+
+
+# pylint: disable=too-many-arguments
+def _split_window(window: List[Any], size: int, batch_size: int,
+                  bucket_span: Optional[int],
+                  batch_tokens: Optional[int],
+                  random_state: Any=np.random) -> Tuple[
+                      List[np.ndarray], Optional[np.ndarray]]:
+    """Split a window of data into batches.
+
+    Arguments:
+        window: The series of the window whose lengths are used.
+        size: The number of items in the window.
+        batch_size: The (maximum) size of a batch.
+        bucket_span: If not None, the items are sorted by their length before
+            splitting and the batches are shuffled.
+        batch_tokens: If not None, the maximum number of padded tokens
+            in a batch.
+        random_state: The random generator shuffling the bucketed batches.
+
+    Returns:
+        List of arrays of indices of the window items, one per batch, and
+        the item lengths (a matrix of shape (items, series)) if the batching
+        depends on them, otherwise None.
+    """
+    if not bucket_span and not batch_tokens:
+        return _plain_batches(size, batch_size), None
+
+    lengths = np.array([_series_lengths(series) for series in window],
+                       dtype=np.int64).T.reshape(size, len(window))
+
+    if bucket_span:
+        order = np.argsort(lengths.sum(axis=1), kind="mergesort")
+    else:
+        order = np.arange(size)
+
+    if batch_tokens:
+        batches = _token_batches(order, lengths, batch_size, batch_tokens)
+    else:
+        batches = [order[start:start + batch_size]
+                   for start in range(0, size, batch_size)]
+
+    if bucket_span:
+        batches = [batches[i]
+                   for i in random_state.permutation(len(batches))]
+
+    return batches, lengths
+
+
+def _plain_batches(size: int, batch_size: int) -> List[np.ndarray]:
+    """Split items into batches of a fixed size in their order."""
+    return [np.arange(start, min(start + batch_size, size))
+            for start in range(0, size, batch_size)]
+
+
+def _join_windows(carried: Tuple[np.ndarray, List[Any]],
+                  positions: Optional[np.ndarray],
+                  window: Optional[List[Any]]) -> Tuple[
+                      np.ndarray, List[Any]]:
+    """Prepend the items carried over from the previous window to a window.
+
+    Arguments:
+        carried: The positions and the series of the carried items.
+        positions: The positions of the window items, None at the end of the
+            data.
+        window: The window data as a list of series, None at the end of the
+            data.
+    """
+    if positions is None or window is None:
+        return carried
+    return (np.concatenate([carried[0], positions]),
+            [_concatenate_series(old, new)
+             for old, new in zip(carried[1], window)])
+
+
+def _concatenate_series(first: Any, second: Any) -> Any:
+    """Join two parts of a data series."""
+    if isinstance(first, np.ndarray) and isinstance(second, np.ndarray):
+        return np.concatenate([first, second])
+    if isinstance(first, TokenSeries) and isinstance(second, TokenSeries):
+        # the parts of a series share the table of tokens
+        return TokenSeries(first.tokens,
+                           np.concatenate([first.ids, second.ids]),
+                           np.concatenate([first.offsets[:-1],
+                                           second.offsets +
+                                           first.offsets[-1]]))
+    return list(first) + list(second)
+
+
+def _token_batches(order: np.ndarray, lengths: np.ndarray, batch_size: int,
+                   batch_tokens: int) -> List[np.ndarray]:
+    """Greedily split items into batches limited by the number of tokens.
+
+    Arguments:
+        order: Indices of the items in the order they should be batched.
+        lengths: Item lengths, a matrix of shape (items, series).
+        batch_size: The maximum number of items in a batch.
+        batch_tokens: The maximum number of padded tokens in a batch.
+
+    Returns:
+        List of arrays of item indices, one per batch.
+    """
+    batches = []
+    start = 0
+    max_lengths = np.zeros(lengths.shape[1], dtype=np.int64)
+    for position, index in enumerate(order):
+        new_max_lengths = np.maximum(max_lengths, lengths[index])
+        items = position - start + 1
+        if position > start and (
+                items > batch_size or
+                items * new_max_lengths.sum() > batch_tokens):
+            batches.append(order[start:position])
+            start = position
+            new_max_lengths = lengths[index]
+        max_lengths = new_max_lengths
+
+    if start < len(order):
+        batches.append(order[start:])
+
+    return batches
+
+
 # pylint: disable=invalid-name
 DatasetPreprocess = Callable[[Dataset], Iterable[Any]]
 DatasetPostprocess = Callable[[Dataset, Dict[str, Iterable[Any]]],
@@ -282,9 +1702,17 @@ SERIES_OUTPUT = re.compile("s_(.*)_out")
 PREPROCESSED_SERIES = re.compile("pre_([^_]*)$")
 
 
+# pylint: disable=too-many-arguments
 def load_dataset_from_files(
         name: str=None, lazy: bool=False,
         preprocessors: List[Tuple[str, str, Callable]]=None,
+        shuffle_buffer_size: int=None,
+        shuffle_block_size: int=None,
+        cache_dir: str=None,
+        columnar: bool=False,
+        preprocessing_workers: int=1,
+        filters: List[ItemFilter]=None,
+        count_series: List[str]=None,
         **kwargs) -> Dataset:
 
     """Load a dataset from the files specified by the provided arguments.
@@ -294,9 +1722,47 @@ def load_dataset_from_files(
         name: The name of the dataset to use. If None (default), the name will
               be inferred from the file names.
         lazy: Boolean flag specifying whether to use lazy loading (useful for
-              large files). Note that the lazy dataset cannot be shuffled.
+              large files). Note that the lazy dataset is shuffled only if
+              the shuffle buffer or the block shuffling is enabled.
               Defaults to False.
         preprocessor: A callable used for preprocessing of the input sentences.
+        shuffle_buffer_size: Size of the shuffle buffer of the lazy dataset.
+              Defaults to None, i.e. no buffer.
+        shuffle_block_size: Number of lines in the blocks which the lazy
+              dataset reads in a random order when it is shuffled. Defaults
+              to None, i.e. the files are always read from the beginning.
+        cache_dir: Directory of the persistent dataset cache. If set, the
+              loaded and preprocessed series are stored in the cache and
+              memory-mapped from it when the same files are loaded with the
+              same readers and preprocessors again. A cached dataset is never
+              lazy. Defaults to None, i.e. no caching.
+        columnar: Boolean flag specifying whether the text series of an
+              in-memory dataset are stored in the compact columnar form (see
+              ``TokenSeries``), which takes much less memory than lists of
+              strings. The series are converted while they are read.
+              Defaults to False.
+        preprocessing_workers: Number of processes applying the
+              preprocessors of an in-memory dataset. The series are split
+              into chunks which are preprocessed in parallel, the order of
+              the items is preserved. A dataset-level preprocessor then gets
+              the chunks as separate datasets, so it must process the items
+              independently. Preprocessors that cannot be pickled are always
+              applied in the main process. Defaults to 1.
+        filters: Callables removing unsuitable items from the dataset (see
+              ``neuralmonkey.processors.filters``). A filter gets a row of
+              the preprocessed dataset as a dictionary and returns the reason
+              for its removal, or None if the row is kept. The numbers of
+              the removed items are logged. A lazy dataset is filtered while
+              it is read, so it does not know its length and ``len`` raises
+              an exception for it. The positions of the kept items are stored
+              in the dataset cache. Defaults to None, i.e. no filtering.
+        count_series: Text series whose tokens are counted for building
+              vocabularies (see ``Dataset.token_counts``). All of them are
+              counted in a single pass through the data, which is the pass
+              storing the dataset in the cache if it is enabled, and the
+              counts are stored in the cache too. The configuration builder
+              sets the series used by the ``vocabulary.from_dataset``
+              sections automatically. Defaults to None.
         kwargs: Dataset keyword argument specs. These parameters should begin
                 with 's_' prefix and may end with '_out' suffix.  For example,
                 a data series 'source' which specify the source sentences
@@ -330,12 +1796,34 @@ def load_dataset_from_files(
     if name is None:
         name = _get_name_from_paths(series_paths_and_readers)
 
+    if cache_dir is not None:
+        dataset_preprocessors = {
+            key: value for key, value in kwargs.items()
+            if PREPROCESSED_SERIES.match(key)}
+        cache_key = dataset_cache_key(
+            cache_dir, series_paths_and_readers, preprocessors,
+            dataset_preprocessors, filters)
+        cached_series = load_cached_series(cache_dir, cache_key)
+        if cached_series is not None:
+            dataset = Dataset(name, cached_series, series_outputs)
+            dataset.indices = load_filtered_index(cache_dir, cache_key)
+            dataset.counted_series = list(count_series or [])
+            # pylint: disable=protected-access
+            dataset._token_counts = load_token_counts(cache_dir, cache_key)
+            log("Dataset loaded from the cache, length: {}".format(
+                len(dataset)))
+            return dataset
+
     if lazy:
         dataset = LazyDataset(name, series_paths_and_readers, series_outputs,
-                              preprocessors)
+                              preprocessors, shuffle_buffer_size,
+                              shuffle_block_size, filters)
         # type: Dataset
     else:
-        series = {key: list(reader(paths))
+        store = functools.partial(
+            _stored_series,
+            columnar=columnar)  # type: Callable[[Iterable[Any]], Any]
+        series = {key: store(reader(paths))
                   for key, (paths, reader) in series_paths_and_readers.items()}
 
         if preprocessors is not None:
@@ -348,18 +1836,58 @@ def load_dataset_from_files(
                         ("The source series ({}) of the '{}' preprocessor "
                          "is not defined in the dataset.").format(
                              src_id, function.__name__))
-                series[tgt_id] = list(map(function, series[src_id]))
+                series[tgt_id] = store(_preprocess_series(
+                    function, series[src_id], preprocessing_workers))
 
         # pylint: disable=redefined-variable-type
         dataset = Dataset(name, series, series_outputs)
         # pylint: enable=redefined-variable-type
         log("Dataset length: {}".format(len(dataset)))
 
-    _preprocessed_datasets(dataset, kwargs)
+    _preprocessed_datasets(dataset, kwargs, columnar, preprocessing_workers)
 
+    kept = None  # type: Optional[List[int]]
+    if filters and not lazy:
+        dataset, kept = _filter_dataset(dataset, filters)
+
+    if cache_dir is not None:
+        keys = list(dataset.series_ids)
+        if isinstance(dataset, LazyDataset) and filters:
+            kept = []
+            # pylint: disable=protected-access
+            rows = _filter_rows(
+                dataset._file_rows(keys, dataset._read_series),
+                keys, filters, name, kept)  # type: Iterable[Tuple]
+        else:
+            rows = zip(*[dataset.get_series(key) for key in keys])
+        # the tokens are counted while the rows are stored
+        token_counts = {name: OrderedCounter()
+                        for name in count_series or []}
+        rows = _counted_rows(rows, keys, token_counts)
+        if cache_series(cache_dir, cache_key, keys, rows, kept,
+                        token_counts):
+            dataset = Dataset(name, load_cached_series(cache_dir, cache_key),
+                              series_outputs)
+            dataset.indices = load_filtered_index(cache_dir, cache_key)
+            # pylint: disable=protected-access
+            dataset._token_counts = token_counts
+
+    dataset.counted_series = list(count_series or [])
     return dataset
 
 
+def _counted_rows(rows: Iterable[Tuple], keys: List[str],
+                  token_counts: Dict[str, collections.Counter]) -> Iterable[
+                      Tuple]:
+    """Count the tokens of the counted series of rows passing through."""
+    columns = [(keys.index(name), counts)
+               for name, counts in token_counts.items() if name in keys]
+    for row in rows:
+        for column, counts in columns:
+            counts.update(row[column])
+        yield row
+
+
 def _get_name_from_paths(series_paths: Dict[str, Tuple[List[str],
                                                        Reader]]) -> str:
     """Construct name for a dataset using the paths to its files.
@@ -443,7 +1971,9 @@ def _get_series_outputs(series_config: SeriesConfig) -> Dict[str, str]:
 
 def _preprocessed_datasets(
         dataset: Dataset,
-        series_config: SeriesConfig) -> None:
+        series_config: SeriesConfig,
+        columnar: bool=False,
+        workers: int=1) -> None:
     """Apply dataset-level preprocessing."""
     keys = [key for key in series_config.keys()
             if PREPROCESSED_SERIES.match(key)]
@@ -453,7 +1983,89 @@ def _preprocessed_datasets(
         preprocessor = cast(DatasetPreprocess, series_config[key])
 
         if isinstance(dataset, Dataset):
-            new_series = list(preprocessor(dataset))
+            preprocessed = _preprocess_dataset(preprocessor, dataset, workers)
+            new_series = (_columnar(preprocessed) if columnar
+                          else list(preprocessed))
             dataset.add_series(name, new_series)
         elif isinstance(dataset, LazyDataset):
             dataset.preprocess_series[name] = (None, preprocessor)
+
+
+# number of items sent to a preprocessing worker at once
+PREPROCESSING_CHUNK_SIZE = 1000
+
+# the preprocessor applied in a worker process
+_WORKER_FUNCTION = None  # type: Optional[Callable]
+
+
+def _preprocess_series(function: Callable, series: Any,
+                       workers: int) -> Iterable[Any]:
+    """Apply a series-level preprocessor, possibly in parallel."""
+    if workers <= 1 or not _is_picklable(function):
+        return map(function, series)
+
+    chunks = (series[start:start + PREPROCESSING_CHUNK_SIZE]
+              for start in range(0, len(series), PREPROCESSING_CHUNK_SIZE))
+    return _parallel_map(_apply_to_items, function, chunks, workers)
+
+
+def _preprocess_dataset(preprocessor: DatasetPreprocess, dataset: Dataset,
+                        workers: int) -> Iterable[Any]:
+    """Apply a dataset-level preprocessor, possibly in parallel."""
+    if workers <= 1 or not _is_picklable(preprocessor):
+        return preprocessor(dataset)
+
+    keys = list(dataset.series_ids)
+    chunks = (
+        Dataset(dataset.name, {
+            key: _take(dataset.get_series(key), np.arange(
+                start, min(start + PREPROCESSING_CHUNK_SIZE, len(dataset))))
+            for key in keys}, {})
+        for start in range(0, len(dataset), PREPROCESSING_CHUNK_SIZE))
+    return _parallel_map(_apply_to_dataset, preprocessor, chunks, workers)
+
+
+def _parallel_map(worker: Callable[[Any], List[Any]], function: Callable,
+                  chunks: Iterable[Any], workers: int) -> Iterable[Any]:
+    """Process chunks of data in a pool of processes.
+
+    Arguments:
+        worker: Module-level function processing a chunk in a worker.
+        function: The preprocessor passed to the workers.
+        chunks: The chunks of data.
+        workers: The number of processes.
+
+    Returns:
+        Generator yielding the processed items in the original order.
+    """
+    with multiprocessing.Pool(workers, initializer=_init_worker,
+                              initargs=(function,)) as pool:
+        for result in pool.imap(worker, chunks):
+            for item in result:
+                yield item
+
+
+def _is_picklable(function: Callable) -> bool:
+    try:
+        pickle.dumps(function)
+        return True
+    except (pickle.PicklingError, AttributeError, TypeError):
+        log("Preprocessor {} cannot be sent to other processes, "
+            "running it serially.".format(function), color="red")
+        return False
+
+
+def _init_worker(function: Callable) -> None:
+    # pylint: disable=global-statement
+    global _WORKER_FUNCTION
+    _WORKER_FUNCTION = function
+
+
+def _apply_to_items(items: List[Any]) -> List[Any]:
+    assert _WORKER_FUNCTION is not None
+    return [_WORKER_FUNCTION(item) for item in items]
+
+
+def _apply_to_dataset(dataset: Dataset) -> List[Any]:
+    assert _WORKER_FUNCTION is not None
+    return list(_WORKER_FUNCTION(dataset))
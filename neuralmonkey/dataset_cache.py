@@ -0,0 +1,402 @@
+"""Persistent cache of loaded and preprocessed datasets.
+
+Loading a dataset means reading the input files and applying all the
+preprocessors, which can take a long time for large corpora. The cache stores
+the final series of a dataset in binary files which are memory-mapped when the
+same dataset is loaded again.
+
+The cache is content-addressed. A dataset is identified by the hashes of its
+input files, its readers and the fingerprints of its preprocessors. The
+fingerprint of a preprocessor consists of its name, code and attributes. If a
+preprocessor depends on something else (e.g. a file it reads lazily), the
+cache has to be deleted manually when that changes.
+
+Text series are stored as token series (see ``neuralmonkey.token_series``),
+series of numpy arrays of the same shape are stored as a single array. If the
+dataset was filtered, the positions of the kept items in the input files are
+stored as well. So are the counts of the tokens of the text series that are
+counted for building vocabularies.
+"""
+
+# tests: lint, mypy
+
+import collections
+import hashlib
+import json
+import os
+import shutil
+import types
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from neuralmonkey.logging import log
+from neuralmonkey.readers.utils import Reader
+from neuralmonkey.token_series import (
+    OrderedCounter, TokenSeriesWriter, load_token_series)
+
+# version of the stored format, part of the cache key
+CACHE_VERSION = 1
+
+MANIFEST_FILE = "series.json"
+FILE_HASHES_FILE = "file_hashes.json"
+FILTERED_INDEX_FILE = "filtered_index.npy"
+TOKEN_COUNTS_FILE = "token_counts.json"
+
+_HASH_BLOCK_SIZE = 2 ** 20
+
+
+def dataset_cache_key(
+        cache_dir: str,
+        series_paths_and_readers: Dict[str, Tuple[List[str], Reader]],
+        preprocessors: Optional[List[Tuple[str, str, Callable]]],
+        dataset_preprocessors: Dict[str, Callable],
+        filters: Optional[List[Callable]]=None) -> str:
+    """Compute the key of a dataset in the cache.
+
+    Arguments:
+        cache_dir: The cache directory (used for memoizing the file hashes).
+        series_paths_and_readers: The mapping of series names to their files
+            and readers.
+        preprocessors: Series-level preprocessors of the dataset.
+        dataset_preprocessors: Dataset-level preprocessors of the dataset.
+        filters: Filters removing items from the dataset.
+
+    Returns:
+        A hexadecimal string identifying the dataset.
+    """
+    hasher = hashlib.sha1()
+    hasher.update("version {}".format(CACHE_VERSION).encode("utf-8"))
+
+    for name, (paths, reader) in sorted(series_paths_and_readers.items()):
+        hasher.update("series {} {}".format(
+            name, _fingerprint(reader)).encode("utf-8"))
+        for path in paths:
+            hasher.update(_file_hash(cache_dir, path).encode("utf-8"))
+
+    for src_id, tgt_id, function in preprocessors or []:
+        hasher.update("preprocessor {} {} {}".format(
+            src_id, tgt_id, _fingerprint(function)).encode("utf-8"))
+
+    for name, function in sorted(dataset_preprocessors.items()):
+        hasher.update("dataset preprocessor {} {}".format(
+            name, _fingerprint(function)).encode("utf-8"))
+
+    for item_filter in filters or []:
+        hasher.update("filter {}".format(
+            _fingerprint(item_filter)).encode("utf-8"))
+
+    return hasher.hexdigest()
+
+
+def load_cached_series(cache_dir: str,
+                       key: str) -> Optional[Dict[str, Any]]:
+    """Load the series of a dataset from the cache.
+
+    Arguments:
+        cache_dir: The cache directory.
+        key: The key of the dataset.
+
+    Returns:
+        Dictionary from series names to the memory-mapped series, None if the
+        dataset is not cached.
+    """
+    directory = os.path.join(cache_dir, key)
+    manifest_path = os.path.join(directory, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return None
+
+    with open(manifest_path, encoding="utf-8") as f_manifest:
+        manifest = json.load(f_manifest)
+
+    series = {}  # type: Dict[str, Any]
+    for name, meta in manifest["series"].items():
+        prefix = os.path.join(directory, meta["file"])
+        if meta["kind"] == "tokens":
+            series[name] = load_token_series(prefix)
+        else:
+            shape = [manifest["length"]] + meta["shape"]
+            if manifest["length"] == 0:
+                series[name] = np.zeros(shape, dtype=meta["dtype"])
+            else:
+                series[name] = np.memmap(prefix, dtype=meta["dtype"],
+                                         mode="r", shape=tuple(shape))
+    return series
+
+
+def load_filtered_index(cache_dir: str, key: str) -> Optional[np.ndarray]:
+    """Load the positions of the items of a filtered dataset in its files.
+
+    Arguments:
+        cache_dir: The cache directory.
+        key: The key of the dataset.
+
+    Returns:
+        Array of the positions of the kept items, None if the dataset is not
+        cached or was not filtered.
+    """
+    path = os.path.join(cache_dir, key, FILTERED_INDEX_FILE)
+    if not os.path.exists(path):
+        return None
+    return np.load(path, mmap_mode="r")
+
+
+def load_token_counts(cache_dir: str,
+                      key: str) -> Dict[str, collections.Counter]:
+    """Load the counts of the tokens of the text series of a dataset.
+
+    Arguments:
+        cache_dir: The cache directory.
+        key: The key of the dataset.
+
+    Returns:
+        Dictionary from series names to the counters of their tokens. It is
+        empty if the dataset is not cached or no series were counted.
+    """
+    path = os.path.join(cache_dir, key, TOKEN_COUNTS_FILE)
+    if not os.path.exists(path):
+        return {}
+
+    with open(path, encoding="utf-8") as f_counts:
+        stored = json.load(f_counts)
+
+    token_counts = {}  # type: Dict[str, collections.Counter]
+    for name, pairs in stored.items():
+        # the pairs keep the order of the tokens
+        counts = OrderedCounter()  # type: collections.Counter
+        for token, count in pairs:
+            counts[token] = count
+        token_counts[name] = counts
+    return token_counts
+
+
+# pylint: disable=too-many-arguments
+def cache_series(cache_dir: str, key: str, names: List[str],
+                 rows: Iterable[Tuple],
+                 filtered_index: Optional[List[int]]=None,
+                 token_counts: Optional[
+                     Dict[str, collections.Counter]]=None) -> bool:
+    """Store the series of a dataset in the cache.
+
+    The items are written as they come, so the whole dataset does not have to
+    fit into the memory. The data is first written into a temporary directory,
+    which is renamed when everything is written.
+
+    Arguments:
+        cache_dir: The cache directory.
+        key: The key of the dataset.
+        names: Names of the stored series.
+        rows: Iterable of tuples of the items of the series.
+        filtered_index: Positions of the stored items in the input files if
+            the dataset was filtered. The list may be filled while the rows
+            are iterated.
+        token_counts: Counts of the tokens of the text series. The
+            counters may be filled while the rows are iterated.
+
+    Returns:
+        True if the series were stored, False if they cannot be cached.
+    """
+    directory = os.path.join(cache_dir, key)
+    tmp_directory = "{}.tmp-{}".format(directory, os.getpid())
+    os.makedirs(tmp_directory, exist_ok=True)
+
+    writers = None  # type: Optional[List[Any]]
+    length = 0
+    cacheable = True
+    try:
+        for row in rows:
+            if writers is None:
+                writers = [
+                    _series_writer(os.path.join(tmp_directory,
+                                                "series-{}".format(i)), item)
+                    for i, item in enumerate(row)]
+            for writer, item in zip(writers, row):
+                writer.add(item)
+            length += 1
+    except ValueError as exc:
+        log("Dataset cannot be cached: {}".format(exc), color="red")
+        cacheable = False
+    finally:
+        # the writers are closed before their directory is deleted
+        for writer in writers or []:
+            writer.close()
+
+    if not cacheable or writers is None:
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+        return False
+
+    manifest = {"version": CACHE_VERSION, "length": length, "series": {}}
+    for i, (name, writer) in enumerate(zip(names, writers)):
+        meta = writer.meta()
+        meta["file"] = "series-{}".format(i)
+        manifest["series"][name] = meta
+
+    if filtered_index is not None:
+        np.save(os.path.join(tmp_directory, FILTERED_INDEX_FILE),
+                np.array(filtered_index, dtype=np.int64))
+
+    if token_counts:
+        with open(os.path.join(tmp_directory, TOKEN_COUNTS_FILE), "w",
+                  encoding="utf-8") as f_counts:
+            json.dump({name: list(counts.items())
+                       for name, counts in token_counts.items()},
+                      f_counts, ensure_ascii=False)
+
+    with open(os.path.join(tmp_directory, MANIFEST_FILE), "w",
+              encoding="utf-8") as f_manifest:
+        json.dump(manifest, f_manifest)
+
+    try:
+        os.rename(tmp_directory, directory)
+    except OSError:
+        # the same dataset was cached by another process in the meantime
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+
+    log("Dataset stored in the cache '{}'".format(directory))
+    return True
+
+
+class _TokensWriter(TokenSeriesWriter):
+    """Token series writer checking the items it gets."""
+
+    def add(self, sentence: List[str]) -> None:
+        if (not isinstance(sentence, (list, tuple)) or
+                not all(isinstance(token, str) for token in sentence)):
+            raise ValueError("Text series contains {}".format(type(sentence)))
+        super().add(sentence)
+
+    # pylint: disable=no-self-use
+    def meta(self) -> Dict[str, Any]:
+        return {"kind": "tokens"}
+
+
+class _ArrayWriter(object):
+    """Writer of a series of numpy arrays of the same shape and type."""
+
+    def __init__(self, path: str, first_item: np.ndarray) -> None:
+        self.shape = first_item.shape
+        self.dtype = first_item.dtype
+        self._file = open(path, "wb")
+
+    def add(self, item: np.ndarray) -> None:
+        if (not isinstance(item, np.ndarray) or item.shape != self.shape or
+                item.dtype != self.dtype):
+            raise ValueError("Series items are not arrays of shape {}"
+                             .format(self.shape))
+        item.tofile(self._file)
+
+    def close(self) -> None:
+        self._file.close()
+
+    def meta(self) -> Dict[str, Any]:
+        return {"kind": "array", "dtype": self.dtype.str,
+                "shape": list(self.shape)}
+
+
+def _series_writer(prefix: str, first_item: Any) -> Any:
+    if isinstance(first_item, np.ndarray):
+        return _ArrayWriter(prefix, first_item)
+    if isinstance(first_item, (list, tuple)):
+        return _TokensWriter(prefix)
+    raise ValueError("Unsupported series item {}".format(type(first_item)))
+
+
+def _file_hash(cache_dir: str, path: str) -> str:
+    """Compute the SHA1 hash of the file contents.
+
+    The hashes are memoized in the cache directory with the size and the
+    modification time of the files, so unchanged files are hashed only once.
+    """
+    memo_path = os.path.join(cache_dir, FILE_HASHES_FILE)
+    memo = {}  # type: Dict[str, List]
+    if os.path.exists(memo_path):
+        with open(memo_path, encoding="utf-8") as f_memo:
+            memo = json.load(f_memo)
+
+    stat = os.stat(path)
+    abs_path = os.path.abspath(path)
+    if abs_path in memo and memo[abs_path][:2] == [stat.st_size,
+                                                   stat.st_mtime_ns]:
+        return memo[abs_path][2]
+
+    hasher = hashlib.sha1()
+    with open(path, "rb") as f_data:
+        for block in iter(lambda: f_data.read(_HASH_BLOCK_SIZE), b""):
+            hasher.update(block)
+    file_hash = hasher.hexdigest()
+
+    os.makedirs(cache_dir, exist_ok=True)
+    memo[abs_path] = [stat.st_size, stat.st_mtime_ns, file_hash]
+    tmp_path = "{}.tmp-{}".format(memo_path, os.getpid())
+    with open(tmp_path, "w", encoding="utf-8") as f_memo:
+        json.dump(memo, f_memo)
+    os.replace(tmp_path, memo_path)
+
+    return file_hash
+
+
+def _fingerprint(obj: Any) -> str:
+    """Describe a reader or a preprocessor by its name, code and state."""
+    hasher = hashlib.sha1()
+    hasher.update(_stable_repr(obj, 0).encode("utf-8"))
+
+    function = getattr(obj, "__call__", None)
+    code = getattr(obj, "__code__", None) or getattr(
+        getattr(function, "__func__", None), "__code__", None)
+    if code is not None:
+        _hash_code(hasher, code)
+
+    return hasher.hexdigest()
+
+
+def _hash_code(hasher: Any, code: types.CodeType) -> None:
+    """Hash the bytecode of a function including its nested functions.
+
+    The representation of a nested code object (e.g. of a comprehension or a
+    lambda) contains its memory address, so it is hashed recursively instead.
+    """
+    hasher.update(code.co_code)
+    hasher.update(repr(code.co_names).encode("utf-8"))
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            _hash_code(hasher, const)
+        else:
+            hasher.update(_stable_repr(const, 0).encode("utf-8"))
+        # separate the constants
+        hasher.update(b"\0")
+
+
+def _stable_repr(value: Any, depth: int) -> str:
+    """Represent a value by a string that does not change between runs."""
+    if depth > 5:
+        return type(value).__name__
+    if isinstance(value, dict):
+        return "{" + ", ".join(
+            "{}: {}".format(_stable_repr(k, depth + 1),
+                            _stable_repr(v, depth + 1))
+            for k, v in sorted(value.items(), key=lambda x: repr(x[0]))) + "}"
+    if isinstance(value, (set, frozenset)):
+        return "{" + ", ".join(
+            sorted(_stable_repr(v, depth + 1) for v in value)) + "}"
+    if isinstance(value, (list, tuple)):
+        return "[" + ", ".join(_stable_repr(v, depth + 1)
+                               for v in value) + "]"
+    if isinstance(value, (str, bytes, int, float, bool, type(None))):
+        return repr(value)
+
+    name = "{}.{}".format(getattr(value, "__module__", ""),
+                          getattr(value, "__qualname__",
+                                  type(value).__qualname__))
+    code = getattr(value, "__code__", None)
+    if isinstance(code, types.CodeType):
+        code_hasher = hashlib.sha1()
+        _hash_code(code_hasher, code)
+        name += "<{}>".format(code_hasher.hexdigest())
+    closure = getattr(value, "__closure__", None)
+    if closure:
+        name += _stable_repr([cell.cell_contents for cell in closure],
+                             depth + 1)
+    if hasattr(value, "__dict__") and not callable(
+            getattr(value, "__code__", None)):
+        name += _stable_repr(vars(value), depth + 1)
+    return name
@@ -456,8 +456,6 @@ class Decoder(ModelPart):
             raise ValueError("When training, you must feed "
                              "reference sentences")
 
-        sentences_list = list(sentences) if sentences is not None else None
-
         fd = {}  # type: FeedDict
         fd[self.train_mode] = train
 
@@ -466,13 +464,15 @@ class Decoder(ModelPart):
                                       dtype=np.int32)
 
         if sentences is not None:
+            sentence_ids = dataset.get_token_ids(self.data_id,
+                                                 self.vocabulary)
             # train_mode=False, since we don't want to <unk>ize target words!
             inputs, weights = self.vocabulary.sentences_to_tensor(
-                sentences_list, self.max_output_len, train_mode=False,
+                sentence_ids, self.max_output_len, train_mode=False,
                 add_start_symbol=False, add_end_symbol=True)
 
-            assert inputs.shape == (self.max_output_len, len(sentences_list))
-            assert weights.shape == (self.max_output_len, len(sentences_list))
+            assert inputs.shape == (self.max_output_len, len(sentence_ids))
+            assert weights.shape == (self.max_output_len, len(sentence_ids))
 
             fd[self.train_inputs] = inputs
             fd[self.train_padding] = weights
@@ -89,9 +89,9 @@ class SequenceLabeler(ModelPart):
                          dataset.get_series(self.data_id, allow_none=True))
 
         if sentences is not None:
-            sentences_list = list(sentences) if sentences is not None else None
             inputs, weights = self.vocabulary.sentences_to_tensor(
-                sentences_list, self.max_output_len)
+                dataset.get_token_ids(self.data_id, self.vocabulary),
+                self.max_output_len)
 
             assert len(weights) == len(self.train_weights)
             assert len(inputs) == len(self.train_targets)
@@ -197,8 +197,9 @@ class FactoredEncoder(ModelPart, Attentive):
 
     # pylint: disable=too-many-locals
     def feed_dict(self, dataset, train=False):
-        factors = {data_id: dataset.get_series(data_id)
-                   for data_id in self.data_ids}
+        factors = {data_id: dataset.get_token_ids(data_id, vocabulary)
+                   for data_id, vocabulary in zip(self.data_ids,
+                                                  self.vocabularies)}
 
         # this method should be responsible for checking if the factored
         # sentences are of the same length
@@ -206,10 +206,10 @@ class SentenceEncoder(ModelPart, Attentive):
         # pylint: disable=invalid-name
         fd = {}  # type: FeedDict
         fd[self.train_mode] = train
-        sentences = dataset.get_series(self.data_id)
+        sentences = dataset.get_token_ids(self.data_id, self.vocabulary)
 
         vectors, paddings = self.vocabulary.sentences_to_tensor(
-            list(sentences), self.max_input_len, train_mode=train)
+            sentences, self.max_input_len, train_mode=train)
 
         # as sentences_to_tensor returns lists of shape (time, batch),
         # we need to transpose
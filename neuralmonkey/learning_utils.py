@@ -2,15 +2,18 @@
 # pylint: disable=too-many-lines
 # There are too many lines because of these pylint directives.
 
-from typing import Any, Callable, Dict, List, Tuple, Optional, Union, Iterable
+from typing import Any, Callable, Dict, List, Tuple, Optional, Union
+import json
 import os
 import numpy as np
 import tensorflow as tf
 from termcolor import colored
 
 from neuralmonkey.logging import log, log_print
-from neuralmonkey.dataset import Dataset, LazyDataset
-from neuralmonkey.tf_manager import TensorFlowManager
+from neuralmonkey.batch_prefetcher import BatchPrefetcher
+from neuralmonkey.dataset import Dataset
+from neuralmonkey.tf_manager import (
+    TensorFlowManager, coder_series, feed_dicts_by_coder)
 from neuralmonkey.runners.base_runner import BaseRunner, ExecutionResult
 from neuralmonkey.trainers.generic_trainer import GenericTrainer
 from neuralmonkey.tf_utils import gpu_memusage
@@ -23,6 +26,9 @@ EvalConfiguration = List[Union[Tuple[SeriesName, Any],
 Postprocess = Optional[List[Tuple[SeriesName, Callable]]]
 # pylint: enable=invalid-name
 
+# suffix of the file with the training position stored next to a checkpoint
+SAMPLER_STATE_SUFFIX = ".sampler.json"
+
 
 # pylint: disable=too-many-arguments, too-many-locals, too-many-branches
 def training_loop(tf_manager: TensorFlowManager,
@@ -44,7 +50,12 @@ def training_loop(tf_manager: TensorFlowManager,
                   val_preview_num_examples: int=15,
                   train_start_offset: int=0,
                   runners_batch_size: Optional[int]=None,
+                  batch_bucket_span: Optional[int]=None,
+                  batch_tokens: Optional[int]=None,
+                  runners_batch_tokens: Optional[int]=None,
+                  prefetch_batches: int=0,
                   initial_variables: Optional[Union[str, List[str]]]=None,
+                  resume_training: bool=False,
                   postprocess: Postprocess=None,
                   minimize_metric: bool=False):
 
@@ -59,6 +70,31 @@ def training_loop(tf_manager: TensorFlowManager,
             the loss and optimization operation.
         train_dataset:
         val_dataset:
+        batch_bucket_span: If not None, sentences of similar length are
+            batched together within windows of ``batch_bucket_span``
+            batches, both for training and for the runners. See
+            ``Dataset.batch_dataset`` for details.
+        batch_tokens: If not None, the training batches are limited by this
+            number of tokens of the series fed to the trainer (counted with
+            the padding to the longest sentence of the batch) instead of a
+            fixed number of sentences. ``batch_size`` then only limits the
+            number of sentences in a batch. See ``Dataset.batch_dataset``.
+        runners_batch_tokens: The token budget for the batches of the runners.
+        prefetch_batches: Number of training batches whose feed dictionaries
+            are prepared in a background thread while the model is running.
+            Zero means no prefetching.
+        train_start_offset: Number of training instances skipped at the
+            beginning of the first epoch, in the order in which they are
+            batched (after shuffling). Ignored when the training is resumed
+            from a stored training position.
+        initial_variables: Variables to start the training with.
+        resume_training: Flag whether to continue an interrupted training
+            from ``initial_variables``. The epoch, the step and the position
+            in the training data stored with the checkpoint (in a file with
+            the ``.sampler.json`` suffix) are restored and the training
+            continues with the batch following the checkpoint. Otherwise
+            (default), e.g. when fine-tuning a model of another experiment,
+            the training starts from the beginning.
         postprocess: Function that takes the output sentence as produced by the
             decoder and transforms into tokenized sentence.
         log_directory: Directory where the TensordBoard log will be generated.
@@ -113,9 +149,32 @@ def training_loop(tf_manager: TensorFlowManager,
         # initial variables are supplied
         tf_manager.initialize_model_parts(runners + [trainer])  # type: ignore
         tf_manager.save(variables_files[0])
+        # positions stored by a previous training do not belong to the files
+        for var_file in variables_files:
+            if os.path.exists(var_file + SAMPLER_STATE_SUFFIX):
+                os.remove(var_file + SAMPLER_STATE_SUFFIX)
     else:
         tf_manager.restore(initial_variables)
 
+    sampler_state = None  # type: Optional[Dict[str, int]]
+    if resume_training:
+        if initial_variables is None:
+            raise ValueError("Resuming the training requires the initial "
+                             "variables of the interrupted training")
+        sampler_state = _load_sampler_state(initial_variables)
+        if sampler_state is None:
+            log("Warning: No training position stored with the initial "
+                "variables, the training starts from the beginning",
+                color="red")
+
+    start_epoch = 1
+    if sampler_state is not None:
+        start_epoch = sampler_state["epoch"]
+        step = sampler_state["step"]
+        seen_instances = sampler_state["seen_instances"]
+        log("Resuming the training at epoch {}, step {}, after {} seen "
+            "instances".format(start_epoch, step, seen_instances))
+
     if os.path.islink(link_best_vars):
         # if overwriting output dir
         os.unlink(link_best_vars)
@@ -131,28 +190,43 @@ def training_loop(tf_manager: TensorFlowManager,
     best_score_batch_no = 0
 
     log("Starting training")
+    prefetcher = None  # type: Optional[BatchPrefetcher]
     try:
-        for epoch_n in range(1, epochs + 1):
+        for epoch_n in range(start_epoch, epochs + 1):
             log_print("")
             log("Epoch {} starts".format(epoch_n), color='red')
 
-            train_dataset.shuffle()
-            train_batched_datasets = train_dataset.batch_dataset(batch_size)
-
-            if epoch_n == 1 and train_start_offset:
-                if not isinstance(train_dataset, LazyDataset):
-                    log("Warning: Not skipping training instances with "
-                        "shuffled in-memory dataset", color="red")
-                else:
-                    _skip_lines(train_start_offset, train_batched_datasets)
-
-            for batch_n, batch_dataset in enumerate(train_batched_datasets):
+            # the seed allows to repeat the order when resuming the training
+            epoch_seed = np.random.randint(2 ** 31 - 1)
+            if sampler_state is not None and epoch_n == start_epoch:
+                epoch_seed = sampler_state["seed"]
+            train_dataset.shuffle(epoch_seed)
+
+            if sampler_state is not None and epoch_n == start_epoch:
+                log("Resuming training at instance {} of epoch {}".format(
+                    sampler_state["items"], epoch_n))
+                train_dataset.skip(sampler_state["items"],
+                                   sampler_state["batches"])
+            elif epoch_n == 1 and train_start_offset:
+                _skip_lines(train_start_offset, train_dataset)
+
+            train_batched_datasets = train_dataset.batch_dataset(
+                batch_size, batch_bucket_span, batch_tokens,
+                coder_series(trainer.all_coders))
+            prefetcher = BatchPrefetcher(
+                train_batched_datasets,
+                lambda batch: feed_dicts_by_coder(batch, trainer.all_coders,
+                                                  train=True),
+                prefetch_batches)
+
+            for batch_n, (batch_dataset, coder_feed_dicts) in enumerate(
+                    prefetcher):
                 step += 1
                 seen_instances += len(batch_dataset)
                 if step % logging_period == logging_period - 1:
                     trainer_result = tf_manager.execute(
                         batch_dataset, [trainer], train=True,
-                        summaries=True)
+                        summaries=True, coder_feed_dicts=coder_feed_dicts)
                     train_results, train_outputs = run_on_dataset(
                         tf_manager, runners, batch_dataset,
                         postprocess, write_out=False)
@@ -171,13 +245,17 @@ def training_loop(tf_manager: TensorFlowManager,
                                                train=True)
                 else:
                     tf_manager.execute(batch_dataset, [trainer],
-                                       train=True, summaries=False)
+                                       train=True, summaries=False,
+                                       coder_feed_dicts=coder_feed_dicts)
 
                 if step % validation_period == validation_period - 1:
                     val_results, val_outputs = run_on_dataset(
                         tf_manager, runners, val_dataset,
                         postprocess, write_out=False,
-                        batch_size=runners_batch_size)
+                        batch_size=runners_batch_size,
+                        bucket_span=batch_bucket_span,
+                        batch_tokens=runners_batch_tokens,
+                        prefetch_batches=prefetch_batches)
                     # ensure val outputs are iterable more than once
                     val_outputs = {k: list(v) for k, v in val_outputs.items()}
                     val_evaluation = evaluation(
@@ -210,6 +288,11 @@ def training_loop(tf_manager: TensorFlowManager,
                         # we need to save this score instead the worst score
                         worst_var_file = variables_files[worst_index]
                         tf_manager.save(worst_var_file)
+                        items, batches = batch_dataset.position or (0, 0)
+                        _save_sampler_state(worst_var_file, {
+                            "epoch": epoch_n, "seed": epoch_seed,
+                            "items": items, "batches": batches,
+                            "step": step, "seen_instances": seen_instances})
                         saved_scores[worst_index] = this_score
                         log("Variable file saved in {}".format(worst_var_file))
 
@@ -250,8 +333,15 @@ def training_loop(tf_manager: TensorFlowManager,
                                     val_preview_output_series,
                                     val_preview_num_examples)
 
+            if batch_bucket_span or batch_tokens:
+                log("Epoch {} batching: {}".format(
+                    epoch_n, train_dataset.padding_statistics))
+
     except KeyboardInterrupt:
         log("Training interrupted by user.")
+    finally:
+        if prefetcher is not None:
+            prefetcher.close()
 
     log("Training finished. Maximum {} on validation data: {:.4g}, epoch {}"
         .format(main_metric, best_score, best_score_epoch))
@@ -262,7 +352,9 @@ def training_loop(tf_manager: TensorFlowManager,
     for dataset in test_datasets:
         test_results, test_outputs = run_on_dataset(
             tf_manager, runners, dataset, postprocess,
-            write_out=True, batch_size=runners_batch_size)
+            write_out=True, batch_size=runners_batch_size,
+            bucket_span=batch_bucket_span, batch_tokens=runners_batch_tokens,
+            prefetch_batches=prefetch_batches)
         # ensure test outputs are iterable more than once
         test_outputs = {k: list(v) for k, v in test_outputs.items()}
         eval_result = evaluation(evaluators, dataset, runners,
@@ -297,7 +389,10 @@ def run_on_dataset(tf_manager: TensorFlowManager,
                    dataset: Dataset,
                    postprocess: Postprocess,
                    write_out: bool=False,
-                   batch_size: Optional[int]=None) \
+                   batch_size: Optional[int]=None,
+                   bucket_span: Optional[int]=None,
+                   batch_tokens: Optional[int]=None,
+                   prefetch_batches: int=0) \
                                                 -> Tuple[List[ExecutionResult],
                                                          Dict[str, List[Any]]]:
     """Apply the model on a dataset and optionally write outputs to files.
@@ -311,6 +406,13 @@ def run_on_dataset(tf_manager: TensorFlowManager,
         postprocess: an object to use as postprocessing of the
         write_out: Flag whether the outputs should be printed to a file defined
             in the dataset object.
+        batch_size: The size of a batch.
+        bucket_span: Number of batches within which sentences of similar
+            lengths are batched together. None means no bucketing.
+        batch_tokens: The maximum number of padded tokens in a batch. None
+            means batches of a fixed size.
+        prefetch_batches: Number of batches prepared in a background thread
+            while the model is running.
 
         extra_fetches: Extra tensors to evaluate for each batch.
 
@@ -324,7 +426,10 @@ def run_on_dataset(tf_manager: TensorFlowManager,
 
     all_results = tf_manager.execute(dataset, runners,
                                      compute_losses=contains_targets,
-                                     batch_size=batch_size)
+                                     batch_size=batch_size,
+                                     bucket_span=bucket_span,
+                                     batch_tokens=batch_tokens,
+                                     prefetch_batches=prefetch_batches)
 
     result_data = {runner.output_series: result.outputs
                    for runner, result in zip(runners, all_results)}
@@ -553,23 +658,57 @@ def _print_examples(dataset: Dataset,
         log_print("")
 
 
-def _skip_lines(start_offset: int,
-                batched_datasets: Iterable[Dataset]) -> None:
-    """Skip training instances from the beginning.
+def _save_sampler_state(variables_file: str, state: Dict[str, int]) -> None:
+    """Store the position in the training data next to a checkpoint.
 
     Arguments:
-        start_offset: How many training instances to skip (minimum)
-        batched_datasets: From where to throw away batches
+        variables_file: The checkpoint file.
+        state: The epoch, its shuffling seed, the position after the last
+            trained batch (see ``Dataset.skip``), the training step and the
+            number of seen instances.
     """
-    log("Skipping first {} instances in the dataset".format(start_offset))
+    with open(variables_file + SAMPLER_STATE_SUFFIX, "w") as f_state:
+        json.dump(state, f_state)
+
 
-    skipped_instances = 0
-    while skipped_instances < start_offset:
-        try:
-            skipped_instances += len(next(batched_datasets))  # type: ignore
-        except StopIteration:
-            raise ValueError("Trying to skip more instances than "
-                             "the size of the dataset")
+def _load_sampler_state(variables: Optional[Union[str, List[str]]]) \
+        -> Optional[Dict[str, int]]:
+    """Load the training position stored with the initial variables.
 
-    if skipped_instances > 0:
-        log("Skipped {} instances".format(skipped_instances))
+    When there are more sessions, the variable files have the session index
+    as a suffix, while the training position is stored only once without it.
+
+    Returns:
+        The stored state or None if there is no such state.
+    """
+    if variables is None:
+        return None
+    if isinstance(variables, str):
+        variables = [variables]
+
+    for path in variables:
+        for candidate in [path, os.path.realpath(path),
+                          os.path.splitext(path)[0]]:
+            state_path = candidate + SAMPLER_STATE_SUFFIX
+            if os.path.exists(state_path):
+                log("Loading training position from {}".format(state_path))
+                with open(state_path) as f_state:
+                    return json.load(f_state)
+    return None
+
+
+def _skip_lines(start_offset: int, dataset: Dataset) -> None:
+    """Skip training instances from the beginning.
+
+    The instances are skipped in the current order of the dataset, i.e. the
+    first instances of a shuffled dataset are skipped after the shuffling.
+    If the files of a lazy dataset are indexed, the reading of the dataset
+    starts directly at the offset, otherwise the skipped lines are only read,
+    but not batched.
+
+    Arguments:
+        start_offset: How many training instances to skip
+        dataset: The dataset in which the instances are skipped
+    """
+    log("Skipping first {} instances in the dataset".format(start_offset))
+    dataset.skip(start_offset)
@@ -0,0 +1,59 @@
+"""Filters removing unsuitable items from datasets.
+
+A filter is a callable which gets a dictionary mapping the series names to the
+items of a single dataset row and returns None if the row should be kept or a
+short description of the reason why it should be removed. The reasons are
+counted and logged by the dataset.
+"""
+
+from typing import Any, Dict, List, Optional
+
+# tests: lint, mypy
+# pylint: disable=too-few-public-methods
+
+
+class LengthFilter(object):
+    """Filter of rows by the lengths of their sentences.
+
+    A row is removed if any of its sentences is shorter than the minimum
+    length or longer than the maximum length, or if the length of the longest
+    sentence exceeds the length of the shortest one more than ``max_ratio``
+    times.
+    """
+
+    def __init__(self, series: List[str], min_length: int=1,
+                 max_length: Optional[int]=None,
+                 max_ratio: Optional[float]=None) -> None:
+        """Create the filter.
+
+        Arguments:
+            series: Names of the text series whose lengths are checked.
+            min_length: The minimum number of tokens in a sentence. The
+                default value 1 removes rows with empty sentences.
+            max_length: The maximum number of tokens in a sentence. None
+                (default) means no limit.
+            max_ratio: The maximum ratio of the lengths of the longest and the
+                shortest sentence of the row. None (default) means no limit.
+        """
+        if not series:
+            raise ValueError("Length filter needs at least one series")
+        self.series = series
+        self.min_length = min_length
+        self.max_length = max_length
+        self.max_ratio = max_ratio
+
+    def __call__(self, row: Dict[str, Any]) -> Optional[str]:
+        # a blank line is read as a single empty token
+        lengths = [len([token for token in row[name] if token])
+                   for name in self.series]
+        shortest = min(lengths)
+        longest = max(lengths)
+
+        if shortest < self.min_length:
+            return "empty" if shortest == 0 else "too short"
+        if self.max_length is not None and longest > self.max_length:
+            return "too long"
+        if (self.max_ratio is not None and
+                longest > self.max_ratio * max(shortest, 1)):
+            return "length ratio"
+        return None
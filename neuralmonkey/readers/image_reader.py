@@ -1,16 +1,30 @@
-from typing import Callable, List, Optional
+from typing import Callable, Iterable, List, Optional
+import collections
+import concurrent.futures
+import hashlib
 import os
 import numpy as np
 from PIL import Image
 
+from neuralmonkey.logging import log
 
+# number of images being decoded ahead per worker
+_PREFETCH_PER_WORKER = 4
+
+
+# pylint: disable=too-many-arguments
 def image_reader(prefix="",
                  pad_w: Optional[int]=None,
                  pad_h: Optional[int]=None,
                  rescale: bool=False,
-                 mode: str='RGB') -> Callable:
+                 mode: str='RGB',
+                 workers: int=1,
+                 cache_dir: Optional[str]=None) -> Callable:
     """Get a reader of images loading them from a list of pahts.
 
+    The images keep the data type of the image mode, i.e. ``uint8`` for the
+    usual 8-bit modes such as RGB or L.
+
     Args:
         prefix: Prefix of the paths that are listed in a image files.
         pad_w: Width to which the images will be padded/cropped/resized.
@@ -19,6 +33,15 @@ def image_reader(prefix="",
             size. Otherwise, they will be cropped from the middle.
         mode: Scipy image loading mode, see scipy documentation for more
             details.
+        workers: Number of threads decoding the images. The images are
+            returned in the order of the list regardless of the number of
+            workers.
+        cache_dir: If set, the padded images of every list file are stored
+            in a numpy file in this directory when they are read for the
+            first time. Next time, the numpy file is memory-mapped and no
+            image is decoded. The cache is identified by the contents of the
+            list file and the reader parameters, it has to be deleted
+            manually when the images change.
 
     Returns:
         The reader function that takes a list of image paths (relative to
@@ -26,40 +49,124 @@ def image_reader(prefix="",
         pad_h x pad_w x number of channels.
     """
 
-    def load(list_files: List[str]):
+    def load_image(path: str) -> np.ndarray:
+        image = Image.open(path).convert(mode)
+        if rescale:
+            _rescale(image, pad_w, pad_h)
+        else:
+            image = _crop(image, pad_w, pad_h)
+        image_np = np.array(image)
+
+        if len(image_np.shape) == 2:
+            channels = 1
+            image_np = np.expand_dims(image_np, 2)
+        elif len(image_np.shape) == 3:
+            channels = image_np.shape[2]
+        else:
+            raise ValueError(
+                ("Image should have either 2 (black and white) "
+                 "or three dimensions (color channels), has {} "
+                 "dimension.").format(len(image_np.shape)))
+
+        return _pad(image_np, pad_w, pad_h, channels)
+
+    def load_list(list_file: str) -> Iterable[np.ndarray]:
+        with open(list_file) as f_list:
+            paths = [os.path.join(prefix, image_file.rstrip())
+                     for image_file in f_list]
+
+        for i, path in enumerate(paths):
+            if not os.path.exists(path):
+                raise Exception(
+                    ("Image file '{}' no."
+                     "{}  does not exist.").format(path, i + 1))
+
+        images = _ordered_map(load_image, paths, workers)
+        if cache_dir is None:
+            return images
+
+        cache_path = os.path.join(cache_dir, "{}-{}.npy".format(
+            os.path.basename(list_file),
+            _cache_key(list_file, prefix, pad_w, pad_h, rescale, mode)))
+        if os.path.exists(cache_path):
+            return iter(np.load(cache_path, mmap_mode="r"))
+        return _cached_images(images, len(paths), cache_path)
+
+    def load(list_files: List[str]) -> Iterable[np.ndarray]:
         for list_file in list_files:
-            with open(list_file) as f_list:
-                for i, image_file in enumerate(f_list):
-                    path = os.path.join(prefix, image_file.rstrip())
-
-                    if not os.path.exists(path):
-                        raise Exception(
-                            ("Image file '{}' no."
-                             "{}  does not exist.").format(path, i + 1))
-
-                    image = Image.open(path).convert(mode)
-                    if rescale:
-                        _rescale(image, pad_w, pad_h)
-                    else:
-                        image = _crop(image, pad_w, pad_h)
-                    image_np = np.array(image)
-
-                    if len(image_np.shape) == 2:
-                        channels = 1
-                        image_np = np.expand_dims(image_np, 2)
-                    elif len(image_np.shape) == 3:
-                        channels = image_np.shape[2]
-                    else:
-                        raise ValueError(
-                            ("Image should have either 2 (black and white) "
-                             "or three dimensions (color channels), has {} "
-                             "dimension.").format(len(image_np.shape)))
-
-                    yield _pad(image_np, pad_w, pad_h, channels)
+            yield from load_list(list_file)
 
     return load
 
 
+def _ordered_map(function: Callable[[str], np.ndarray], paths: List[str],
+                 workers: int) -> Iterable[np.ndarray]:
+    """Apply the function to the paths in a thread pool, keeping the order.
+
+    Only a few images per worker are decoded ahead of the one that is
+    yielded, so the memory use does not grow with the number of images.
+    """
+    if workers <= 1:
+        yield from map(function, paths)
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        pending = collections.deque()  # type: collections.deque
+        remaining = iter(paths)
+        try:
+            for path in remaining:
+                pending.append(executor.submit(function, path))
+                if len(pending) >= workers * _PREFETCH_PER_WORKER:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def _cached_images(images: Iterable[np.ndarray], count: int,
+                   cache_path: str) -> Iterable[np.ndarray]:
+    """Write the images into the cache while they are yielded.
+
+    The cache file is written under a temporary name, which is changed when
+    all images are written. If the reading stops early, the temporary file
+    is deleted.
+    """
+    tmp_path = "{}.{}.tmp.npy".format(cache_path[:-4], os.getpid())
+    cached = None  # type: Optional[np.ndarray]
+    written = 0
+    try:
+        for image in images:
+            if cached is None:
+                os.makedirs(os.path.dirname(cache_path) or ".",
+                            exist_ok=True)
+                cached = np.lib.format.open_memmap(
+                    tmp_path, mode="w+", dtype=image.dtype,
+                    shape=(count,) + image.shape)
+            cached[written] = image
+            written += 1
+            yield image
+    finally:
+        if cached is not None:
+            del cached
+            if written == count:
+                os.replace(tmp_path, cache_path)
+                log("Images stored in the cache '{}'".format(cache_path))
+            else:
+                os.remove(tmp_path)
+
+
+def _cache_key(list_file: str, prefix: str, pad_w: Optional[int],
+               pad_h: Optional[int], rescale: bool, mode: str) -> str:
+    hasher = hashlib.sha1()
+    with open(list_file, "rb") as f_list:
+        hasher.update(f_list.read())
+    hasher.update(repr((os.path.abspath(prefix), pad_w, pad_h, rescale,
+                        mode)).encode("utf-8"))
+    return hasher.hexdigest()
+
+
 def _rescale(image, pad_w, pad_h):
     orig_w, orig_h = image.size
     if orig_w > pad_w or orig_h > pad_h:
@@ -82,7 +189,7 @@ def _crop(image, pad_w, pad_h):
 def _pad(image, pad_w, pad_h, channels):
     img_h, img_w = image.shape[:2]
 
-    image_padded = np.zeros((pad_h, pad_w, channels))
+    image_padded = np.zeros((pad_h, pad_w, channels), dtype=image.dtype)
     image_padded[:img_h, :img_w, :] = image
 
     return image_padded
@@ -1,12 +1,110 @@
-from typing import List
+from typing import Any, Iterable, List, Tuple, Union
 
 import numpy as np
 
 # tests: lint, mypy
 
 
-def numpy_reader(files: List[str]):
-    if len(files) == 1:
-        return np.load(files[0])
-    else:
-        np.concatenate([np.load(f) for f in files], axis=0)
+def numpy_reader(files: List[str]) -> Union[np.ndarray, "ConcatenatedArray"]:
+    """Open numpy files with the items of a series along the first axis.
+
+    The files are memory-mapped, so only the items that are used are read
+    into the memory. Several files are concatenated virtually, without
+    copying the data.
+
+    Arguments:
+        files: Paths to the ``.npy`` files.
+
+    Returns:
+        The memory-mapped array for a single file, a ``ConcatenatedArray`` of
+        the memory-mapped arrays for more files.
+    """
+    arrays = [np.load(f, mmap_mode="r") for f in files]
+    if len(arrays) == 1:
+        return arrays[0]
+    return ConcatenatedArray(arrays)
+
+
+class ConcatenatedArray(object):
+    """Read-only concatenation of numpy arrays along the first axis.
+
+    The arrays are not copied. Indexing by an integer returns the item,
+    indexing by a slice or an array of indices returns a new numpy array of
+    the selected items, so a batch can be taken at once.
+    """
+
+    def __init__(self, arrays: List[np.ndarray]) -> None:
+        """Concatenate the arrays.
+
+        Raises:
+            ValueError if the items of the arrays differ in shape or type.
+        """
+        if not arrays:
+            raise ValueError("No arrays to concatenate")
+        for array in arrays[1:]:
+            if (array.shape[1:] != arrays[0].shape[1:] or
+                    array.dtype != arrays[0].dtype):
+                raise ValueError(
+                    "Cannot concatenate arrays of items of shapes {} and {}"
+                    .format(arrays[0].shape[1:], array.shape[1:]))
+
+        self.arrays = arrays
+        self.dtype = arrays[0].dtype
+        # positions of the first items of the arrays followed by the length
+        self.offsets = np.cumsum([0] + [len(array) for array in arrays])
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return (int(self.offsets[-1]),) + self.arrays[0].shape[1:]
+
+    def __len__(self) -> int:
+        return int(self.offsets[-1])
+
+    def __array__(self, dtype: Any=None, copy: Any=None) -> np.ndarray:
+        if copy is False:
+            raise ValueError("Concatenated arrays cannot be converted to a "
+                             "numpy array without copying")
+        array = self._take(np.arange(len(self)))
+        return array if dtype is None else array.astype(dtype)
+
+    def __iter__(self) -> Iterable[np.ndarray]:
+        for array in self.arrays:
+            yield from array
+
+    def __getitem__(self, index: Any) -> np.ndarray:
+        if isinstance(index, (int, np.integer)):
+            if index < 0:
+                index += len(self)
+            if not 0 <= index < len(self):
+                raise IndexError("Index {} out of range".format(index))
+            array_index = np.searchsorted(self.offsets, index,
+                                          side="right") - 1
+            return self.arrays[array_index][index - self.offsets[array_index]]
+
+        if isinstance(index, slice):
+            index = np.arange(len(self))[index]
+        return self._take(np.asarray(index, dtype=np.int64))
+
+    def _take(self, indices: np.ndarray) -> np.ndarray:
+        """Gather items from the arrays into a new array."""
+        if indices.ndim != 1:
+            raise IndexError("Only one-dimensional indices are supported")
+        indices = np.where(indices < 0, indices + len(self), indices)
+        if indices.size and (indices.min() < 0 or
+                             indices.max() >= len(self)):
+            raise IndexError("Index out of range")
+
+        result = np.empty((len(indices),) + self.arrays[0].shape[1:],
+                          dtype=self.dtype)
+        array_indices = np.searchsorted(self.offsets, indices,
+                                        side="right") - 1
+        for array_index in np.unique(array_indices):
+            mask = array_indices == array_index
+            local = indices[mask] - self.offsets[array_index]
+            if local.size and np.all(np.diff(local) == 1):
+                # a contiguous range is read as a single slice
+                result[mask] = self.arrays[array_index][
+                    local[0]:local[-1] + 1]
+            else:
+                result[mask] = self.arrays[array_index][local]
+        return result
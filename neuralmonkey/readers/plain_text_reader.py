@@ -1,27 +1,249 @@
-from typing import List, Iterable
+from typing import BinaryIO, Callable, Dict, List, Iterable, Optional
+import bz2
+import codecs
 import gzip
+import itertools
+import lzma
+import mmap
+import os
 
-from neuralmonkey.readers.utils import FILETYPER
+import numpy as np
+
+from neuralmonkey.logging import log
 
 # tests: lint,mypy
 
+# magic bytes at the beginning of the compressed files
+_COMPRESSION_MAGIC = [(b"\x1f\x8b", "gzip"),
+                      (b"BZh", "bz2"),
+                      (b"\xfd7zXZ\x00", "xz")]
 
-def get_plain_text_reader(encoding: str="utf-8"):
-    """Get reader for space-separated tokenized text."""
-    def reader(files: List[str]) -> Iterable[List[str]]:
-        for path in files:
-            mime_type = FILETYPER.from_file(path)
+_DECOMPRESSORS = {
+    "gzip": gzip.open,
+    "bz2": bz2.open,
+    "xz": lzma.open
+}  # type: Dict[str, Callable[..., BinaryIO]]
 
-            if mime_type == "application/gzip":
-                with gzip.open(path, 'r') as f_data:
-                    for line in f_data:
-                        yield str(line, 'utf-8').strip().split(" ")
-            else:
-                with open(path, encoding=encoding) as f_data:
-                    for line in f_data:
+# size of the blocks read by the reader, in bytes
+DEFAULT_BLOCK_SIZE = 2 ** 20
+
+# size of the blocks read when reading a range of lines
+_RANGE_BLOCK_SIZE = 2 ** 16
+
+
+class PlainTextReader(object):
+    """Reader for space-separated tokenized text.
+
+    Uncompressed files are read line by line by the buffered text reader,
+    which is the fastest way for them. Files compressed with gzip, bzip2 or
+    xz are decompressed on the fly in large blocks which are decoded at once
+    and split into lines, the compression is recognized by the first bytes of
+    the file. Uncompressed files can also be memory-mapped instead of read.
+
+    Besides reading whole files, the reader can read a range of lines
+    starting at a known byte offset of an uncompressed file. Together with
+    the line index (see ``line_index``), this gives the lazy dataset random
+    access to the lines.
+    """
+
+    def __init__(self, encoding: str="utf-8",
+                 block_size: int=DEFAULT_BLOCK_SIZE,
+                 use_mmap: bool=False) -> None:
+        """Create the reader.
+
+        Arguments:
+            encoding: Encoding of the files.
+            block_size: Number of bytes decompressed (or taken from a
+                memory-mapped file) at once.
+            use_mmap: If True, uncompressed files are memory-mapped.
+        """
+        self.encoding = encoding
+        self.block_size = block_size
+        self.use_mmap = use_mmap
+
+    def __call__(self, files: List[str]) -> Iterable[List[str]]:
+        for path in files:
+            method = compression(path)
+            if method is None and not self.use_mmap:
+                # only "\n" ends a line, as in the line index
+                with open(path, encoding=self.encoding,
+                          newline="\n") as f_text:
+                    for line in f_text:
                         yield line.strip().split(" ")
+            else:
+                for line in self._block_lines(path, method):
+                    yield line.strip().split(" ")
+
+    def _block_lines(self, path: str, method: Optional[str]) -> Iterable[str]:
+        """Read the lines of a compressed or memory-mapped file in blocks.
+
+        Arguments:
+            path: Path to the file.
+            method: The compression of the file, None if it is not compressed.
+        """
+        if method is not None:
+            with _DECOMPRESSORS[method](path, "rb") as f_data:
+                yield from _decode_lines(_read_blocks(f_data, self.block_size),
+                                         self.encoding)
+        elif os.path.getsize(path) > 0:
+            with open(path, "rb") as f_data, mmap.mmap(
+                    f_data.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                yield from _decode_lines(
+                    _mapped_blocks(mapped, self.block_size), self.encoding)
+
+    def read_lines(self, path: str, offset: int,
+                   num_lines: int) -> List[List[str]]:
+        """Read a range of lines from an uncompressed file.
+
+        Arguments:
+            path: Path to the file.
+            offset: Byte offset of the first line to read.
+            num_lines: Number of lines to read.
+
+        Returns:
+            List of the tokenized lines.
+        """
+        with open(path, 'rb') as f_data:
+            f_data.seek(offset)
+            blocks = _read_blocks(f_data,
+                                  min(self.block_size, _RANGE_BLOCK_SIZE))
+            return [line.strip().split(" ") for line in itertools.islice(
+                _decode_lines(blocks, self.encoding), num_lines)]
+
+
+def get_plain_text_reader(encoding: str="utf-8",
+                          block_size: int=DEFAULT_BLOCK_SIZE,
+                          use_mmap: bool=False) -> PlainTextReader:
+    """Get reader for space-separated tokenized text."""
+    return PlainTextReader(encoding, block_size, use_mmap)
+
+
+def compression(path: str) -> Optional[str]:
+    """Recognize the compression of a file by its first bytes.
+
+    Arguments:
+        path: Path to the file.
+
+    Returns:
+        The name of the compression (``gzip``, ``bz2`` or ``xz``), None if the
+        file is not compressed.
+    """
+    with open(path, "rb") as f_data:
+        head = f_data.read(8)
+    for magic, method in _COMPRESSION_MAGIC:
+        if head.startswith(magic):
+            return method
+    return None
+
+
+def _read_blocks(f_data: BinaryIO, block_size: int) -> Iterable[bytes]:
+    while True:
+        block = f_data.read(block_size)
+        if not block:
+            break
+        yield block
+
+
+def _mapped_blocks(mapped: mmap.mmap, block_size: int) -> Iterable[bytes]:
+    for start in range(0, len(mapped), block_size):
+        yield mapped[start:start + block_size]
+
+
+def _decode_lines(blocks: Iterable[bytes], encoding: str) -> Iterable[str]:
+    """Decode blocks of bytes and split them into lines.
+
+    The blocks may end anywhere, the incremental decoder keeps the incomplete
+    characters and the incomplete last line is carried over to the next
+    block.
+    """
+    decoder = codecs.getincrementaldecoder(encoding)()
+    rest = ""
+    for block in blocks:
+        lines = decoder.decode(block).split("\n")
+        lines[0] = rest + lines[0]
+        rest = lines.pop()
+        yield from lines
+
+    rest += decoder.decode(b"", final=True)
+    if rest:
+        yield rest
+
+
+# suffix of the line index file stored next to the indexed file
+INDEX_SUFFIX = ".lineidx.npy"
+
+_SCAN_CHUNK_SIZE = 2 ** 24
+
+
+def line_index(path: str) -> Optional[np.ndarray]:
+    """Get the byte offsets of the lines of an uncompressed file.
+
+    The index is built once and stored as a ``uint64`` array in a numpy file
+    next to the indexed file. The first two items of the stored array are the
+    size and the modification time (in nanoseconds) of the indexed file, the
+    index is rebuilt when any of them changes. The stored index is memory
+    mapped when loaded. When the index cannot be stored (e.g. in a read-only
+    directory), it is kept in the memory only.
+
+    Arguments:
+        path: Path to the file.
+
+    Returns:
+        Array of the offsets of the beginnings of the lines followed by the
+        file size, i.e. line ``i`` spans bytes ``index[i]:index[i + 1]``.
+        None if the file is compressed.
+    """
+    if compression(path) is not None:
+        return None
+
+    stat = os.stat(path)
+    index_path = path + INDEX_SUFFIX
+
+    if os.path.exists(index_path):
+        try:
+            stored = np.load(index_path, mmap_mode="r")
+            if (stored.shape[0] >= 3 and stored[0] == stat.st_size and
+                    stored[1] == stat.st_mtime_ns):
+                return stored[2:]
+        except (ValueError, OSError):
+            pass
+
+    offsets = _scan_line_offsets(path, stat.st_size)
+    stored = np.concatenate(
+        [np.array([stat.st_size, stat.st_mtime_ns], dtype=np.uint64),
+         offsets])
+
+    tmp_path = "{}.{}.tmp".format(index_path, os.getpid())
+    try:
+        with open(tmp_path, "wb") as f_index:
+            np.save(f_index, stored)
+        os.replace(tmp_path, index_path)
+    except OSError as exc:
+        log("Cannot store the line index of '{}': {}".format(path, exc),
+            color="red")
+
+    return stored[2:]
+
+
+def _scan_line_offsets(path: str, size: int) -> np.ndarray:
+    """Find the offsets of the line beginnings by scanning the file."""
+    chunks = [np.zeros(1 if size else 0, dtype=np.uint64)]
+    position = 0
+    with open(path, "rb") as f_data:
+        while True:
+            chunk = f_data.read(_SCAN_CHUNK_SIZE)
+            if not chunk:
+                break
+            newlines = np.flatnonzero(
+                np.frombuffer(chunk, dtype=np.uint8) == ord("\n"))
+            chunks.append((newlines + position + 1).astype(np.uint64))
+            position += len(chunk)
 
-    return reader
+    offsets = np.concatenate(chunks)
+    # no line begins after the final newline
+    if offsets.size and offsets[-1] == size:
+        offsets = offsets[:-1]
+    return np.append(offsets, np.uint64(size))
 
 
 # pylint: disable=invalid-name
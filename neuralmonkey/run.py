@@ -17,6 +17,9 @@ CONFIG.add_argument('evaluation', list)
 CONFIG.add_argument('runners', list)
 CONFIG.add_argument('threads', int, required=False, default=4)
 CONFIG.add_argument('runners_batch_size', int, required=False, default=None)
+CONFIG.add_argument('runners_batch_tokens', int, required=False, default=None)
+CONFIG.add_argument('batch_bucket_span', int, required=False, default=None)
+CONFIG.add_argument('prefetch_batches', int, required=False, default=0)
 # ignore arguments which are just for training
 CONFIG.ignore_argument('val_dataset')
 CONFIG.ignore_argument('trainer')
@@ -24,6 +27,7 @@ CONFIG.ignore_argument('name')
 CONFIG.ignore_argument('train_dataset')
 CONFIG.ignore_argument('epochs')
 CONFIG.ignore_argument('batch_size')
+CONFIG.ignore_argument('batch_tokens')
 CONFIG.ignore_argument('test_datasets')
 CONFIG.ignore_argument('initial_variables')
 CONFIG.ignore_argument('validation_period')
@@ -108,7 +112,11 @@ def main() -> None:
     for dataset in datesets_model.test_datasets:
         execution_results, output_data = run_on_dataset(
             CONFIG.model.tf_manager, CONFIG.model.runners,
-            dataset, CONFIG.model.postprocess, write_out=True)
+            dataset, CONFIG.model.postprocess, write_out=True,
+            batch_size=CONFIG.model.runners_batch_size,
+            bucket_span=CONFIG.model.batch_bucket_span,
+            batch_tokens=CONFIG.model.runners_batch_tokens,
+            prefetch_batches=CONFIG.model.prefetch_batches)
         # TODO what if there is no ground truth
         eval_result = evaluation(evaluators, dataset, CONFIG.model.runners,
                                  execution_results, output_data)
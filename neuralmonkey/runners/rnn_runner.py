@@ -8,10 +8,14 @@ model ensembling and beam search.
 The TensorFlow session is invoked for every single output of the decoder
 separately which allows ensembling from all sessions and do the beam pruning
 before the a next output is emmited.
+
+The beam is expanded, scored and pruned for the whole batch at once. The
+hypotheses are not copied, only the chosen tokens and pointers to the
+hypotheses they continue are stored for every time step.
 """
 
 
-from typing import Dict, List, Callable, NamedTuple, Tuple
+from typing import Dict, List, Callable, NamedTuple, Optional
 import numpy as np
 import tensorflow as tf
 
@@ -23,160 +27,110 @@ from neuralmonkey.vocabulary import END_TOKEN_INDEX
 
 
 # pylint: disable=invalid-name
-BeamBatch = NamedTuple('BeamBatch',
-                       [('decoded', np.ndarray),
-                        ('logprobs', np.ndarray)])
-ExpandedBeamBatch = NamedTuple('ExpandedBeamBatch',
-                               [('beam_batch', BeamBatch),
-                                ('next_logprobs', np.ndarray)])
+# Hypotheses of the beam after a time step, ordered from the best one. The
+# arrays have the shape batch x beam. The tokens and the backpointers (the
+# positions of the continued hypotheses in the previous beam) are stored for
+# every time step. The sums of log-probabilities and the lengths count the
+# tokens up to the end token including.
+Beam = NamedTuple('Beam',
+                  [('tokens', List[np.ndarray]),
+                   ('backpointers', List[np.ndarray]),
+                   ('logprob_sums', np.ndarray),
+                   ('lengths', np.ndarray),
+                   ('finished', np.ndarray)])
+# Scores hypotheses given the sums of log-probabilities of their tokens and
+# their lengths, arrays of the shape batch x beam x vocabulary.
 ScoringFunction = Callable[[np.ndarray, np.ndarray], np.ndarray]
 
-# pylint: disable=too-many-locals
-
 
 def _n_best_indices(scores: np.ndarray, n: int) -> np.ndarray:
-    if scores.shape[0] <= n:
-        unsorted_n_best_indices = np.arange(scores.shape[0])
+    """Get the indices of the n best scores in every row, best first."""
+    if scores.shape[1] <= n:
+        unsorted_n_best_indices = np.tile(np.arange(scores.shape[1]),
+                                          (scores.shape[0], 1))
     else:
-        unsorted_n_best_indices = np.argpartition(-scores, n)[:n]
-    n_best_indices = unsorted_n_best_indices[
-        np.argsort(scores[unsorted_n_best_indices])]
-    return n_best_indices
-
+        unsorted_n_best_indices = np.argpartition(
+            -scores, n - 1, axis=1)[:, :n]
+    rows = np.arange(scores.shape[0])[:, np.newaxis]
+    order = np.argsort(-scores[rows, unsorted_n_best_indices], axis=1)
+    return unsorted_n_best_indices[rows, order]
 
-def _score_expanded(n: int,
-                    batch_size: int,
-                    expanded: List[ExpandedBeamBatch],
-                    scoring_function: ScoringFunction) -> \
-        Tuple[List[np.ndarray], List[np.ndarray]]:
-    """Score expanded beams.
-
-    After all hypotheses have their possible continuations, we need to score
-    the expanded hypotheses. We collect all possible conitnuations (typically
-    `n`-times size of the voabulary), score them using `scoring_function` and
-    keep only `n` with the highest scores.
-
-    Args:
-        n: Number of best hypotheses.
-        batch_size: Number hypothese in the batch.
-        expanded: List of expanded hypotheses from the previous beam, organized
-            into batches.
-        scoring_function: A function that scores the expanded hypotheses based
-            on the hypotheses and individual words' log-probs.
-
-    Returns:
-        Hypotheses indices and logprobs for the next decoding step.
-    """
-    next_beam_hypotheses = []
-    next_beam_logprobs = []
-    # agregate the expanded hypotheses hypothesis-wise
-    for rank in range(batch_size):
-        candidate_scores = None
-        candidate_hypotheses = None
-        candidate_logprobs = None
-
-        for expanded_batch in expanded:
-            next_distribution = expanded_batch.next_logprobs[rank]
-            if expanded_batch.beam_batch is None:
-                expanded_hypotheses = np.expand_dims(np.arange(
-                    len(next_distribution)), axis=1)
-                expanded_logprobs = np.expand_dims(next_distribution, 1)
-            else:
-                hypothesis = expanded_batch.beam_batch.decoded[rank]
-                prev_logprobs = expanded_batch.beam_batch.logprobs[rank]
-
-                expanded_hypotheses = np.array(
-                    [np.append(hypothesis, index)
-                     for index, _ in enumerate(next_distribution)])
-                expanded_logprobs = np.array(
-                    [np.append(prev_logprobs, logprob)
-                     for logprob in next_distribution])
-
-            assert expanded_hypotheses.shape == expanded_logprobs.shape
-            scores = scoring_function(expanded_hypotheses, expanded_logprobs)
-            assert scores.shape[0] == expanded_hypotheses.shape[0]
-            n_best_indices = _n_best_indices(scores, n)
-            candidate_scores = _try_append(
-                candidate_scores, scores[n_best_indices])
-            candidate_hypotheses = _try_append(
-                candidate_hypotheses, expanded_hypotheses[n_best_indices])
-            candidate_logprobs = _try_append(
-                candidate_logprobs, expanded_logprobs[n_best_indices])
-            assert len(candidate_hypotheses.shape) == 2
-
-        n_best_indices = _n_best_indices(candidate_scores, n)
-        n_best_hypotheses = candidate_hypotheses[n_best_indices]
-        n_best_logprobs = candidate_logprobs[n_best_indices]
-
-        assert len(n_best_hypotheses.shape) == 2
-        assert n_best_hypotheses.shape == n_best_logprobs.shape
-        next_beam_hypotheses.append(n_best_hypotheses)
-        next_beam_logprobs.append(n_best_logprobs)
-    return next_beam_hypotheses, next_beam_logprobs
-
-
-def _try_append(first, second):
-    if first is None:
-        return second
-    else:
-        return np.append(first, second, axis=0)
 
-
-def likelihood_beam_score(decoded, logprobs):
+def likelihood_beam_score(logprob_sums, lengths):
     """Score the beam by normalized probaility."""
-
-    mask = []
-    for hypothesis in decoded:
-        before_end = True
-        hyp_mask = []
-        for index in hypothesis:
-            hyp_mask.append(float(before_end))
-            before_end &= (index != END_TOKEN_INDEX)
-        mask.append(hyp_mask)
-
-    mask_matrix = np.array(mask)
-    masked_logprobs = mask_matrix * logprobs
-    # pylint: disable=no-member
-    avg_logprobs = masked_logprobs.sum(
-        axis=1) - np.log(mask_matrix.sum(axis=1))
-    return avg_logprobs
+    return logprob_sums - np.log(lengths)
 
 
 def n_best(n: int,
-           expanded: List[ExpandedBeamBatch],
-           scoring_function) -> List[BeamBatch]:
+           beam: Optional[Beam],
+           next_logprobs: np.ndarray,
+           scoring_function: ScoringFunction) -> Beam:
     """Take n-best from expanded beam search hypotheses.
 
-    To do the scoring we need to "reshape" the hypohteses. Before the scoring
-    the hypothesis are split into beam batches by their position in the beam.
-    To do the scoring, however, they need to be organized by the instances.
-    After the scoring, only _n_ hypotheses is kept for each isntance. These
-    are again split by their position in the beam.
+    Every hypothesis is expanded by every word of the vocabulary. The
+    expanded hypotheses of a batch item are scored together as a single
+    array and the n best of them form the next beam. Hypotheses which already
+    contain the end token do not change by the expansion.
 
     Args:
         n: Beam size.
-        expanded: List of batched expanded hypotheses.
-        scoring_function: A function
+        beam: The beam to expand, None at the first time step.
+        next_logprobs: Log-probabilities of the next words for the
+            hypotheses of the beam, an array of the shape batch x beam x
+            vocabulary.
+        scoring_function: A function scoring the expanded hypotheses.
 
     Returns:
-        List of BeamBatches ready for new expansion.
-
+        The beam of the n best expanded hypotheses.
     """
+    batch_size, _, vocabulary_size = next_logprobs.shape
+    if beam is None:
+        prev_sums = np.zeros((batch_size, 1))
+        prev_lengths = np.zeros((batch_size, 1), dtype=np.int64)
+        prev_finished = np.zeros((batch_size, 1), dtype=bool)
+    else:
+        prev_sums = beam.logprob_sums
+        prev_lengths = beam.lengths
+        prev_finished = beam.finished
+
+    active = ~prev_finished[:, :, np.newaxis]
+    logprob_sums = prev_sums[:, :, np.newaxis] + np.where(
+        active, next_logprobs, 0.)
+    lengths = np.broadcast_to(prev_lengths[:, :, np.newaxis] + active,
+                              logprob_sums.shape)
+    scores = scoring_function(logprob_sums, lengths)
+
+    best = _n_best_indices(scores.reshape(batch_size, -1), n)
+    rows = np.arange(batch_size)[:, np.newaxis]
+    backpointers = best // vocabulary_size
+    tokens = best % vocabulary_size
+
+    return Beam(
+        tokens=(beam.tokens if beam is not None else []) + [tokens],
+        backpointers=((beam.backpointers if beam is not None else []) +
+                      [backpointers]),
+        logprob_sums=logprob_sums.reshape(batch_size, -1)[rows, best],
+        lengths=lengths.reshape(batch_size, -1)[rows, best],
+        finished=(prev_finished[rows, backpointers] |
+                  (tokens == END_TOKEN_INDEX)))
+
+
+def decoded_hypotheses(beam: Beam) -> np.ndarray:
+    """Reconstruct the hypotheses of the beam by following the backpointers.
 
-    batch_size = expanded[0].next_logprobs.shape[0]
-    next_beam_hypotheses, next_beam_logprobs = _score_expanded(
-        n, batch_size, expanded, scoring_function)
-
-    # now cut the beams by hypotheses rank
-    beam_batches = []
-    for rank in range(n):
-        hypotheses = np.array([beam[rank] for beam in next_beam_hypotheses])
-        logprobs = np.array([beam[rank] for beam in next_beam_logprobs])
-        assert len(hypotheses.shape) == 2
-        assert hypotheses.shape == logprobs.shape
-        beam_batches.append(BeamBatch(hypotheses, logprobs))
-
-    return beam_batches
+    Returns:
+        The tokens of the hypotheses in an array of the shape batch x beam x
+        time.
+    """
+    batch_size, beam_size = beam.tokens[-1].shape
+    decoded = np.empty((batch_size, beam_size, len(beam.tokens)),
+                       dtype=beam.tokens[-1].dtype)
+    rows = np.arange(batch_size)[:, np.newaxis]
+    positions = np.tile(np.arange(beam_size), (batch_size, 1))
+    for step in reversed(range(len(beam.tokens))):
+        decoded[:, :, step] = beam.tokens[step][rows, positions]
+        positions = beam.backpointers[step][rows, positions]
+    return decoded
 
 
 class RuntimeRnnRunner(BaseRunner):
@@ -227,9 +181,11 @@ class RuntimeRnnExecutable(Executable):
         self._beam_scoring_f = beam_scoring_f
         self._postprocess = postprocess
 
-        self._to_exapand = [None]  # type: List[Option[BeamBatch]]
-        self._current_beam_batch = None
-        self._expanded = []  # type: List[ExpandedBeamBatch]
+        self._beam = None  # type: Optional[Beam]
+        # hypotheses of the beam as a batch x beam x time array
+        self._decoded = None  # type: Optional[np.ndarray]
+        # log-probabilities of the next words for the expanded beam ranks
+        self._expanded = []  # type: List[np.ndarray]
         self._time_step = 0
 
         self.result = None  # type: Option[ExecutionResult]
@@ -237,8 +193,8 @@ class RuntimeRnnExecutable(Executable):
     def next_to_execute(self) -> NextExecute:
         """Get the feedables and tensors to run.
 
-        It takes a beam batch that should be expanded the next and preprare an
-        additional feed_dict based on the hypotheses history.
+        It takes the hypotheses of the beam rank that should be expanded the
+        next and preprare an additional feed_dict based on their history.
         """
 
         if self.result is not None:
@@ -247,12 +203,11 @@ class RuntimeRnnExecutable(Executable):
 
         to_run = {'logprobs': self._decoder.train_logprobs[self._time_step]}
 
-        self._current_beam_batch = self._to_exapand.pop()
-
-        if self._current_beam_batch is not None:
-            batch_size, output_len = self._current_beam_batch.decoded.shape
+        if self._decoded is not None:
+            batch_size, _, output_len = self._decoded.shape
             fed_value = np.zeros([self._decoder.max_output_len, batch_size])
-            fed_value[:output_len, :] = self._current_beam_batch.decoded.T
+            fed_value[:output_len, :] = self._decoded[
+                :, len(self._expanded), :].T
 
             additional_feed_dict = {self._decoder.train_inputs: fed_value}
         else:
@@ -271,7 +226,8 @@ class RuntimeRnnExecutable(Executable):
         """Process what the TF session returned.
 
         Only a single time step is always processed at once. First,
-        distributions from all sessions are aggregated.
+        distributions from all sessions are aggregated. When all ranks of the
+        beam are expanded, the next beam is selected.
 
         """
 
@@ -281,18 +237,19 @@ class RuntimeRnnExecutable(Executable):
                                            sess_result["logprobs"])
         avg_logprobs = summed_logprobs - np.log(len(results))
 
-        expanded_batch = ExpandedBeamBatch(self._current_beam_batch,
-                                           avg_logprobs)
-        self._expanded.append(expanded_batch)
+        self._expanded.append(avg_logprobs)
 
-        if not self._to_exapand:
+        beam_size = 1 if self._beam is None else self._beam.tokens[-1].shape[1]
+        if len(self._expanded) == beam_size:
             self._time_step += 1
-            self._to_exapand = n_best(
-                self._beam_size, self._expanded, self._beam_scoring_f)
+            self._beam = n_best(
+                self._beam_size, self._beam,
+                np.stack(self._expanded, axis=1), self._beam_scoring_f)
+            self._decoded = decoded_hypotheses(self._beam)
             self._expanded = []
 
         if self._time_step == self._decoder.max_output_len:
-            top_batch = self._to_exapand[-1].decoded.T
+            top_batch = self._decoded[:, 0, :].T
             decoded_tokens = self._vocabulary.vectors_to_sentences(top_batch)
 
             if self._postprocess is not None:
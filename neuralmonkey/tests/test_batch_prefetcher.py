@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+# tests: mypy, lint
+
+import unittest
+
+from neuralmonkey.batch_prefetcher import BatchPrefetcher
+from neuralmonkey.dataset import Dataset
+
+
+def _batches(count):
+    dataset = Dataset("dataset", {"source": [["a"] * i for i in range(count)]},
+                      {})
+    return dataset.batch_dataset(2)
+
+
+def _prepare(batch):
+    return [len(s) for s in batch.get_series("source")]
+
+
+class TestBatchPrefetcher(unittest.TestCase):
+
+    def test_order(self):
+        for queue_size in [0, 1, 3]:
+            with BatchPrefetcher(_batches(9), _prepare, queue_size) as batches:
+                prepared = [item for _, items in batches for item in items]
+            self.assertEqual(prepared, list(range(9)))
+
+    def test_failure(self):
+        def prepare(batch):
+            if 4 in _prepare(batch):
+                raise ValueError("Failed")
+            return None
+
+        with BatchPrefetcher(_batches(9), prepare, 2) as batches:
+            with self.assertRaises(ValueError):
+                list(batches)
+
+    def test_early_close(self):
+        prefetcher = BatchPrefetcher(_batches(100), _prepare, 2)
+        for _ in prefetcher:
+            break
+        prefetcher.close()
+        # pylint: disable=protected-access
+        self.assertIsNone(prefetcher._thread)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+
+# tests: mypy, lint
+
+import unittest
+
+import numpy as np
+
+from neuralmonkey.runners.rnn_runner import (
+    decoded_hypotheses, likelihood_beam_score, n_best)
+from neuralmonkey.vocabulary import END_TOKEN_INDEX
+
+
+class TestBeamSearch(unittest.TestCase):
+
+    def test_n_best(self):
+        # batch of one item, vocabulary of four words
+        first = np.log([[[0.05, 0.05, 0.1, 0.8]]])
+        beam = n_best(2, None, first, likelihood_beam_score)
+        self.assertEqual(beam.tokens[-1].tolist(), [[3, END_TOKEN_INDEX]])
+
+        second = np.log([[[0.02, 0.03, 0.05, 0.9]],
+                         [[0.25, 0.25, 0.25, 0.25]]]).transpose(1, 0, 2)
+        beam = n_best(2, beam, second, likelihood_beam_score)
+
+        # the finished hypothesis does not change and keeps its score
+        self.assertEqual(beam.backpointers[-1].tolist(), [[0, 1]])
+        self.assertEqual(decoded_hypotheses(beam)[0, :, 0].tolist(),
+                         [3, END_TOKEN_INDEX])
+        self.assertEqual(beam.lengths.tolist(), [[2, 1]])
+        self.assertTrue(np.allclose(
+            likelihood_beam_score(beam.logprob_sums, beam.lengths),
+            [[np.log(0.8 * 0.9) - np.log(2), np.log(0.1)]]))
+        self.assertTrue(beam.finished[0, 1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,442 @@
+#!/usr/bin/env python3
+
+# tests: mypy, lint
+
+import gzip
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from neuralmonkey import dataset as dataset_module
+from neuralmonkey.dataset import (
+    PREPROCESSING_CHUNK_SIZE, Dataset, MixedDataset, load_dataset_from_files)
+from neuralmonkey.processors.filters import LengthFilter
+from neuralmonkey.token_series import TokenSeries
+
+LENGTHS = [3, 50, 4, 48, 5, 47, 2, 51, 6, 46, 7, 45]
+
+
+def _reverse(sentence):
+    return sentence[::-1]
+
+
+def _lowercase(sentence):
+    return [token.lower() for token in sentence if token not in {"<s>"}]
+
+
+def _source_lengths(dataset):
+    return [len(s) for s in dataset.get_series("source")]
+
+
+def _create_dataset():
+    source = [["w{}".format(i)] * length for i, length in enumerate(LENGTHS)]
+    target = [["t{}".format(i)] * length for i, length in enumerate(LENGTHS)]
+    return Dataset("dataset", {"source": source, "target": target}, {})
+
+
+class TestBatching(unittest.TestCase):
+
+    def test_plain_batches(self):
+        dataset = _create_dataset()
+        batches = list(dataset.batch_dataset(5))
+
+        self.assertEqual([len(b) for b in batches], [5, 5, 2])
+        self.assertSequenceEqual(
+            [item for b in batches for item in b.get_series("source")],
+            dataset.get_series("source"))
+
+    def test_bucketed_batches(self):
+        dataset = _create_dataset()
+        batches = list(dataset.batch_dataset(3, bucket_span=2))
+
+        self.assertEqual(sum(len(b) for b in batches), len(LENGTHS))
+        for batch in batches:
+            lengths = [len(s) for s in batch.get_series("source")]
+            self.assertLess(max(lengths) - min(lengths), 10)
+            for index, sent in zip(batch.indices, batch.get_series("target")):
+                self.assertEqual(sent, dataset.get_series("target")[index])
+
+        stats = dataset.padding_statistics
+        self.assertEqual(stats.tokens, 2 * sum(LENGTHS))
+        self.assertLess(stats.ratio, stats.plain_ratio)
+
+    def test_token_budget(self):
+        dataset = _create_dataset()
+        batches = list(dataset.batch_dataset(4, batch_tokens=200))
+
+        self.assertEqual(sum(len(b) for b in batches), len(LENGTHS))
+        for batch in batches:
+            self.assertLessEqual(len(batch), 4)
+            padded = len(batch) * sum(
+                max(len(s) for s in batch.get_series(key))
+                for key in ["source", "target"])
+            self.assertTrue(len(batch) == 1 or padded <= 200)
+
+    def test_token_budget_stream(self):
+        dataset = Dataset("dataset", {"source": [["a"]] * 10,
+                                      "target": [["b"]] * 10}, {})
+        # two tokens per item, the windows have four items
+        batches = list(dataset.batch_dataset(4, batch_tokens=6))
+
+        # the remainders of the windows are not batched separately
+        self.assertEqual([len(b) for b in batches], [3, 3, 3, 1])
+        self.assertEqual(
+            [i for b in batches for i in b.indices.tolist()], list(range(10)))
+
+        dataset.skip(*batches[1].position)
+        self.assertEqual(
+            [b.indices.tolist() for b in dataset.batch_dataset(
+                4, batch_tokens=6)],
+            [b.indices.tolist() for b in batches[2:]])
+
+    def test_length_series(self):
+        dataset = Dataset("dataset", {"source": [["a"]] * 10,
+                                      "target": [["b"] * 5] * 10}, {})
+        batches = list(dataset.batch_dataset(
+            4, batch_tokens=3, length_series=["source", "missing"]))
+
+        self.assertEqual([len(b) for b in batches], [3, 3, 3, 1])
+        self.assertEqual(dataset.padding_statistics.tokens, 10)
+
+    def test_numpy_series(self):
+        dataset = Dataset("dataset", {"vectors": np.arange(12).reshape(6, 2),
+                                      "source": [["a"]] * 6}, {})
+        batches = list(dataset.batch_dataset(4, bucket_span=2))
+
+        self.assertEqual(sorted(len(b) for b in batches), [2, 4])
+        for batch in batches:
+            self.assertTrue(np.array_equal(
+                batch.get_series("vectors"),
+                np.arange(12).reshape(6, 2)[batch.indices]))
+
+    def test_columnar_series(self):
+        dataset = _create_dataset()
+        source = TokenSeries.from_sentences(dataset.get_series("source"))
+        self.assertEqual(list(source), dataset.get_series("source"))
+
+        columnar = Dataset("columnar", {"source": source}, {})
+        for batch in columnar.batch_dataset(3, bucket_span=2):
+            self.assertIsInstance(batch.get_series("source"), TokenSeries)
+            self.assertEqual(
+                list(batch.get_series("source")),
+                [dataset.get_series("source")[i] for i in batch.indices])
+
+
+class TestShuffling(unittest.TestCase):
+
+    def test_shuffle_keeps_series(self):
+        dataset = _create_dataset()
+        original = list(dataset.get_series("source"))
+        dataset.shuffle()
+
+        self.assertSequenceEqual(dataset.get_series("source"), original)
+
+        batched = [item for b in dataset.batch_dataset(5)
+                   for item in b.get_series("source")]
+        self.assertNotEqual(batched, original)
+        self.assertEqual(sorted(batched), sorted(original))
+
+    def test_seeded_shuffle(self):
+        dataset = _create_dataset()
+
+        dataset.shuffle(seed=42)
+        first = [b.indices.tolist() for b in dataset.batch_dataset(5)]
+        dataset.shuffle(seed=42)
+        second = [b.indices.tolist() for b in dataset.batch_dataset(5)]
+
+        self.assertEqual(first, second)
+        self.assertEqual(dataset.shuffle_seed, 42)
+
+    def test_resume_position(self):
+        dataset = _create_dataset()
+
+        dataset.shuffle(seed=3)
+        batches = list(dataset.batch_dataset(2, bucket_span=2))
+        dataset.shuffle(seed=3)
+        dataset.skip(*batches[2].position)
+        resumed = list(dataset.batch_dataset(2, bucket_span=2))
+
+        self.assertEqual([b.indices.tolist() for b in resumed],
+                         [b.indices.tolist() for b in batches[3:]])
+
+    def test_skip_compressed(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # a compressed file has no line index
+            path = os.path.join(tmp_dir, "data.txt.gz")
+            with gzip.open(path, "wt", encoding="utf-8") as f_data:
+                for i, length in enumerate(LENGTHS):
+                    f_data.write(" ".join(["w{}".format(i)] * length) + "\n")
+
+            dataset = load_dataset_from_files(s_source=path, lazy=True)
+            dataset.skip(10)
+            self.assertEqual(
+                [len(s) for b in dataset.batch_dataset(5)
+                 for s in b.get_series("source")], LENGTHS[10:])
+
+            dataset.skip(len(LENGTHS))
+            self.assertEqual(list(dataset.batch_dataset(5)), [])
+
+            dataset.skip(len(LENGTHS) + 1)
+            with self.assertRaises(ValueError):
+                list(dataset.batch_dataset(5))
+
+
+class TestSharding(unittest.TestCase):
+
+    def test_shards_cover_dataset(self):
+        dataset = _create_dataset()
+        for strided in [False, True]:
+            shards = [dataset.shard(i, 5, strided) for i in range(5)]
+            indices = np.concatenate([s.indices for s in shards])
+            self.assertEqual(sorted(indices), list(range(len(LENGTHS))))
+
+            for shard in shards:
+                self.assertLessEqual(len(shard), 3)
+                for key in ["source", "target"]:
+                    self.assertEqual(
+                        shard.get_series(key),
+                        [dataset.get_series(key)[i] for i in shard.indices])
+
+        self.assertEqual(dataset.shard(1, 5, strided=True).indices.tolist(),
+                         [1, 6, 11])
+
+    def test_lazy_shards(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "data.txt")
+            with open(path, "w", encoding="utf-8") as f_data:
+                for i, length in enumerate(LENGTHS):
+                    f_data.write(" ".join(["w{}".format(i)] * length) + "\n")
+
+            dataset = load_dataset_from_files(s_source=path, lazy=True)
+            sentences = list(dataset.get_series("source"))
+            for strided in [False, True]:
+                shards = [dataset.shard(i, 5, strided) for i in range(5)]
+                series = [list(shard.get_series("source"))
+                          for shard in shards]
+                for shard, shard_series in zip(shards, series):
+                    # the series are aligned with the batches of the shard
+                    self.assertEqual(
+                        [s for batch in shard.batch_dataset(2)
+                         for s in batch.get_series("source")], shard_series)
+
+                if strided:
+                    self.assertEqual(series[1], sentences[1::5])
+                else:
+                    self.assertEqual(sum(series, []), sentences)
+
+    def test_invalid_shard(self):
+        with self.assertRaises(ValueError):
+            _create_dataset().shard(3, 3)
+
+
+class TestMixing(unittest.TestCase):
+
+    def test_weighted_mixture(self):
+        small = Dataset("small", {"source": [["s"]] * 3,
+                                  "target": [["t"]] * 3}, {})
+        mixed = MixedDataset("mixed", [_create_dataset(), small], [1., 2.])
+
+        passes = []
+        for _ in range(2):
+            mixed.shuffle(3)
+            passes.append([s for batch in mixed.batch_dataset(4)
+                           for s in batch.get_series("source")])
+        self.assertEqual(passes[0], passes[1])
+
+        self.assertEqual(mixed.source_epochs[0], 1)
+        self.assertEqual(mixed.source_items[0], len(LENGTHS))
+        self.assertGreater(mixed.source_epochs[1], 1)
+        self.assertEqual(passes[0].count(["s"]), mixed.source_items[1])
+
+        mixed.size = 10
+        self.assertEqual(len(list(mixed.get_series("source"))), 10)
+
+
+class TestPreprocessing(unittest.TestCase):
+
+    # the data span more than two chunks
+    lengths = [i % 7 + 1 for i in range(2 * PREPROCESSING_CHUNK_SIZE + 3)]
+
+    def _write_data(self, tmp_dir):
+        path = os.path.join(tmp_dir, "data.txt")
+        with open(path, "w", encoding="utf-8") as f_data:
+            for i, length in enumerate(self.lengths):
+                f_data.write(" ".join(["w{}".format(i)] * length) + "\n")
+        return path
+
+    def test_parallel_order(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = self._write_data(tmp_dir)
+            datasets = [
+                load_dataset_from_files(
+                    s_source=path, preprocessors=[
+                        ("source", "reversed", _reverse)],
+                    pre_lengths=_source_lengths, preprocessing_workers=workers)
+                for workers in [1, 3]]
+
+        serial, parallel = datasets
+        for name in ["reversed", "lengths"]:
+            self.assertEqual(list(parallel.get_series(name)),
+                             list(serial.get_series(name)))
+        self.assertEqual(list(parallel.get_series("lengths")), self.lengths)
+        self.assertEqual([s[0] for s in parallel.get_series("reversed")],
+                         ["w{}".format(i) for i in range(len(self.lengths))])
+
+    def test_unpicklable_preprocessor(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = self._write_data(tmp_dir)
+            # a lambda cannot be sent to the workers, no pool is created
+            with mock.patch.object(dataset_module.multiprocessing, "Pool",
+                                   side_effect=AssertionError):
+                dataset = load_dataset_from_files(
+                    s_source=path, preprocessors=[
+                        ("source", "reversed", lambda s: s[::-1])],
+                    pre_lengths=lambda d: [len(s) for s in d.get_series(
+                        "source")],
+                    preprocessing_workers=2)
+
+        self.assertEqual(list(dataset.get_series("lengths")), self.lengths)
+        self.assertEqual(dataset.get_series("reversed")[1], ["w1", "w1"])
+
+
+class TestFiltering(unittest.TestCase):
+
+    def test_length_filter(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "data.txt")
+            with open(path, "w", encoding="utf-8") as f_data:
+                for i, length in enumerate(LENGTHS):
+                    f_data.write(" ".join(["w{}".format(i)] * length) + "\n")
+
+            filters = [LengthFilter(["source"], min_length=3, max_length=47)]
+            for lazy in [False, True]:
+                dataset = load_dataset_from_files(
+                    s_source=path, lazy=lazy, filters=filters)
+                self.assertEqual(
+                    [len(s) for s in dataset.get_series("source")],
+                    [3, 4, 5, 47, 6, 46, 7, 45])
+
+            # the shard is taken from the lines before filtering
+            shard = dataset.shard(1, 2, strided=True)
+            self.assertEqual([len(s) for s in shard.get_series("source")],
+                             [47, 46, 45])
+
+    def test_length_filter_blank_lines(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "data.txt")
+            with open(path, "w", encoding="utf-8") as f_data:
+                f_data.write("a b c\n\nd e\n")
+
+            filters = [LengthFilter(["source"])]
+            for lazy in [False, True]:
+                dataset = load_dataset_from_files(
+                    s_source=path, lazy=lazy, filters=filters)
+                self.assertEqual(list(dataset.get_series("source")),
+                                 [["a", "b", "c"], ["d", "e"]])
+
+
+CACHE_KEY_SCRIPT = """
+import sys
+from neuralmonkey.dataset_cache import dataset_cache_key
+from neuralmonkey.processors.helpers import pipeline
+from neuralmonkey.readers.plain_text_reader import UtfPlainTextReader
+from neuralmonkey.tests.test_dataset import (
+    _lowercase, _reverse, _source_lengths)
+print(dataset_cache_key(
+    sys.argv[1], {"source": ([sys.argv[2]], UtfPlainTextReader)},
+    [("source", "lower", pipeline([_lowercase, _reverse]))],
+    {"lengths": _source_lengths}))
+"""
+
+
+class TestCache(unittest.TestCase):
+
+    def test_key_across_processes(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "data.txt")
+            with open(path, "w", encoding="utf-8") as f_data:
+                f_data.write("A b c\n")
+
+            root = os.path.dirname(os.path.dirname(dataset_module.__file__))
+            env = dict(os.environ)
+            env["PYTHONPATH"] = os.pathsep.join(
+                [root] + [p for p in [env.get("PYTHONPATH")] if p])
+            # every process hashes the nested code objects of the functions
+            keys = [
+                subprocess.check_output(
+                    [sys.executable, "-c", CACHE_KEY_SCRIPT, tmp_dir, path],
+                    env=env, universal_newlines=True).split()[-1]
+                for _ in range(2)]
+
+        self.assertEqual(keys[0], keys[1])
+
+    def test_cached_dataset(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "data.txt")
+            with open(path, "w", encoding="utf-8") as f_data:
+                for i, length in enumerate(LENGTHS):
+                    f_data.write(" ".join(["w{}".format(i)] * length) + "\n")
+
+            cache_dir = os.path.join(tmp_dir, "cache")
+            preprocessors = [("source", "reversed", lambda s: s[::-1])]
+            datasets = [
+                load_dataset_from_files(s_source=path,
+                                        preprocessors=preprocessors,
+                                        cache_dir=cache_dir)
+                for _ in range(2)]
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+            for dataset in datasets:
+                self.assertEqual(
+                    [len(s) for s in dataset.get_series("reversed")], LENGTHS)
+                self.assertEqual(dataset.get_series("source")[1],
+                                 ["w1"] * 50)
+
+            load_dataset_from_files(s_source=path, cache_dir=cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)), 3)
+
+    def test_uncacheable_series(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "data.txt")
+            with open(path, "w", encoding="utf-8") as f_data:
+                f_data.write("a b c\nd e\n")
+
+            # arrays of different shapes cannot be stored in the cache
+            cache_dir = os.path.join(tmp_dir, "cache")
+            dataset = load_dataset_from_files(
+                s_source=path,
+                s_ragged=([path], lambda _: [np.zeros(3), np.zeros(4)]),
+                cache_dir=cache_dir)
+            self.assertEqual(
+                [len(item) for item in dataset.get_series("ragged")], [3, 4])
+            self.assertFalse([name for name in os.listdir(cache_dir)
+                              if not name.endswith(".json")])
+
+    def test_token_counts(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "data.txt")
+            with open(path, "w", encoding="utf-8") as f_data:
+                for i, length in enumerate(LENGTHS):
+                    f_data.write(" ".join(["w{}".format(i)] * length) + "\n")
+
+            cache_dir = os.path.join(tmp_dir, "cache")
+            expected = {"w{}".format(i): length
+                        for i, length in enumerate(LENGTHS)}
+            # counted while lazily read, stored and loaded from the cache
+            for cache in [None, cache_dir, cache_dir]:
+                dataset = load_dataset_from_files(
+                    s_source=path, lazy=True, cache_dir=cache,
+                    count_series=["source", "target"])
+                self.assertEqual(dict(dataset.token_counts("source")),
+                                 expected)
+                self.assertEqual(len(dataset.token_counts("target")), 0)
+                self.assertIsNone(dataset.token_counts("reversed"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+# tests: mypy, lint
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from neuralmonkey.dataset import load_dataset_from_files
+from neuralmonkey.readers.numpy_reader import ConcatenatedArray, numpy_reader
+
+
+class TestNumpyReader(unittest.TestCase):
+
+    def test_concatenated_files(self):
+        arrays = [np.arange(i * 10, i * 10 + 2 * length).reshape(length, 2)
+                  for i, length in enumerate([3, 0, 4, 2])]
+        expected = np.concatenate(arrays)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            paths = [os.path.join(tmp_dir, "{}.npy".format(i))
+                     for i in range(len(arrays))]
+            for path, array in zip(paths, arrays):
+                np.save(path, array)
+
+            series = numpy_reader(paths)
+            self.assertEqual(series.shape, expected.shape)
+            self.assertTrue(np.array_equal(series[5], expected[5]))
+            self.assertTrue(np.array_equal(series[2:6], expected[2:6]))
+            indices = np.array([8, 0, 4, 3, -1])
+            self.assertTrue(np.array_equal(series[indices],
+                                           expected[indices]))
+            self.assertTrue(np.array_equal(np.array(series), expected))
+            self.assertTrue(np.array_equal(np.stack(list(series)), expected))
+
+    def test_dataset_batches(self):
+        arrays = [np.arange(i * 10, i * 10 + 2 * length).reshape(length, 2)
+                  for i, length in enumerate([3, 4, 2])]
+        expected = np.concatenate(arrays)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            paths = [os.path.join(tmp_dir, "{}.npy".format(i))
+                     for i in range(len(arrays))]
+            for path, array in zip(paths, arrays):
+                np.save(path, array)
+
+            dataset = load_dataset_from_files(s_feats=(paths, numpy_reader))
+            self.assertIsInstance(dataset.get_series("feats"),
+                                  ConcatenatedArray)
+
+            dataset.shuffle(seed=1)
+            batches = list(dataset.batch_dataset(4))
+            self.assertEqual(sum(len(batch) for batch in batches),
+                             len(expected))
+            for batch in batches:
+                series = batch.get_series("feats")
+                self.assertIsInstance(series, np.ndarray)
+                self.assertTrue(np.array_equal(series,
+                                               expected[batch.indices]))
+
+
+if __name__ == "__main__":
+    unittest.main()
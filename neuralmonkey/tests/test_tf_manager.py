@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+# tests: mypy, lint
+
+import unittest
+
+from neuralmonkey.dataset import Dataset
+from neuralmonkey.runners.base_runner import ExecutionResult
+from neuralmonkey.tf_manager import (
+    TensorFlowManager, coder_series, feed_dicts_by_coder)
+
+
+class FakeCoder(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.fed = 0
+
+    def feed_dict(self, dataset, train=False):
+        self.fed += 1
+        return {self.name: len(dataset)}
+
+
+class FakeExecutable(object):
+
+    def __init__(self, steps):
+        self.steps = steps
+        self.result = None
+
+    def next_to_execute(self):
+        return self.steps.pop(0), [], {}
+
+    def collect_results(self, results):
+        if not self.steps:
+            self.result = results
+
+
+class FakeSession(object):
+
+    def __init__(self):
+        self.feed_dicts = []
+
+    def run(self, fetches, feed_dict=None):
+        self.feed_dicts.append(feed_dict)
+        return {key: feed_dict for key in fetches}
+
+
+class SourceCoder(object):
+
+    def feed_dict(self, dataset, train=False):
+        return {"source": list(dataset.get_series("source"))}
+
+
+class SourceExecutable(object):
+    """Executable returning the source sentences as its outputs."""
+
+    def __init__(self, coder):
+        self.coder = coder
+        self.result = None
+
+    def next_to_execute(self):
+        return {self.coder}, [], {}
+
+    def collect_results(self, results):
+        self.result = ExecutionResult(results[0]["source"], [], None, None,
+                                      None)
+
+
+class SourceScript(object):
+
+    def __init__(self):
+        self.coder = SourceCoder()
+        self.all_coders = {self.coder}
+
+    # pylint: disable=unused-argument
+    def get_executable(self, compute_losses=False, summaries=True):
+        return SourceExecutable(self.coder)
+
+
+class TestRunStep(unittest.TestCase):
+
+    def setUp(self):
+        self.encoder = FakeCoder("encoder")
+        self.decoder = FakeCoder("decoder")
+        self.batch = Dataset("batch", {"source": [["a"], ["b"]]}, {})
+        self.session = FakeSession()
+        self.manager = TensorFlowManager.__new__(TensorFlowManager)
+        self.manager.sessions = [self.session]
+
+    def test_prefetched_feed_dicts(self):
+        prefetched = feed_dicts_by_coder(
+            self.batch, {self.encoder, self.decoder})
+        executable = FakeExecutable([{self.encoder},
+                                     {self.encoder, self.decoder}])
+
+        while executable.result is None:
+            # pylint: disable=protected-access
+            self.manager._run_step(self.batch, [executable], prefetched,
+                                   False)
+
+        # each step feeds only its coders, which are not fed again
+        self.assertEqual(self.session.feed_dicts,
+                         [{"encoder": 2}, {"encoder": 2, "decoder": 2}])
+        self.assertEqual(self.encoder.fed, 1)
+        self.assertEqual(self.decoder.fed, 1)
+
+    def test_coders_not_prefetched(self):
+        prefetched = feed_dicts_by_coder(self.batch, {self.encoder})
+        executable = FakeExecutable([{self.encoder, self.decoder}])
+
+        # pylint: disable=protected-access
+        self.manager._run_step(self.batch, [executable], prefetched, False)
+
+        self.assertEqual(self.session.feed_dicts,
+                         [{"encoder": 2, "decoder": 2}])
+        self.assertEqual(self.decoder.fed, 1)
+
+
+class TestExecute(unittest.TestCase):
+
+    def test_dataset_order(self):
+        sentences = [["w{}".format(i)] * (i % 4 + 1) for i in range(10)]
+        dataset = Dataset("dataset", {"source": sentences}, {})
+        dataset.shuffle(seed=1)
+
+        manager = TensorFlowManager.__new__(TensorFlowManager)
+        manager.sessions = [FakeSession()]
+        for bucket_span in [None, 2]:
+            result, = manager.execute(dataset, [SourceScript()],
+                                      batch_size=3, bucket_span=bucket_span)
+            self.assertEqual(result.outputs, sentences)
+
+
+class TestCoderSeries(unittest.TestCase):
+
+    def test_coder_series(self):
+        encoder = FakeCoder("encoder")
+        encoder.data_ids = ["source", "tags"]
+        decoder = FakeCoder("decoder")
+        decoder.data_id = "target"
+
+        self.assertEqual(coder_series([encoder, decoder, FakeCoder("x")]),
+                         ["source", "tags", "target"])
+
+
+if __name__ == "__main__":
+    unittest.main()
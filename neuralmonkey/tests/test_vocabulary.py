@@ -3,9 +3,18 @@
 
 # tests: mypy, lint
 
+import collections
+import os
+import pickle
+import tempfile
 import unittest
 
-from neuralmonkey.vocabulary import Vocabulary
+import numpy as np
+
+from neuralmonkey.dataset import Dataset
+from neuralmonkey.vocabulary import (
+    Vocabulary, PAD_TOKEN_INDEX, END_TOKEN_INDEX, UNK_TOKEN_INDEX,
+    from_dataset, from_file)
 
 CORPUS = [
     "the colorless ideas slept furiously",
@@ -33,10 +42,21 @@ class TestVocabulary(unittest.TestCase):
         self.assertFalse("jindrisek" in VOCABULARY)
 
     def test_padding(self):
-        pass
+        vectors, _ = VOCABULARY.sentences_to_tensor(
+            TOKENIZED_CORPUS + [["jindrisek"]], 6, add_end_symbol=True)
+        self.assertEqual(vectors.shape, (6, len(TOKENIZED_CORPUS) + 1))
+        self.assertEqual(vectors.dtype, np.int32)
+        self.assertEqual(vectors[:, 1].tolist()[4:],
+                         [END_TOKEN_INDEX, PAD_TOKEN_INDEX])
+        self.assertNotIn(END_TOKEN_INDEX, vectors[:, 3])
+        self.assertEqual(vectors[:2, -1].tolist(),
+                         [UNK_TOKEN_INDEX, END_TOKEN_INDEX])
 
     def test_weights(self):
-        pass
+        _, weights = VOCABULARY.sentences_to_tensor(
+            TOKENIZED_CORPUS, 6, add_start_symbol=True, add_end_symbol=True)
+        self.assertEqual(weights.shape, (7, len(TOKENIZED_CORPUS)))
+        self.assertEqual(weights.sum(axis=0).tolist(), [7, 6, 7, 7, 5])
 
     def test_there_and_back_self(self):
         vectors, _ = VOCABULARY.sentences_to_tensor(TOKENIZED_CORPUS, 20,
@@ -48,6 +68,71 @@ class TestVocabulary(unittest.TestCase):
                 zip(TOKENIZED_CORPUS, senteces_again):
             self.assertSequenceEqual(orig_sentence, reconstructed_sentence)
 
+    def test_ids_only(self):
+        vectors, _ = VOCABULARY.sentences_to_tensor(TOKENIZED_CORPUS, 20,
+                                                    add_end_symbol=True)
+        ids = VOCABULARY.vectors_to_sentences(vectors, ids_only=True)
+
+        self.assertEqual([len(s) for s in ids],
+                         [len(s) for s in TOKENIZED_CORPUS])
+        self.assertEqual(ids[2].tolist(), vectors[:7, 2].tolist())
+
+    def test_from_dataset_order(self):
+        dataset = Dataset("corpus", {"text": TOKENIZED_CORPUS}, {})
+        for workers in [1, 2]:
+            vocabulary = from_dataset([dataset], ["text"], 100,
+                                      workers=workers)
+            # the words are indexed in the order of their first occurrence
+            self.assertEqual(vocabulary.index_to_word,
+                             VOCABULARY.index_to_word)
+
+    def test_trunkate(self):
+        vocabulary = Vocabulary()
+        vocabulary.add_counts(collections.OrderedDict(
+            [("a", 3), ("b", 2), ("c", 2), ("d", 2), ("e", 5)]))
+        vocabulary.trunkate(3)
+
+        # of the words seen twice, the one added first is kept
+        self.assertEqual(vocabulary.index_to_word[4:], ["a", "b", "e"])
+        self.assertEqual(vocabulary.word_to_index["e"], 6)
+        self.assertEqual(vocabulary.word_count["b"], 2)
+        self.assertNotIn("c", vocabulary)
+
+    def test_save_and_load(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "vocabulary")
+            VOCABULARY.save_to_file(path)
+            loaded = from_file(path)
+
+            # the loaded vocabulary maps the file it overwrites
+            loaded.save_to_file(path, overwrite=True)
+            reloaded = from_file(path)
+
+        for vocabulary in [loaded, reloaded]:
+            self.assertEqual(vocabulary.index_to_word,
+                             VOCABULARY.index_to_word)
+            self.assertEqual(vocabulary.word_to_index,
+                             VOCABULARY.word_to_index)
+            self.assertEqual(vocabulary.word_count, VOCABULARY.word_count)
+
+    def test_load_legacy_pickle(self):
+        # older versions pickled the dictionaries as plain attributes
+        legacy = Vocabulary.__new__(Vocabulary)
+        legacy.__dict__.update({
+            "word_to_index": dict(VOCABULARY.word_to_index),
+            "index_to_word": list(VOCABULARY.index_to_word),
+            "word_count": dict(VOCABULARY.word_count),
+            "unk_sample_prob": 0.0})
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "vocabulary.pickle")
+            with open(path, "wb") as f_pickle:
+                pickle.dump(legacy, f_pickle)
+            loaded = from_file(path)
+
+        self.assertEqual(loaded.word_to_index, VOCABULARY.word_to_index)
+        self.assertEqual(loaded.word_count, VOCABULARY.word_count)
+
 
 if __name__ == "__main__":
     unittest.main()
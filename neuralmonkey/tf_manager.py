@@ -9,13 +9,15 @@ variables.
 """
 
 # pylint: disable=unused-import
-from typing import Any, List, Union
+from typing import Any, Dict, List, Optional, Set, Union
 # pylint: enable=unused-import
 
+import numpy as np
 import tensorflow as tf
 from typeguard import check_argument_types
 
 from neuralmonkey.logging import log
+from neuralmonkey.batch_prefetcher import BatchPrefetcher
 from neuralmonkey.dataset import Dataset
 from neuralmonkey.runners.base_runner import (ExecutionResult,
                                               reduce_execution_results)
@@ -82,58 +84,127 @@ class TensorFlowManager(object):
                 train=False,
                 compute_losses=True,
                 summaries=True,
-                batch_size=None) -> List[ExecutionResult]:
-        if batch_size is None:
-            batch_size = len(dataset)
-        batched_dataset = dataset.batch_dataset(batch_size)
+                batch_size=None,
+                bucket_span: Optional[int]=None,
+                batch_tokens: Optional[int]=None,
+                prefetch_batches: int=0,
+                coder_feed_dicts: Optional[Dict]=None) -> List[
+                    ExecutionResult]:
+        """Run the execution scripts on the dataset batch by batch.
+
+        Arguments:
+            dataset: The dataset to run the scripts on.
+            execution_scripts: Runners and trainers to execute.
+            train: Flag whether the scripts are executed in the training
+                mode.
+            compute_losses: Flag whether the losses should be computed.
+            summaries: Flag whether the TensorBoard summaries should be
+                computed.
+            batch_size: The size of a batch. If None, the whole dataset is
+                processed in a single batch.
+            bucket_span: If not None, batch sentences of similar lengths
+                together within windows of ``bucket_span`` batches (see
+                ``Dataset.batch_dataset``). The outputs are returned in the
+                order of the dataset regardless of the bucketing and the
+                shuffling.
+            batch_tokens: If not None, the maximum number of tokens of the
+                series fed by the coders of the scripts in a batch (see
+                ``Dataset.batch_dataset``). The batch size then limits the
+                number of sentences.
+            prefetch_batches: Number of batches whose feed dictionaries are
+                prepared in a background thread while the current batch is
+                running. Zero (default) means no prefetching.
+            coder_feed_dicts: Feed dictionaries of the coders of the scripts
+                already computed for the dataset (e.g. by a
+                ``BatchPrefetcher``), see ``feed_dicts_by_coder``. If given,
+                the dataset is processed as a single batch.
+
+        Returns:
+            List of execution results, one for every execution script.
+        """
+        all_coders = set.union(*[s.all_coders for s in execution_scripts])
+
+        if coder_feed_dicts is not None:
+            prefetcher = BatchPrefetcher(
+                [dataset], lambda _: coder_feed_dicts, 0)
+        else:
+            if batch_size is None:
+                batch_size = len(dataset)
+            prefetcher = BatchPrefetcher(
+                dataset.batch_dataset(batch_size, bucket_span, batch_tokens,
+                                      coder_series(all_coders)),
+                lambda batch: feed_dicts_by_coder(batch, all_coders,
+                                                  train=train),
+                prefetch_batches)
 
         batch_results = [
             [] for _ in execution_scripts]  # type: List[List[ExecutionResult]]
-        for batch in batched_dataset:
-            executables = [s.get_executable(compute_losses=compute_losses,
-                                            summaries=summaries)
-                           for s in execution_scripts]
-            while not all(ex.result is not None for ex in executables):
-                all_feedables = set()   # type: Set[Any]
-                # type: Dict[Executable, tf.Tensor]
-                all_tensors_to_execute = {}
-                additional_feed_dicts = []
-                tensor_list_lengths = []  # type: List[int]
-
-                for executable in executables:
-                    if executable.result is None:
-                        (feedables,
-                         tensors_to_execute,
-                         add_feed_dict) = executable.next_to_execute()
-                        all_feedables = all_feedables.union(feedables)
-                        all_tensors_to_execute[executable] = tensors_to_execute
-                        additional_feed_dicts.append(add_feed_dict)
-                        tensor_list_lengths.append(len(tensors_to_execute))
-                    else:
-                        tensor_list_lengths.append(0)
-
-                feed_dict = _feed_dicts(batch, all_feedables, train=train)
-                for fdict in additional_feed_dicts:
-                    feed_dict.update(fdict)
-
-                session_results = [sess.run(all_tensors_to_execute,
-                                            feed_dict=feed_dict)
-                                   for sess in self.sessions]
-
-                for executable in executables:
-                    if executable.result is None:
-                        executable.collect_results(
-                            [res[executable] for res in session_results])
-
-            for script_list, executable in zip(batch_results, executables):
-                script_list.append(executable.result)
+        batch_indices = []  # type: List[np.ndarray]
+        with prefetcher as batches:
+            for batch, prefetched in batches:
+                batch_indices.append(batch.indices)
+                executables = [s.get_executable(compute_losses=compute_losses,
+                                                summaries=summaries)
+                               for s in execution_scripts]
+                while not all(ex.result is not None for ex in executables):
+                    self._run_step(batch, executables, prefetched, train)
+
+                for script_list, executable in zip(batch_results,
+                                                   executables):
+                    script_list.append(executable.result)
 
         collected_results = []  # type: List[ExecutionResult]
         for result_list in batch_results:
             collected_results.append(reduce_execution_results(result_list))
 
+        # the batches follow the shuffling and the bucketing of the dataset,
+        # the outputs are always returned in the order of the dataset
+        if coder_feed_dicts is None and batch_indices:
+            order = np.argsort(np.concatenate(batch_indices), kind="mergesort")
+            collected_results = [_restore_order(result, order)
+                                 for result in collected_results]
+
         return collected_results
 
+    def _run_step(self, batch: Dataset, executables: List[Any],
+                  coder_feed_dicts: Dict[Any, Dict], train: bool) -> None:
+        """Run a single step of the unfinished executables on a batch.
+
+        Only the coders needed by the executables in this step are fed. Their
+        feed dictionaries are taken from the prefetched ones if possible.
+        """
+        all_feedables = set()   # type: Set[Any]
+        # type: Dict[Executable, tf.Tensor]
+        all_tensors_to_execute = {}
+        additional_feed_dicts = []
+
+        for executable in executables:
+            if executable.result is None:
+                (feedables,
+                 tensors_to_execute,
+                 add_feed_dict) = executable.next_to_execute()
+                all_feedables = all_feedables.union(feedables)
+                all_tensors_to_execute[executable] = tensors_to_execute
+                additional_feed_dicts.append(add_feed_dict)
+
+        if all_feedables <= set(coder_feed_dicts):
+            feed_dict = {}  # type: Dict
+            for coder in all_feedables:
+                feed_dict.update(coder_feed_dicts[coder])
+        else:
+            feed_dict = feed_dicts(batch, all_feedables, train=train)
+        for fdict in additional_feed_dicts:
+            feed_dict.update(fdict)
+
+        session_results = [sess.run(all_tensors_to_execute,
+                                    feed_dict=feed_dict)
+                           for sess in self.sessions]
+
+        for executable in executables:
+            if executable.result is None:
+                executable.collect_results(
+                    [res[executable] for res in session_results])
+
     def save(self, variable_files: Union[str, List[str]]) -> None:
         if isinstance(variable_files, str) and len(self.sessions) == 1:
             self.saver.save(self.sessions[0], variable_files)
@@ -172,7 +243,18 @@ class TensorFlowManager(object):
                 coder.load(session)
 
 
-def _feed_dicts(dataset, coders, train=False):
+def _restore_order(result: ExecutionResult,
+                   order: np.ndarray) -> ExecutionResult:
+    """Reorder outputs of the batches back to the dataset order."""
+    outputs = result.outputs
+    if len(outputs) != len(order):
+        return result
+    if isinstance(outputs, np.ndarray):
+        return result._replace(outputs=outputs[order])
+    return result._replace(outputs=[outputs[i] for i in order])
+
+
+def feed_dicts(dataset, coders, train=False):
     """
     This function ensures all encoder and decoder objects feed their the data
     they need from the dataset.
@@ -183,3 +265,22 @@ def _feed_dicts(dataset, coders, train=False):
         res.update(coder.feed_dict(dataset, train=train))
 
     return res
+
+
+def coder_series(coders) -> List[str]:
+    """Get the names of the data series the coders feed to the model."""
+    names = set()  # type: Set[str]
+    for coder in coders:
+        if getattr(coder, "data_id", None) is not None:
+            names.add(coder.data_id)
+        names.update(getattr(coder, "data_ids", None) or [])
+    return sorted(names)
+
+
+def feed_dicts_by_coder(dataset, coders, train=False) -> Dict[Any, Dict]:
+    """Get the feed dictionaries of the coders separately.
+
+    This allows preparing the data for all coders of the scripts at once and
+    feeding only those needed in a particular step.
+    """
+    return {coder: coder.feed_dict(dataset, train=train) for coder in coders}
@@ -0,0 +1,237 @@
+"""Compact storage of tokenized text series.
+
+A token series stores the sentences of a data series as a single flat array of
+token ids and an array of sentence offsets into it. The ids point to a table of
+token strings which is collected when the series is created. The arrays can be
+stored in binary files and memory-mapped when they are loaded again.
+"""
+
+# tests: lint, mypy
+
+import array
+import collections
+import json
+import os
+from typing import Any, Dict, Iterable, List, Union
+
+import numpy as np
+
+TOKENS_SUFFIX = ".tokens.json"
+IDS_SUFFIX = ".ids"
+OFFSETS_SUFFIX = ".offsets"
+
+_FLUSH_SIZE = 2 ** 20
+
+
+class OrderedCounter(collections.Counter, collections.OrderedDict):
+    """Counter which keeps its keys in the order of their first insertion.
+
+    Plain dictionaries (and counters) are unordered before Python 3.6, so the
+    order of the tokens would depend on the hash randomization.
+    """
+
+    def __reduce__(self):
+        # Counter pickles itself as a plain dictionary
+        return self.__class__, (collections.OrderedDict(self),)
+
+
+class TokenSeries(collections.Sequence):
+    """Read-only sequence of tokenized sentences in a compact form.
+
+    Items of the series are lists of strings, so the series can be used
+    wherever a list of tokenized sentences is expected. The sentences are
+    only created when they are accessed.
+
+    Attributes:
+        tokens: The table of token strings.
+        ids: Flat array of token ids of all sentences.
+        offsets: Array of sentence beginnings in the ``ids`` array followed by
+            the length of the ``ids`` array.
+    """
+
+    def __init__(self, tokens: List[str], ids: np.ndarray,
+                 offsets: np.ndarray) -> None:
+        self.tokens = tokens
+        self.ids = ids
+        self.offsets = offsets
+
+    @classmethod
+    def from_sentences(cls, sentences: Iterable[List[str]]) -> "TokenSeries":
+        """Create a token series from tokenized sentences.
+
+        The sentences are consumed one by one, so they can be produced by a
+        generator without ever being stored as lists.
+
+        Arguments:
+            sentences: Iterable of lists of tokens.
+        """
+        token_ids = {}  # type: Dict[str, int]
+        tokens = []  # type: List[str]
+        ids = array.array("i")
+        offsets = array.array("q", [0])
+
+        for sentence in sentences:
+            for token in sentence:
+                token_id = token_ids.get(token)
+                if token_id is None:
+                    token_id = len(tokens)
+                    token_ids[token] = token_id
+                    tokens.append(token)
+                ids.append(token_id)
+            offsets.append(len(ids))
+
+        return cls(tokens, np.array(ids, dtype=np.int32),
+                   np.array(offsets, dtype=np.int64))
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: Union[int, slice]) -> Any:
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("Token series index out of range")
+
+        tokens = self.tokens
+        return [tokens[i] for i in
+                self.ids[self.offsets[index]:self.offsets[index + 1]]]
+
+    def __iter__(self) -> Iterable[List[str]]:
+        tokens = self.tokens
+        for start, end in zip(self.offsets[:-1], self.offsets[1:]):
+            yield [tokens[i] for i in self.ids[start:end]]
+
+    def lengths(self) -> np.ndarray:
+        """Get the lengths of all sentences in the series."""
+        return np.diff(self.offsets)
+
+    def take(self, indices: np.ndarray) -> "TokenSeries":
+        """Select sentences from the series.
+
+        The selected sentences are gathered into new arrays without creating
+        the token lists. The table of tokens is shared with this series.
+
+        Arguments:
+            indices: Array of the sentence indices.
+
+        Returns:
+            A new token series with the selected sentences.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        starts = self.offsets[indices]
+        lengths = self.offsets[indices + 1] - starts
+
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        positions = (np.repeat(starts - offsets[:-1], lengths) +
+                     np.arange(offsets[-1]))
+
+        return TokenSeries(self.tokens, self.ids[positions], offsets)
+
+
+class TokenSeriesWriter(object):
+    """Write a token series sentence by sentence into binary files.
+
+    The token ids and offsets are appended to the files as they come, only the
+    table of tokens is kept in the memory.
+    """
+
+    def __init__(self, prefix: str) -> None:
+        """Open the files for writing.
+
+        Arguments:
+            prefix: Path prefix of the series files.
+        """
+        self.prefix = prefix
+        self._token_ids = {}  # type: Dict[str, int]
+        self._tokens = []  # type: List[str]
+        self._ids_file = open(prefix + IDS_SUFFIX, "wb")
+        self._offsets_file = open(prefix + OFFSETS_SUFFIX, "wb")
+        self._ids = []  # type: List[int]
+        self._offsets = [0]
+        self._length = 0
+
+    def add(self, sentence: List[str]) -> None:
+        """Append a tokenized sentence to the series."""
+        token_ids = self._token_ids
+        for token in sentence:
+            token_id = token_ids.get(token)
+            if token_id is None:
+                token_id = len(self._tokens)
+                token_ids[token] = token_id
+                self._tokens.append(token)
+            self._ids.append(token_id)
+
+        self._length += len(sentence)
+        self._offsets.append(self._length)
+
+        if len(self._ids) >= _FLUSH_SIZE or len(self._offsets) >= _FLUSH_SIZE:
+            self._flush()
+
+    def _flush(self) -> None:
+        np.array(self._ids, dtype=np.int32).tofile(self._ids_file)
+        np.array(self._offsets, dtype=np.int64).tofile(self._offsets_file)
+        self._ids = []
+        self._offsets = []
+
+    def close(self) -> None:
+        """Finish writing of the series."""
+        self._flush()
+        self._ids_file.close()
+        self._offsets_file.close()
+        with open(self.prefix + TOKENS_SUFFIX, "w",
+                  encoding="utf-8") as f_tokens:
+            json.dump(self._tokens, f_tokens, ensure_ascii=False)
+
+
+def load_token_series(prefix: str) -> TokenSeries:
+    """Load a token series written by the ``TokenSeriesWriter``.
+
+    The id and offset arrays are memory-mapped, so the loading is fast and the
+    series takes the memory only when it is used.
+
+    Arguments:
+        prefix: Path prefix of the series files.
+    """
+    with open(prefix + TOKENS_SUFFIX, encoding="utf-8") as f_tokens:
+        tokens = json.load(f_tokens)
+
+    ids = _memmap(prefix + IDS_SUFFIX, np.int32)
+    offsets = _memmap(prefix + OFFSETS_SUFFIX, np.int64)
+    return TokenSeries(tokens, ids, offsets)
+
+
+def count_tokens(sentences: Iterable[List[str]]) -> collections.Counter:
+    """Count the tokens of a text series.
+
+    The tokens of a token series are counted from its id array without
+    creating the sentences.
+
+    Arguments:
+        sentences: Iterable of lists of tokens or a token series.
+
+    Returns:
+        Counter of the tokens in the order of their first occurrence (for a
+        token series, in the order of its table of tokens).
+    """
+    counts = OrderedCounter()  # type: collections.Counter
+    if isinstance(sentences, TokenSeries):
+        token_counts = np.bincount(sentences.ids,
+                                   minlength=len(sentences.tokens))
+        for token, count in zip(sentences.tokens, token_counts.tolist()):
+            if count:
+                counts[token] = count
+    else:
+        for sentence in sentences:
+            counts.update(sentence)
+    return counts
+
+
+def _memmap(path: str, dtype: Any) -> np.ndarray:
+    # numpy cannot map empty files
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r")
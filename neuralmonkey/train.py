@@ -44,12 +44,22 @@ def create_config() -> Configuration:
     config.add_argument('train_start_offset', int, required=False, default=0)
     config.add_argument('runners_batch_size', int,
                         required=False, default=None)
+    config.add_argument('batch_bucket_span', int, required=False,
+                        default=None, cond=lambda x: x > 0)
+    config.add_argument('batch_tokens', int, required=False, default=None,
+                        cond=lambda x: x > 0)
+    config.add_argument('runners_batch_tokens', int, required=False,
+                        default=None, cond=lambda x: x > 0)
+    config.add_argument('prefetch_batches', int, required=False, default=0,
+                        cond=lambda x: x >= 0)
     config.add_argument('minimize', bool, required=False, default=False)
     config.add_argument('postprocess')
     config.add_argument('name', str)
     config.add_argument('random_seed', int, required=False)
     config.add_argument('initial_variables', Union[List[str], str],
                         required=False, default=None)
+    config.add_argument('resume_training', bool, required=False,
+                        default=False)
     config.add_argument('overwrite_output_dir', bool, required=False,
                         default=False)
 
@@ -182,5 +192,10 @@ def main() -> None:
         postprocess=cfg.model.postprocess,
         train_start_offset=cfg.model.train_start_offset,
         runners_batch_size=cfg.model.runners_batch_size,
+        batch_bucket_span=cfg.model.batch_bucket_span,
+        batch_tokens=cfg.model.batch_tokens,
+        runners_batch_tokens=cfg.model.runners_batch_tokens,
+        prefetch_batches=cfg.model.prefetch_batches,
         initial_variables=cfg.model.initial_variables,
+        resume_training=cfg.model.resume_training,
         minimize_metric=cfg.model.minimize)
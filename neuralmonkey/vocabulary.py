@@ -2,18 +2,23 @@
 can be used to obtain a Vocabulary instance.
 """
 
+import array
 import collections
+import json
+import multiprocessing
 import os
 import pickle as pickle
 import random
 
-from typing import List, Tuple
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
 
 import numpy as np
 from typeguard import check_argument_types
 
 from neuralmonkey.logging import log
 from neuralmonkey.dataset import Dataset, LazyDataset
+from neuralmonkey.token_series import (
+    OrderedCounter, TokenSeries, count_tokens)
 
 PAD_TOKEN = "<pad>"
 START_TOKEN = "<s>"
@@ -27,6 +32,10 @@ START_TOKEN_INDEX = 1
 END_TOKEN_INDEX = 2
 UNK_TOKEN_INDEX = 3
 
+# beginning of the vocabulary files, followed by the length of the header
+VOCABULARY_MAGIC = b"NMVOCAB\n"
+VOCABULARY_FORMAT_VERSION = 1
+
 
 def _is_special_token(word: str) -> bool:
     """Check whether word is a special token (such as <pad> or <s>).
@@ -44,10 +53,13 @@ def _is_special_token(word: str) -> bool:
 
 
 def from_file(path: str) -> 'Vocabulary':
-    """Loads vocabulary from a pickled file
+    """Loads vocabulary from a file
+
+    The file is either in the format written by ``Vocabulary.save_to_file``
+    or a pickled vocabulary written by older versions.
 
     Arguments:
-        path: The path to the pickle file
+        path: The path to the vocabulary file
 
     Returns:
         The newly created vocabulary.
@@ -55,22 +67,73 @@ def from_file(path: str) -> 'Vocabulary':
     if not os.path.exists(path):
         raise Exception("Vocabulary file does not exist: {}".format(path))
 
-    with open(path, 'rb') as f_pickle:
-        vocabulary = pickle.load(f_pickle)
-    assert isinstance(vocabulary, Vocabulary)
+    with open(path, 'rb') as f_vocab:
+        is_pickle = f_vocab.read(len(VOCABULARY_MAGIC)) != VOCABULARY_MAGIC
+
+    if is_pickle:
+        with open(path, 'rb') as f_pickle:
+            vocabulary = pickle.load(f_pickle)
+        assert isinstance(vocabulary, Vocabulary)
+        log("Pickled vocabulary loaded. Size: {} words"
+            .format(len(vocabulary)))
+    else:
+        vocabulary = _load_vocabulary_file(path)
+        log("Vocabulary loaded. Size: {} words".format(len(vocabulary)))
 
-    log("Pickled vocabulary loaded. Size: {} words".format(len(vocabulary)))
     vocabulary.log_sample()
     return vocabulary
 
 
+def _load_vocabulary_file(path: str) -> 'Vocabulary':
+    """Load a vocabulary file written by ``Vocabulary.save_to_file``.
+
+    The file consists of the magic bytes, the length of a JSON header (as a
+    little-endian 64-bit integer), the header, the counts of the words (as
+    64-bit integers) and the words in the order of their indices, separated by
+    newlines and encoded in UTF-8. The header is padded, so the counts are
+    aligned. The counts are memory-mapped and the dictionaries of the
+    vocabulary are built only when they are needed.
+    """
+    mapped = np.memmap(path, dtype=np.uint8, mode="r")
+    start = len(VOCABULARY_MAGIC) + 8
+    header_size = int(mapped[len(VOCABULARY_MAGIC):start].view("<u8")[0])
+    header = json.loads(bytes(mapped[start:start + header_size]).decode(
+        "utf-8"))
+    if header["version"] > VOCABULARY_FORMAT_VERSION:
+        raise Exception("Vocabulary file '{}' has an unsupported version {}"
+                        .format(path, header["version"]))
+
+    start += header_size
+    size = header["size"]
+    counts = mapped[start:start + 8 * size].view("<i8")
+    start += 8 * size
+    words = bytes(mapped[start:start + header["strings_bytes"]]).decode(
+        "utf-8").split("\n")
+    if len(words) != size:
+        raise Exception("Vocabulary file '{}' is corrupted".format(path))
+
+    vocabulary = Vocabulary(unk_sample_prob=header["unk_sample_prob"])
+    vocabulary.index_to_word = words
+    # pylint: disable=protected-access
+    vocabulary._word_to_index = None
+    vocabulary._word_count = None
+    vocabulary._counts = counts
+    return vocabulary
+
+
 # pylint: disable=too-many-arguments
 # helper function, this number of parameters is needed
 def from_dataset(datasets: List[Dataset], series_ids: List[str], max_size: int,
                  save_file: str=None, overwrite: bool=False,
-                 unk_sample_prob: float=0.5) -> 'Vocabulary':
+                 unk_sample_prob: float=0.5,
+                 workers: int=1) -> 'Vocabulary':
     """Loads vocabulary from a dataset with an option to save it.
 
+    The words are counted while the series are read, so the memory needed
+    depends only on the size of the vocabulary. Series in the
+    ``counted_series`` of a dataset are counted by the dataset, together with
+    the other series counted for other vocabularies.
+
     Arguments:
         datasets: A list of datasets from which to create the vocabulary
         series_ids: A list of ids of series of the datasets that should be used
@@ -80,6 +143,9 @@ def from_dataset(datasets: List[Dataset], series_ids: List[str], max_size: int,
                    the vocabulary will not be saved.
         unk_sample_prob: The probability with which to sample unks out of
                          words with frequency 1. Defaults to 0.5.
+        workers: Number of processes counting the words. Each of them
+                 counts a shard of every dataset (see ``Dataset.shard``).
+                 Defaults to 1.
 
     Returns:
         The new Vocabulary instance.
@@ -93,12 +159,7 @@ def from_dataset(datasets: List[Dataset], series_ids: List[str], max_size: int,
         if isinstance(dataset, LazyDataset):
             log("Warning: inferring vocabulary from lazy dataset", color="red")
 
-        for series_id in series_ids:
-            series = dataset.get_series(series_id, allow_none=True)
-            if series:
-                vocabulary.add_tokenized_text(
-                    [token for sent in series for token in sent])
-
+    vocabulary.add_counts(_count_words(datasets, series_ids, workers))
     vocabulary.trunkate(max_size)
 
     log("Vocabulary for series {} initialized, containing {} words"
@@ -116,6 +177,70 @@ def from_dataset(datasets: List[Dataset], series_ids: List[str], max_size: int,
     return vocabulary
 
 
+# the dataset counted by the worker processes
+_COUNTED_DATASET = None  # type: Optional[Dataset]
+
+
+def _count_words(datasets: List[Dataset], series_ids: List[str],
+                 workers: int) -> collections.Counter:
+    """Count the words of the series of the datasets.
+
+    The words are counted in the order of their first occurrence. The counts
+    memoized by a dataset (see ``Dataset.token_counts``) are used if they are
+    available.
+    """
+    counts = OrderedCounter()  # type: collections.Counter
+    for dataset in datasets:
+        for series_id in series_ids:
+            series_counts = dataset.token_counts(series_id)
+            if series_counts is None:
+                series_counts = _count_series(dataset, series_id, workers)
+            counts.update(series_counts)
+    return counts
+
+
+def _count_series(dataset: Dataset, series_id: str,
+                  workers: int) -> collections.Counter:
+    """Count the words of a series of the dataset.
+
+    In parallel, the series is split into contiguous shards whose counts are
+    merged in their order, which keeps the order of the words.
+    """
+    if workers > 1:
+        try:
+            # fails e.g. for lazy datasets of compressed files
+            dataset.shard(0, workers)
+        # pylint: disable=broad-except
+        except Exception as exc:
+            log("Cannot count words in parallel, counting serially: {}"
+                .format(exc), color="red")
+            workers = 1
+
+    if workers <= 1:
+        series = dataset.get_series(series_id, allow_none=True)
+        return count_tokens(series if series is not None else [])
+
+    counts = OrderedCounter()  # type: collections.Counter
+    tasks = [(shard, workers, series_id) for shard in range(workers)]
+    with multiprocessing.Pool(workers, initializer=_init_counting,
+                              initargs=(dataset,)) as pool:
+        for shard_counts in pool.imap(_count_shard, tasks):
+            counts.update(shard_counts)
+    return counts
+
+
+def _init_counting(dataset: Dataset) -> None:
+    # pylint: disable=global-statement
+    global _COUNTED_DATASET
+    _COUNTED_DATASET = dataset
+
+
+def _count_shard(task: Tuple[int, int, str]) -> collections.Counter:
+    assert _COUNTED_DATASET is not None
+    shard, count, series_id = task
+    return _count_series(_COUNTED_DATASET.shard(shard, count), series_id, 1)
+
+
 def from_bpe(path: str, encoding: str="utf-8") -> 'Vocabulary':
     """Loads vocabulary from Byte-pair encoding merge list.
 
@@ -205,11 +330,18 @@ class Vocabulary(collections.Sized):
         Arguments:
             tokenized_text: The initial list of words to add.
         """
-        self.word_to_index = {}  # type: Dict[str, int]
         self.index_to_word = []  # type: List[str]
-        self.word_count = {}  # type: Dict[str, int]
+        # the dictionaries are None in a vocabulary loaded from a file until
+        # they are used, the counts are kept in an array till then
+        self._word_to_index = {}  # type: Optional[Dict[str, int]]
+        self._word_count = {}  # type: Optional[Dict[str, int]]
+        self._counts = None  # type: Optional[np.ndarray]
 
         self.unk_sample_prob = unk_sample_prob
+        # mask of the word indices seen at most once, computed when needed
+        self._singletons = None  # type: Optional[np.ndarray]
+        # the words as a numpy object array, created when needed
+        self._words = None  # type: Optional[np.ndarray]
 
         self.add_word(PAD_TOKEN)
         self.add_word(START_TOKEN)
@@ -219,6 +351,46 @@ class Vocabulary(collections.Sized):
         if tokenized_text:
             self.add_tokenized_text(tokenized_text)
 
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        """Restore a pickled vocabulary.
+
+        Vocabularies pickled by older versions store the dictionaries
+        directly.
+        """
+        for name in ["word_to_index", "word_count"]:
+            if name in state:
+                state["_" + name] = state.pop(name)
+        state.setdefault("_counts", None)
+        state.setdefault("_singletons", None)
+        state.setdefault("_words", None)
+        self.__dict__.update(state)
+
+    @property
+    def word_to_index(self) -> Dict[str, int]:
+        """The dictionary from words to their indices."""
+        if self._word_to_index is None:
+            self._word_to_index = dict(
+                zip(self.index_to_word, range(len(self.index_to_word))))
+        return self._word_to_index
+
+    @word_to_index.setter
+    def word_to_index(self, value: Dict[str, int]) -> None:
+        self._word_to_index = value
+
+    @property
+    def word_count(self) -> Dict[str, int]:
+        """The dictionary from words to their counts."""
+        if self._word_count is None:
+            self._word_count = dict(
+                zip(self.index_to_word, self._counts.tolist()))
+            self._counts = None
+        return self._word_count
+
+    @word_count.setter
+    def word_count(self, value: Dict[str, int]) -> None:
+        self._word_count = value
+        self._counts = None
+
     def __len__(self) -> int:
         """Get the size of the vocabulary.
 
@@ -249,6 +421,25 @@ class Vocabulary(collections.Sized):
             self.index_to_word.append(word)
             self.word_count[word] = 0
         self.word_count[word] += 1
+        self._singletons = None
+
+    def add_counts(self, counts: Dict[str, int]) -> None:
+        """Add words with their counts to the vocabulary.
+
+        Arguments:
+            counts: Dictionary from words to their counts. New words are
+                added in its order, so it should be ordered, e.g. an
+                ``OrderedCounter`` or a ``collections.OrderedDict``.
+        """
+        word_to_index = self.word_to_index
+        word_count = self.word_count
+        for word, count in counts.items():
+            if word not in word_to_index:
+                word_to_index[word] = len(self.index_to_word)
+                self.index_to_word.append(word)
+                word_count[word] = 0
+            word_count[word] += count
+        self._singletons = None
 
     def add_tokenized_text(self, tokenized_text: List[str]) -> None:
         """Add words from a list to the vocabulary.
@@ -300,34 +491,96 @@ class Vocabulary(collections.Sized):
         """Truncate the vocabulary to the requested size by discarding
         infrequent tokens.
 
+        The most frequent words are selected without sorting the whole
+        vocabulary. Of words with the same count, the ones with lower indices
+        (i.e. added earlier) are kept. The special tokens are always kept and
+        the kept words stay in the order of their indices.
+
         Arguments:
             size: The final size of the vocabulary
         """
-        # sort by frequency
-        words_by_freq = sorted(list(self.word_count.keys()),
-                               key=lambda w: self.word_count[w])
+        if size >= len(self):
+            return
+
+        counts = self._count_array()
+        keep = np.zeros(len(counts), dtype=bool)
+        if size > 0:
+            # the count of the size-th most frequent word
+            threshold = np.partition(counts, len(counts) - size)[-size]
+            keep = counts > threshold
+            ties = np.flatnonzero(counts == threshold)
+            keep[ties[:size - np.count_nonzero(keep)]] = True
+
+        # the special tokens are added first by the constructor
+        for index, word in enumerate(
+                self.index_to_word[:len(_SPECIAL_TOKENS)]):
+            if _is_special_token(word):
+                keep[index] = True
+
+        kept = np.flatnonzero(keep)
+        self.index_to_word = [self.index_to_word[i] for i in kept.tolist()]
+        # the dictionaries are built from the counts when they are needed
+        self._counts = counts[kept]
+        self._word_count = None
+        self._word_to_index = None
+        self._singletons = None
+        self._words = None
+
+    def _singleton_mask(self) -> np.ndarray:
+        """Get the mask of the word indices seen at most once.
+
+        Vocabularies pickled by older versions do not have the attribute.
+        """
+        if getattr(self, "_singletons", None) is None:
+            self._singletons = self._count_array() <= 1
+        return self._singletons
+
+    def _count_array(self) -> np.ndarray:
+        """Get the counts of the words in the order of their indices."""
+        if self._counts is not None:
+            return np.asarray(self._counts)
+        word_count = self.word_count
+        return np.array([word_count.get(word, 0)
+                         for word in self.index_to_word], dtype=np.int64)
 
-        # keep the least frequent words which are not special symbols
-        words_to_delete = [w for w in words_by_freq[:-size]
-                           if not _is_special_token(w)]
+    def series_to_ids(self, sentences: Iterable[List[str]]) -> TokenSeries:
+        """Convert tokenized sentences to the indices of the vocabulary.
 
-        # sort by index ... bigger indices needs to be removed first
-        # to keep the lists propertly shaped
-        delete_words_by_index = sorted(
-            [(w, self.word_to_index[w]) for w in words_to_delete],
-            key=lambda p: -p[1])
+        Only the table of tokens of a token series is looked up, the indices
+        of its sentences are then gathered from the converted table.
 
-        for word, index in delete_words_by_index:
-            del self.word_count[word]
-            del self.index_to_word[index]
+        Arguments:
+            sentences: The sentences as lists of tokens or a token series.
 
-        self.word_to_index = {}
-        for index, word in enumerate(self.index_to_word):
-            self.word_to_index[word] = index
+        Returns:
+            Token series whose token table is the list of the vocabulary
+            words, i.e. its ``ids`` are the vocabulary indices.
+        """
+        if (isinstance(sentences, TokenSeries) and
+                sentences.tokens is self.index_to_word):
+            return sentences
+
+        unk_index = self.get_word_index(UNK_TOKEN)
+        if isinstance(sentences, TokenSeries):
+            table = np.fromiter(
+                (self.word_to_index.get(token, unk_index)
+                 for token in sentences.tokens),
+                dtype=np.int32, count=len(sentences.tokens))
+            return TokenSeries(self.index_to_word, table[sentences.ids],
+                               sentences.offsets)
+
+        ids = array.array("i")
+        offsets = array.array("q", [0])
+        for sentence in sentences:
+            ids.extend(self.word_to_index.get(word, unk_index)
+                       for word in sentence)
+            offsets.append(len(ids))
+        return TokenSeries(self.index_to_word, np.array(ids, dtype=np.int32),
+                           np.array(offsets, dtype=np.int64))
 
     def sentences_to_tensor(
             self,
-            sentences: List[List[str]],
+            sentences: Iterable[List[str]],
             max_len: int,
             train_mode: bool=False,
             add_start_symbol: bool=False,
@@ -335,7 +588,9 @@ class Vocabulary(collections.Sized):
         """Generate the tensor representation for the provided sentences.
 
         Arguments:
-            sentences: List of sentences as lists of tokens.
+            sentences: List of sentences as lists of tokens, or the sentences
+                already converted by ``series_to_ids`` (e.g. by
+                ``Dataset.get_token_ids``).
             max_len: Maximum lengh of a sentence toward which they will be
                 padded to.
             train_mode: Flag whether we are training or not
@@ -359,57 +614,96 @@ class Vocabulary(collections.Sized):
             The shape of the padding vector is the same as of the sentence
             vector.
         """
+        unk_index = self.get_word_index(UNK_TOKEN)
+        id_series = self.series_to_ids(sentences)
+        lengths = np.minimum(id_series.lengths(), max_len)
+
+        # indices of the first max_len words of the sentences, sentence
+        # after sentence
+        starts = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=starts[1:])
+        positions = (np.repeat(id_series.offsets[:-1] - starts[:-1], lengths) +
+                     np.arange(starts[-1]))
+        indices = id_series.ids[positions].astype(np.int32)
+
+        if train_mode and self.unk_sample_prob > 0:
+            sampled = self._singleton_mask()[indices] & (
+                np.random.random_sample(indices.shape) < self.unk_sample_prob)
+            indices[sampled] = unk_index
+
+        mask = np.arange(max_len)[:, np.newaxis] < lengths
         word_indices = np.full(
-            [max_len, len(sentences)], self.get_word_index(PAD_TOKEN),
+            [max_len, len(lengths)], self.get_word_index(PAD_TOKEN),
             dtype=np.int32)
-        weights = np.zeros([max_len, len(sentences)])
+        # the transposed mask is traversed sentence after sentence
+        word_indices.T[mask.T] = indices
+        weights = mask.astype(np.float64)
 
-        for i in range(max_len):
-            for j, sent in enumerate(sentences):
-                if i < len(sent):
-                    w_idx = (self.get_unk_sampled_word_index(sent[i])
-                             if train_mode else self.get_word_index(sent[i]))
-                    word_indices[i, j] = w_idx
-                    weights[i, j] = 1
-
-                elif i == len(sent) and add_end_symbol:
-                    word_indices[i, j] = self.get_word_index(END_TOKEN)
-                    weights[i, j] = 1
+        if add_end_symbol:
+            ended = np.flatnonzero(lengths < max_len)
+            word_indices[lengths[ended], ended] = self.get_word_index(
+                END_TOKEN)
+            weights[lengths[ended], ended] = 1
 
         if add_start_symbol:
             prepend_indices = np.full(
-                [1, len(sentences)], self.get_word_index(START_TOKEN),
+                [1, len(lengths)], self.get_word_index(START_TOKEN),
                 dtype=np.int32)
-            prepend_weights = np.ones([1, len(sentences)])
+            prepend_weights = np.ones([1, len(lengths)])
 
             word_indices = np.concatenate((prepend_indices, word_indices))
             weights = np.concatenate((prepend_weights, weights))
 
         return word_indices, weights
 
-    def vectors_to_sentences(self,
-                             vectors: List[np.ndarray]) -> List[List[str]]:
+    def vectors_to_sentences(
+            self, vectors: Union[List[np.ndarray], np.ndarray],
+            ids_only: bool=False) -> Union[List[List[str]], List[np.ndarray]]:
         """Convert vectors of indexes of vocabulary items to lists of words.
 
+        The sentences end before the first end token. The end positions are
+        found and the words are gathered for the whole batch at once.
+
         Arguments:
-            vectors: List of vectors of vocabulary indices.
+            vectors: List of vectors of vocabulary indices, one for every
+                time step, or a time x batch array.
+            ids_only: If True, return the indices of the words instead of
+                the words, e.g. for postprocessors which work on the indices.
 
         Returns:
-            List of lists of words.
+            List of lists of words, or arrays of the word indices if
+            ``ids_only`` is set.
         """
-        sentences = [[] for _ in range(vectors[0].shape[0])]
-        # type: List[List[str]]
+        indices = np.asarray(vectors).T
+        is_end = indices == END_TOKEN_INDEX
+        lengths = np.where(is_end.any(axis=1), is_end.argmax(axis=1),
+                           indices.shape[1])
+
+        if ids_only:
+            return [row[:length] for row, length in zip(indices, lengths)]
 
-        for vec in vectors:
-            for sentence, word_i in zip(sentences, vec):
-                if not sentence or sentence[-1] != END_TOKEN:
-                    sentence.append(self.index_to_word[word_i])
+        words = self._word_array()[indices]
+        return [row[:length].tolist() for row, length in zip(words, lengths)]
 
-        return [s[:-1] if s[-1] == END_TOKEN else s for s in sentences]
+    def _word_array(self) -> np.ndarray:
+        """Get the words as a numpy object array to gather them by indices.
+
+        Vocabularies pickled by older versions do not have the attribute.
+        """
+        words = getattr(self, "_words", None)
+        # the words are only appended, except for truncating
+        if words is None or len(words) != len(self.index_to_word):
+            words = np.empty(len(self.index_to_word), dtype=object)
+            words[:] = self.index_to_word
+            self._words = words
+        return words
 
     def save_to_file(self, path: str, overwrite: bool=False) -> None:
         """Save the vocabulary to a file.
 
+        The vocabulary is stored in a compact binary format which is loaded
+        fast (see ``from_file``), not pickled.
+
         Arguments:
             path: The path to save the file to.
             overwrite: Flag whether to overwrite existing file.
@@ -417,13 +711,36 @@ class Vocabulary(collections.Sized):
         Raises:
             FileExistsError if the file exists and overwrite flag is
             disabled.
+            ValueError if a word contains a newline.
         """
         if os.path.exists(path) and not overwrite:
             raise FileExistsError("Cannot save vocabulary: File exists and "
                                   "overwrite is disabled. {}".format(path))
 
-        with open(path, 'wb') as f_pickle:
-            pickle.dump(self, f_pickle)
+        if any("\n" in word for word in self.index_to_word):
+            raise ValueError("Cannot save vocabulary with newlines in words")
+        strings = "\n".join(self.index_to_word).encode("utf-8")
+
+        header = json.dumps({
+            "version": VOCABULARY_FORMAT_VERSION,
+            "size": len(self),
+            "strings_bytes": len(strings),
+            "unk_sample_prob": self.unk_sample_prob}).encode("utf-8")
+        # align the counts to 8 bytes
+        header += b" " * (-len(header) % 8)
+
+        # the counts of a loaded vocabulary are mapped from its file, which
+        # may be the one being overwritten, so they are copied first and the
+        # file is replaced only when the new one is written
+        counts = self._count_array().astype("<i8").tobytes()
+        tmp_path = "{}.tmp-{}".format(path, os.getpid())
+        with open(tmp_path, 'wb') as f_vocab:
+            f_vocab.write(VOCABULARY_MAGIC)
+            f_vocab.write(np.array([len(header)], dtype="<u8").tobytes())
+            f_vocab.write(header)
+            f_vocab.write(counts)
+            f_vocab.write(strings)
+        os.replace(tmp_path, path)
 
     def log_sample(self, size: int=5):
         """Logs a sample of the vocabulary
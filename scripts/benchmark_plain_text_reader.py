@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""Measure the throughput of the plain text reader.
+
+The block reader is compared with the line-by-line reading the plain text
+reader used before, on an uncompressed file and its gzip, bzip2 and xz
+compressed copies. The compressed copies are created in a temporary
+directory.
+
+Example::
+
+    scripts/benchmark_plain_text_reader.py tests/data/train.tc.en --repeat 50
+"""
+
+import argparse
+import bz2
+import gzip
+import lzma
+import os
+import shutil
+import tempfile
+import time
+from typing import Callable, Iterable, List
+
+from neuralmonkey.readers.plain_text_reader import PlainTextReader
+
+
+def line_reader(files: List[str]) -> Iterable[List[str]]:
+    """The original reader decoding and splitting the lines one by one."""
+    for path in files:
+        if path.endswith(".gz"):
+            with gzip.open(path, 'r') as f_data:
+                for line in f_data:
+                    yield str(line, "utf-8").strip().split(" ")
+        elif path.endswith((".bz2", ".xz")):
+            opener = bz2.open if path.endswith(".bz2") else lzma.open
+            with opener(path, "rt", encoding="utf-8") as f_data:
+                for line in f_data:
+                    yield line.strip().split(" ")
+        else:
+            with open(path, encoding="utf-8") as f_data:
+                for line in f_data:
+                    yield line.strip().split(" ")
+
+
+def measure(reader: Callable[[List[str]], Iterable[List[str]]],
+            path: str, size: int) -> float:
+    """Read the file and return the throughput of the text in MB/s."""
+    start = time.perf_counter()
+    for _ in reader([path]):
+        pass
+    elapsed = time.perf_counter() - start
+    return size / 2 ** 20 / elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("file", help="Uncompressed tokenized text file")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="Concatenate the file this many times")
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        plain = os.path.join(tmp_dir, "data.txt")
+        with open(args.file, "rb") as f_in, open(plain, "wb") as f_out:
+            data = f_in.read()
+            for _ in range(args.repeat):
+                f_out.write(data)
+
+        paths = [plain]
+        for suffix, opener in [(".gz", gzip.open), (".bz2", bz2.open),
+                               (".xz", lzma.open)]:
+            paths.append(plain + suffix)
+            with open(plain, "rb") as f_in, opener(paths[-1], "wb") as f_out:
+                shutil.copyfileobj(f_in, f_out)
+
+        readers = [("line by line", line_reader),
+                   ("blocks", PlainTextReader()),
+                   ("blocks, mmap", PlainTextReader(use_mmap=True))]
+
+        size = os.path.getsize(plain)
+        print("{:<12} {:>14} {:>14} {:>14}".format(
+            "file", *[name for name, _ in readers]))
+        for path in paths:
+            results = [measure(reader, path, size) for _, reader in readers]
+            print("{:<12} {:>9.1f} MB/s {:>9.1f} MB/s {:>9.1f} MB/s".format(
+                os.path.basename(path), *results))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
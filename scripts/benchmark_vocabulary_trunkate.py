@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""Measure the time of truncating a large vocabulary.
+
+A vocabulary of random words with Zipf-distributed counts is truncated to the
+given size. The truncation is compared with the original implementation,
+which sorted all words and deleted the discarded ones from the list one by
+one, unless it would take too long (see ``--max-old-size``).
+
+Example::
+
+    scripts/benchmark_vocabulary_trunkate.py --types 5000000 --size 50000
+"""
+
+import argparse
+import time
+from typing import Dict
+
+import numpy as np
+
+from neuralmonkey.vocabulary import Vocabulary, _is_special_token
+
+
+def old_trunkate(vocabulary: Vocabulary, size: int) -> None:
+    """The original truncation deleting the words one by one."""
+    words_by_freq = sorted(list(vocabulary.word_count.keys()),
+                           key=lambda w: vocabulary.word_count[w])
+    words_to_delete = [w for w in words_by_freq[:-size]
+                       if not _is_special_token(w)]
+    delete_words_by_index = sorted(
+        [(w, vocabulary.word_to_index[w]) for w in words_to_delete],
+        key=lambda p: -p[1])
+
+    for word, index in delete_words_by_index:
+        del vocabulary.word_count[word]
+        del vocabulary.index_to_word[index]
+
+    vocabulary.word_to_index = {}
+    for index, word in enumerate(vocabulary.index_to_word):
+        vocabulary.word_to_index[word] = index
+
+
+def random_counts(types: int, seed: int) -> Dict[str, int]:
+    random = np.random.RandomState(seed)
+    counts = np.minimum(random.zipf(1.3, size=types), 10 ** 9)
+    return {"w{}".format(i): int(count) for i, count in enumerate(counts)}
+
+
+def measure(counts: Dict[str, int], size: int, old: bool) -> float:
+    vocabulary = Vocabulary()
+    vocabulary.add_counts(counts)
+    start = time.perf_counter()
+    if old:
+        old_trunkate(vocabulary, size)
+    else:
+        vocabulary.trunkate(size)
+        # include building the dictionaries the old version built eagerly
+        assert vocabulary.word_to_index and vocabulary.word_count
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--types", type=int, default=5000000,
+                        help="Number of distinct words in the vocabulary")
+    parser.add_argument("--size", type=int, default=50000,
+                        help="Size of the truncated vocabulary")
+    parser.add_argument("--max-old-size", type=int, default=500000,
+                        help="Measure the original implementation only on "
+                        "vocabularies up to this size")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    counts = random_counts(args.types, args.seed)
+    print("truncating {} types to {}".format(args.types, args.size))
+    print("top-k selection: {:.2f} s".format(
+        measure(counts, args.size, old=False)))
+    if args.types <= args.max_old_size:
+        print("original:        {:.2f} s".format(
+            measure(counts, args.size, old=True)))
+    else:
+        print("original:        skipped, more than {} types".format(
+            args.max_old_size))
+
+
+if __name__ == "__main__":
+    main()